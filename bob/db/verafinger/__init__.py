@@ -4,11 +4,37 @@
 """The VERA Database for finger verification
 """
 
-from .query import Database
-from .models import Client, Finger, File, Protocol, Subset
+# public names and the submodules defining them - submodules are only imported
+# on first access to one of their names, so that importing this package does
+# not pull in SQLAlchemy, nor does it open the database (see PEP 562)
+_lazy = {
+    'Database': 'query',
+    'Client': 'models',
+    'Finger': 'models',
+    'File': 'models',
+    'Protocol': 'models',
+    'Subset': 'models',
+    'PADDatabase': 'pad',
+    'PADProtocol': 'models',
+    'PADSubset': 'models',
+    }
 
-from .pad import PADDatabase
-from .models import PADProtocol, PADSubset
+
+def __getattr__(name):
+
+  if name not in _lazy:
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__,
+      name))
+
+  import importlib
+  module = importlib.import_module('.' + _lazy[name], __name__)
+  value = getattr(module, name)
+  globals()[name] = value
+  return value
+
+
+def __dir__():
+  return sorted(set(globals()) | set(_lazy))
 
 
 def get_config():
@@ -19,4 +45,4 @@ def get_config():
 
 
 # gets sphinx autodoc done right - don't remove it
-__all__ = [_ for _ in dir() if not _.startswith('_')]
+__all__ = sorted(_lazy) + ['get_config']
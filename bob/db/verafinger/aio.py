@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Asynchronous (:py:mod:`asyncio`) access to the VERA database
+
+Queries and file loading in this package are blocking calls. The coroutines
+in this module, and the ``a``-prefixed methods of
+:py:class:`bob.db.verafinger.Database`, :py:class:`bob.db.verafinger.PADDatabase`
+and :py:class:`bob.db.verafinger.File` using them, run those calls on a
+process-wide pool of threads, so that they do not block the event loop.
+
+Concurrency is bounded by the number of threads in the pool (see
+:py:func:`set_workers`): requests beyond that wait for a free thread, so that
+hundreds of concurrent requests do not open hundreds of files at once.
+Database sessions are not thread-safe, so queries on the same database object
+are serialised, while files are loaded concurrently.
+"""
+
+import os
+import weakref
+import threading
+import functools
+import itertools
+import collections
+
+
+WORKERS = 8
+"""Default number of threads for running blocking calls"""
+
+
+_LOCK = threading.Lock()
+_STATE = {'workers': WORKERS, 'executor': None}
+_QUERY_LOCKS = weakref.WeakKeyDictionary()
+
+
+def _after_fork():
+  """Forgets the executor (and the lock) inherited from the parent process"""
+
+  global _LOCK
+  _LOCK = threading.Lock()
+  _STATE['executor'] = None
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork)
+
+
+def set_workers(workers):
+  """Sets the maximum number of blocking calls running concurrently
+
+  Calls already running finish on the previous pool of threads. New calls
+  run on a new pool, of the given size.
+  """
+
+  with _LOCK:
+    _STATE['workers'] = max(1, int(workers))
+    previous, _STATE['executor'] = _STATE['executor'], None
+  if previous is not None: previous.shutdown(wait=False)
+
+
+def executor():
+  """Returns the pool of threads running blocking calls, shared within the
+  process"""
+
+  with _LOCK:
+    if _STATE['executor'] is None:
+      from concurrent.futures import ThreadPoolExecutor
+      _STATE['executor'] = ThreadPoolExecutor(
+          max_workers=_STATE['workers'], thread_name_prefix='verafinger')
+    return _STATE['executor']
+
+
+async def run(function, *args, **kwargs):
+  """Runs a blocking call on the shared pool of threads
+
+
+  Parameters:
+
+    function (callable): The function to call
+
+    args, kwargs: Arguments to pass to ``function``
+
+
+  Returns:
+
+    object: The value returned by ``function``
+
+  """
+
+  import asyncio
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(executor(),
+      functools.partial(function, *args, **kwargs))
+
+
+def _query_lock(db):
+  """Returns the lock serialising queries on a database object, for the
+  running event loop"""
+
+  import asyncio
+  loop = asyncio.get_running_loop()
+  with _LOCK:
+    locks = _QUERY_LOCKS.setdefault(loop, weakref.WeakKeyDictionary())
+    lock = locks.get(db)
+    if lock is None: lock = locks[db] = asyncio.Lock()
+  return lock
+
+
+async def query(db, method, *args, **kwargs):
+  """Runs a query on the shared pool of threads
+
+  Queries on the same database object wait for each other on the event loop,
+  instead of blocking threads of the pool.
+
+
+  Parameters:
+
+    db (bob.db.verafinger.Database): The database object to query (or a
+      :py:class:`bob.db.verafinger.PADDatabase`)
+
+    method (callable): A (bound) method of ``db``
+
+    args, kwargs: Arguments to pass to ``method``
+
+
+  Returns:
+
+    object: The value returned by ``method``
+
+  """
+
+  async with _query_lock(db):
+    return await run(method, *args, **kwargs)
+
+
+async def stream(files, directory=None, extension='.png', roi=None,
+    depth=16):
+  """Asynchronously iterates over images of a list of files
+
+  This is the asynchronous counterpart of
+  :py:func:`bob.db.verafinger.loader.prefetch`: images are loaded on the
+  shared pool of threads, at most ``depth`` files ahead of the one last
+  returned, and returned in the same order as ``files``. Pending loads are
+  cancelled if the iterator is closed.
+
+
+  Parameters:
+
+    files (list): An iterable over :py:class:`bob.db.verafinger.File` (or
+      :py:class:`bob.db.verafinger.records.FileRow`) objects
+
+    directory (str, optional): The path to the root of the dataset
+      installation. See :py:meth:`bob.db.verafinger.File.load`.
+
+    extension (str, optional): The extension to use for loading the files in
+      question. See :py:meth:`bob.db.verafinger.File.load`.
+
+    roi (str, optional): If set, the path to the root of the dataset
+      installation, from which region-of-interest annotations are also loaded
+
+    depth (int, optional): The maximum number of files loaded ahead
+
+
+  Returns:
+
+    async_generator: An asynchronous generator of tuples ``(file, image,
+    roi)``, where ``roi`` is ``None`` if not loading annotations
+
+  """
+
+  import asyncio
+  from .loader import load_with_roi
+
+  loop = asyncio.get_running_loop()
+  pool = executor()
+  _load = functools.partial(load_with_roi, directory=directory,
+      extension=extension, roi=roi)
+
+  files = iter(files)
+  pending = collections.deque()
+  try:
+    for f in itertools.islice(files, max(1, depth)):
+      pending.append(loop.run_in_executor(pool, _load, f))
+    while pending:
+      retval = await pending.popleft()
+      # refills the queue before the caller starts working on this image
+      for f in itertools.islice(files, 1):
+        pending.append(loop.run_in_executor(pool, _load, f))
+      yield retval
+  finally:
+    for k in pending: k.cancel()
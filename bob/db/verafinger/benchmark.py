@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Performance benchmarks for the VERA database interface
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+
+IMPORT_STATEMENTS = (
+    ('import', 'import bob.db.verafinger'),
+    ('import+models', 'import bob.db.verafinger.models'),
+    ('import+Database', 'import bob.db.verafinger; ' \
+        'bob.db.verafinger.Database'),
+    )
+"""Statements timed by :py:func:`time_imports`, with their names"""
+
+
+def time_import(statement, repeat=5):
+  """Times a statement importing modules on a fresh interpreter
+
+  Each repetition runs on a new Python process, so that timings correspond to
+  cold imports (modulo the operating system's file cache).
+
+
+  Parameters:
+
+    statement (str): The Python statement to time
+
+    repeat (int, optional): The number of times to run the statement
+
+
+  Returns:
+
+    list: A list of floats with the time, in seconds, taken by each
+    repetition
+
+  """
+
+  code = 'import time; _start = time.perf_counter(); %s; ' \
+      'print(time.perf_counter() - _start)' % statement
+
+  retval = []
+  for _ in range(repeat):
+    output = subprocess.check_output([sys.executable, '-c', code])
+    retval.append(float(output.decode().strip().split()[-1]))
+  return retval
+
+
+def time_imports(repeat=5):
+  """Times cold imports of this package
+
+  Returns a dictionary mapping each of the names in
+  :py:data:`IMPORT_STATEMENTS` to the list of timings returned by
+  :py:func:`time_import`.
+  """
+
+  return dict([(name, time_import(statement, repeat)) for name, statement in
+    IMPORT_STATEMENTS])
+
+
+def time_create(directory, repeat=1):
+  """Times the creation of the SQLite database from the raw dataset
+
+  Databases are created on a temporary directory, which is removed
+  afterwards, so the installed database is never touched.
+
+
+  Parameters:
+
+    directory (str): The path to the root of the dataset installation (the
+      directory containing ``metadata.csv`` and ``protocols``)
+
+    repeat (int, optional): The number of times to create the database
+
+
+  Returns:
+
+    list: A list of floats with the time, in seconds, taken by each
+    repetition
+
+  """
+
+  import argparse
+  from .create import create
+
+  retval = []
+  for _ in range(repeat):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      args = argparse.Namespace(files=[os.path.join(tmpdir, 'db.sql3')],
+          type='sqlite', recreate=True, verbose=0, directory=directory)
+      start = time.perf_counter()
+      create(args)
+      retval.append(time.perf_counter() - start)
+    finally:
+      shutil.rmtree(tmpdir)
+  return retval
+
+
+BACKENDS = ('sql', 'index', 'snapshot')
+"""Backends for which queries are timed by :py:func:`time_queries`"""
+
+
+def query_cases(db, paddb):
+  """Returns the queries timed by :py:func:`time_queries`
+
+  Covers :py:meth:`bob.db.verafinger.Database.objects` on every protocol,
+  group and purpose (with and without model identifiers),
+  :py:meth:`bob.db.verafinger.Database.model_ids`,
+  :py:meth:`bob.db.verafinger.PADDatabase.objects` on every protocol, group
+  and purpose and building paths for the files of a large subset.
+
+
+  Parameters:
+
+    db (bob.db.verafinger.Database): The database to query
+
+    paddb (bob.db.verafinger.PADDatabase): The PAD database to query
+
+
+  Returns:
+
+    list: A list of tuples ``(name, function)``, where ``function`` takes no
+    parameters and runs the query
+
+  """
+
+  retval = [('model_ids()', db.model_ids)]
+
+  for protocol in db.protocol_names():
+    retval.append(('model_ids(%s)' % protocol,
+      lambda p=protocol: db.model_ids(p)))
+    retval.append(('model_ids(%s/dev)' % protocol,
+      lambda p=protocol: db.model_ids(p, 'dev')))
+    for group in db.groups():
+      retval.append(('objects(%s/%s)' % (protocol, group),
+        lambda p=protocol, g=group: db.objects(p, g)))
+    for purpose in ('enroll', 'probe', 'attack'):
+      retval.append(('objects(%s/dev/%s)' % (protocol, purpose),
+        lambda p=protocol, u=purpose: db.objects(p, 'dev', u)))
+    model_ids = db.model_ids(protocol, 'dev')
+    if model_ids:
+      for purpose in ('enroll', 'attack'):
+        retval.append(('objects(%s/dev/%s/%s)' % (protocol, purpose,
+          model_ids[0]), lambda p=protocol, u=purpose, m=model_ids[0]: \
+              db.objects(p, 'dev', u, m)))
+
+  for protocol in paddb.protocol_names():
+    for group in paddb.groups():
+      retval.append(('padobjects(%s/%s)' % (protocol, group),
+        lambda p=protocol, g=group: paddb.objects(p, g)))
+      for purpose in paddb.purposes():
+        retval.append(('padobjects(%s/%s/%s)' % (protocol, group, purpose),
+          lambda p=protocol, g=group, u=purpose: paddb.objects(p, g, u)))
+
+  retval.append(('make_path(Full/dev)', lambda: [k.make_path('/root',
+    '.png') for k in db.objects('Full', 'dev')]))
+
+  return retval
+
+
+def time_queries(sqlite_file=None, repeat=5, backend='sql'):
+  """Times queries on the database
+
+  Each query is timed ``repeat`` times cold and warm. Before each cold run,
+  memoised metadata and the in-memory index are dropped (see
+  :py:meth:`bob.db.verafinger.Database.clear_cache`), so that it includes
+  their lazy initialisation. The warm run follows right after, on the same
+  database objects, and does not.
+
+
+  Parameters:
+
+    sqlite_file (:py:class:`str`, optional): The path to the SQLite file to
+      query (e.g. a synthetic database, see
+      :py:mod:`bob.db.verafinger.synthetic`). If not set, use the one
+      installed with this package.
+
+    repeat (:py:class:`int`, optional): The number of times to run each query
+
+    backend (:py:class:`str`, optional): One of :py:data:`BACKENDS`. The
+      ``index`` backend corresponds to the ``sql`` backend with the
+      in-memory index turned on.
+
+
+  Returns:
+
+    dict: A dictionary mapping the names of queries (see
+    :py:func:`query_cases`), prefixed by the backend and suffixed by ``cold``
+    or ``warm``, to lists of floats with the time, in seconds, taken by each
+    repetition
+
+  """
+
+  from .query import Database
+  from .pad import PADDatabase
+
+  kwargs = dict(sqlite_file=sqlite_file, index=(backend == 'index'),
+      backend=('snapshot' if backend == 'snapshot' else 'sql'))
+  db = Database(**kwargs)
+  paddb = PADDatabase(**kwargs)
+
+  retval = {}
+  for name, function in query_cases(db, paddb):
+    cold = []
+    warm = []
+    for _ in range(repeat):
+      db.clear_cache()
+      paddb.clear_cache()
+      for timings in (cold, warm):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    retval['%s:%s:cold' % (backend, name)] = cold
+    retval['%s:%s:warm' % (backend, name)] = warm
+  return retval
+
+
+def report(timings, **metadata):
+  """Returns a machine-readable report of benchmark results
+
+  The report is a dictionary that can be serialised as JSON. It holds
+  information about the environment, the given metadata and, for each
+  benchmark, all timings (in the order they were measured) with their
+  minimum and median, in seconds.
+  """
+
+  import platform
+
+  def _summary(values):
+    ordered = sorted(values)
+    return dict(timings=list(values), min=ordered[0],
+        median=ordered[len(ordered) // 2])
+
+  try:
+    import importlib.metadata
+    version = importlib.metadata.version('bob.db.verafinger')
+  except Exception:
+    version = None
+
+  retval = dict(
+      version=version,
+      python=platform.python_version(),
+      platform=platform.platform(),
+      time=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+      results=dict([(k, _summary(v)) for k, v in timings.items()]),
+      )
+  retval.update(metadata)
+  return retval
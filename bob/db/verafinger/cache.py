@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Process-wide cache of decoded images and region-of-interest annotations
+
+The biometric recognition and presentation attack detection protocols of this
+database refer to the same :py:class:`bob.db.verafinger.File` entries, so
+that combined vulnerability and PAD analyses end-up decoding the same files
+more than once. This module provides a bounded, byte-size-aware LRU cache that
+is used by :py:meth:`bob.db.verafinger.File.load` and
+:py:meth:`bob.db.verafinger.File.roi`, and therefore shared by all instances
+of :py:class:`bob.db.verafinger.Database` and
+:py:class:`bob.db.verafinger.PADDatabase` in a process.
+
+The cache is disabled by default. Enable it by setting a maximum size in
+bytes:
+
+.. code-block:: python
+
+   from bob.db.verafinger import cache
+   cache.configure(max_bytes=2**30) #1 GB
+"""
+
+import threading
+import collections
+
+import numpy
+
+
+class LRUCache(object):
+  """A thread-safe, least-recently-used cache bounded by size in bytes
+
+  Values stored in this cache are read-only views on NumPy arrays, given
+  they are shared between all callers. Memory-mapped arrays are not stored:
+  they are not resident in memory and mapping them again is cheap.
+
+
+  Parameters:
+
+    max_bytes (int, optional): The maximum number of bytes to keep in the
+      cache. If set to zero, the cache is disabled.
+
+  """
+
+
+  def __init__(self, max_bytes=0):
+
+    self._lock = threading.Lock()
+    self._data = collections.OrderedDict()
+    self._max_bytes = max_bytes
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+
+  @property
+  def max_bytes(self):
+    """The maximum number of bytes to keep in the cache"""
+
+    return self._max_bytes
+
+
+  @max_bytes.setter
+  def max_bytes(self, value):
+
+    with self._lock:
+      self._max_bytes = value
+      self._evict()
+
+
+  @property
+  def enabled(self):
+    """If this cache stores anything at all"""
+
+    return self._max_bytes > 0
+
+
+  def _evict(self):
+    """Evicts least recently used entries until we are within bounds"""
+
+    while self._data and self.bytes > self._max_bytes:
+      _, value = self._data.popitem(last=False)
+      self.bytes -= value.nbytes
+      self.evictions += 1
+
+
+  def get(self, key):
+    """Returns the value stored for ``key`` or ``None``, if not cached"""
+
+    with self._lock:
+      value = self._data.get(key)
+      if value is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self._data.move_to_end(key)
+      return value
+
+
+  def put(self, key, value):
+    """Stores a copy-free, read-only view of ``value`` under ``key``
+
+    ``value`` itself is not modified. Callers should use the returned view
+    from then on and drop their reference to ``value``, since changes to it
+    would be visible through the cache. Values larger than
+    :py:attr:`max_bytes` and memory-mapped arrays are not stored.
+
+
+    Parameters:
+
+      key (object): The key to store ``value`` under
+
+      value (numpy.ndarray): The array to store
+
+
+    Returns:
+
+      numpy.ndarray: The read-only view stored on the cache, or ``value``
+      itself, if not stored
+
+    """
+
+    if value.nbytes > self._max_bytes or isinstance(value, numpy.memmap):
+      return value
+
+    value = value.view()
+    value.setflags(write=False)
+
+    with self._lock:
+      previous = self._data.pop(key, None)
+      if previous is not None: self.bytes -= previous.nbytes
+      self._data[key] = value
+      self.bytes += value.nbytes
+      self._evict()
+
+    return value
+
+
+  def clear(self):
+    """Removes all entries from the cache and resets statistics"""
+
+    with self._lock:
+      self._data.clear()
+      self.bytes = 0
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+
+
+  def stats(self):
+    """Returns a dictionary with statistics about this cache"""
+
+    with self._lock:
+      return dict(
+          entries=len(self._data),
+          bytes=self.bytes,
+          max_bytes=self._max_bytes,
+          hits=self.hits,
+          misses=self.misses,
+          evictions=self.evictions,
+          )
+
+
+  def __len__(self):
+    return len(self._data)
+
+
+class Memo(object):
+  """A thread-safe memoisation table for small, immutable metadata
+
+  Used by :py:class:`bob.db.verafinger.Database` and
+  :py:class:`bob.db.verafinger.PADDatabase` to avoid re-issuing queries for
+  information that does not change while the database is open (e.g. protocol
+  names or model identifiers). Entries are never evicted, only explicitly
+  cleared.
+  """
+
+
+  def __init__(self):
+
+    self._lock = threading.Lock()
+    self._data = {}
+    self.hits = 0
+    self.misses = 0
+
+
+  def __call__(self, key, function, *args):
+    """Returns the value memoised for ``key``, calling ``function(*args)`` to
+    compute it if not available yet"""
+
+    with self._lock:
+      if key in self._data:
+        self.hits += 1
+        return self._data[key]
+      self.misses += 1
+
+    value = function(*args)
+
+    with self._lock:
+      return self._data.setdefault(key, value)
+
+
+  def clear(self):
+    """Removes all entries and resets statistics"""
+
+    with self._lock:
+      self._data.clear()
+      self.hits = 0
+      self.misses = 0
+
+
+  def stats(self):
+    """Returns a dictionary with statistics about this table"""
+
+    with self._lock:
+      return dict(entries=len(self._data), hits=self.hits,
+          misses=self.misses)
+
+
+  def __len__(self):
+    return len(self._data)
+
+
+CACHE = LRUCache()
+"""The process-wide cache used by :py:class:`bob.db.verafinger.File`"""
+
+
+def configure(max_bytes):
+  """Sets the maximum size of the process-wide cache, in bytes
+
+  Setting it to zero disables (and empties) the cache.
+  """
+
+  CACHE.max_bytes = max_bytes
+
+
+def stats():
+  """Returns statistics about the process-wide cache"""
+
+  return CACHE.stats()
+
+
+def clear():
+  """Empties the process-wide cache and resets its statistics"""
+
+  CACHE.clear()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Parallel, incremental verification of a VERA dataset installation
+
+Files are checked on a pool of threads. For each file, we record its size,
+modification time and, optionally, a content hash on a manifest keyed by
+:py:attr:`bob.db.verafinger.File.id`. When a manifest from a previous run is
+given, only files whose size or modification time changed are hashed again, so
+that re-validating a dataset copy is dominated by ``stat`` calls.
+"""
+
+import os
+import json
+import hashlib
+
+
+HASHES = ('sha256', 'xxhash')
+"""Supported content hashing algorithms"""
+
+
+def _hasher(algorithm):
+  """Returns a new hashing object for the given algorithm"""
+
+  if algorithm == 'sha256':
+    return hashlib.sha256()
+  elif algorithm == 'xxhash':
+    try:
+      import xxhash
+    except ImportError:
+      raise RuntimeError("hashing with `xxhash' requires the python package " \
+          "`xxhash' to be installed - use `sha256' otherwise")
+    return xxhash.xxh64()
+  raise ValueError("unsupported hashing algorithm `%s' - choose one of %s" % \
+      (algorithm, ', '.join(HASHES)))
+
+
+def file_hash(path, algorithm, chunk_size=2**20):
+  """Returns the hexadecimal content hash of a file"""
+
+  hasher = _hasher(algorithm)
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+
+def load_manifest(path):
+  """Loads a manifest written by :py:func:`save_manifest`
+
+  Returns an empty manifest if ``path`` does not exist.
+  """
+
+  if not os.path.exists(path):
+    return {'hash': None, 'files': {}}
+  with open(path, 'rt') as f:
+    return json.load(f)
+
+
+def save_manifest(manifest, path):
+  """Saves a manifest returned by :py:func:`check`, atomically"""
+
+  tmp = path + '.tmp'
+  with open(tmp, 'wt') as f:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+  os.replace(tmp, path) #overwrites existing manifests, also on Windows
+
+
+def _check_one(path, entry, algorithm, hashed):
+  """Checks a single file against its manifest entry
+
+  Returns a tuple ``(status, entry)``, where ``status`` is one of ``ok``,
+  ``missing`` or ``modified`` and ``entry`` the (possibly updated) manifest
+  entry for the file. If ``hashed`` is not set, hashes on ``entry`` (if any)
+  were computed with another algorithm and are ignored.
+  """
+
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return 'missing', entry
+
+  current = dict(size=stat.st_size, mtime=stat.st_mtime_ns)
+  previous_hash = entry.get('hash') if (entry and hashed) else None
+
+  if entry is not None and entry.get('size') == current['size'] and \
+      entry.get('mtime') == current['mtime'] and \
+      (algorithm is None or previous_hash is not None):
+    return 'ok', entry #unchanged since last run, no need to re-hash
+
+  if algorithm is not None:
+    current['hash'] = file_hash(path, algorithm)
+
+  if previous_hash is not None:
+    if previous_hash != current['hash']: return 'modified', entry
+  elif entry is not None and entry.get('size') != current['size']:
+    return 'modified', entry
+
+  return 'ok', current
+
+
+def check(files, directory, extension='.png', annotations=False,
+    algorithm=None, manifest=None, workers=8):
+  """Checks files of the dataset on a thread pool
+
+
+  Parameters:
+
+    files (list): A list of :py:class:`bob.db.verafinger.File` objects to
+      check
+
+    directory (str): The path to the root of the dataset installation
+
+    extension (str, optional): The extension of the image files
+
+    annotations (bool, optional): If set, also check region-of-interest
+      annotations of files of size ``full``
+
+    algorithm (str, optional): If set, one of :py:data:`HASHES`, to also
+      hash the contents of every file
+
+    manifest (dict, optional): A manifest returned by a previous call to this
+      function (or loaded with :py:func:`load_manifest`). Files whose size and
+      modification time did not change are not hashed again. Files which
+      changed are reported as ``modified`` if their hash (or, if not hashing,
+      their size) does not match the manifest.
+
+    workers (int, optional): The number of threads to use
+
+
+  Returns:
+
+    list: A list of tuples ``(path, status)`` for all files which are either
+      ``missing`` or ``modified``
+
+    dict: The updated manifest, with entries for all checked files, keyed by
+      file identifier
+
+  """
+
+  from concurrent.futures import ThreadPoolExecutor
+
+  manifest = manifest or {}
+  entries = manifest.get('files', {})
+  # hashes computed with a different algorithm cannot be compared
+  hashed = manifest.get('hash') == algorithm
+
+  roidir = os.path.join(directory, 'annotations', 'roi')
+
+  items = []
+  for f in files:
+    key = str(f.id)
+    entry = entries.get(key, {})
+    items.append((key, 'image', f.make_path(directory, extension),
+      entry.get('image')))
+    if annotations and f.size == 'full':
+      items.append((key, 'roi', f.make_path(roidir, '.txt'),
+        entry.get('roi')))
+
+  def _run(item):
+    return _check_one(item[2], item[3], algorithm, hashed)
+
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+    results = list(pool.map(_run, items))
+
+  bad = []
+  # if not hashing, keeps track of the algorithm of hashes we carry over
+  retval = {'hash': algorithm or manifest.get('hash'), 'files': {}}
+  for (key, kind, path, _), (status, entry) in zip(items, results):
+    if status != 'ok': bad.append((path, status))
+    if entry is not None:
+      retval['files'].setdefault(key, {})[kind] = entry
+
+  return bad, retval
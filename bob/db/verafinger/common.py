@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Functionality shared by the verification and PAD database interfaces"""
+
+
+from .driver import _files, SNAPSHOT_FILE
+from .records import SIZE_SHAPES
+
+import os
+import numpy
+
+# required by both backends, as the database classes derive from it
+import bob.db.base
+
+
+class BaseDatabase(bob.db.base.SQLiteDatabase):
+  """Base class of :py:class:`bob.db.verafinger.Database` and
+  :py:class:`bob.db.verafinger.PADDatabase`
+
+  It sets up the query backend (a private session, a shared read-only engine
+  or the metadata snapshot), the in-memory index and memoised metadata. See
+  :py:class:`bob.db.verafinger.Database` for a description of the
+  parameters.
+  """
+
+
+  def __init__(self, original_directory=None, original_extension=None,
+      index=False, read_only=False, backend='sql', sqlite_file=None):
+    if backend not in ('sql', 'snapshot'):
+      raise ValueError("Invalid backend '%s'. Valid values are ('sql', " \
+          "'snapshot')" % backend)
+    self.backend = backend
+    self.read_only = read_only
+    sqlite_file = sqlite_file or _files()[0]
+    self.snapshot_file = os.path.join(os.path.dirname(sqlite_file),
+        SNAPSHOT_FILE)
+    if read_only or backend == 'snapshot':
+      # skips the base class constructor, which opens a private session
+      bob.db.base.Database.__init__(self, original_directory,
+          original_extension)
+      self.m_sqlite_file = sqlite_file
+      self.m_session = None
+      self._pid = None
+      if backend == 'snapshot':
+        from .records import FileRow
+        self.m_file_class = FileRow
+      else:
+        from .models import File
+        self.m_file_class = File
+        if os.path.exists(self.m_sqlite_file): self._connect()
+    else:
+      from .models import File
+      super(BaseDatabase, self).__init__(sqlite_file, File,
+          original_directory, original_extension)
+    # the snapshot backend always answers queries from the index
+    self.use_index = index or backend == 'snapshot'
+    self._index = None
+    from .cache import Memo
+    self._memo = Memo()
+
+
+  def __del__(self):
+    """Closes the session of this database
+
+    In read-only mode, the engine is shared with other database objects (see
+    :py:mod:`bob.db.verafinger.connection`), so it must not be disposed of, as
+    the base class does: only the connection of this object is released.
+    """
+
+    if getattr(self, 'read_only', False) or \
+        getattr(self, 'backend', 'sql') == 'snapshot':
+      session = getattr(self, 'm_session', None)
+      if session is not None:
+        try:
+          session.close()
+        except Exception:
+          pass #e.g. while the interpreter exits
+      return
+
+    parent = getattr(super(BaseDatabase, self), '__del__', None)
+    if parent is not None: parent()
+
+
+  def _connect(self):
+    """Binds a new session to the shared, read-only engine"""
+
+    from .connection import session
+    self.m_session = session(self.m_sqlite_file)
+    self._pid = os.getpid()
+
+
+  def query(self, *args):
+    """Creates a query for the given objects
+
+    In read-only mode, re-connects first if we have been forked since the last
+    query.
+    """
+
+    if self.read_only and self.m_session is not None and \
+        self._pid != os.getpid():
+      self._connect()
+    return super(BaseDatabase, self).query(*args)
+
+
+  @property
+  def index(self):
+    """The in-memory :py:class:`bob.db.verafinger.index.Index` for this
+    database, loaded on first access"""
+
+    if self._index is None:
+      from .index import Index
+      if self.backend == 'snapshot':
+        self._index = Index.load(self.snapshot_file)
+      else:
+        self._index = Index(self)
+    return self._index
+
+
+  def is_valid(self):
+    """Returns if the database (or its snapshot) is available"""
+
+    if self.backend == 'snapshot':
+      return os.path.exists(self.snapshot_file)
+    return super(BaseDatabase, self).is_valid()
+
+
+  def clear_cache(self):
+    """Drops memoised metadata and the in-memory index of this database
+
+    Protocol names (and, for verification databases, model identifiers and
+    model to finger associations) are memoised on first use. Call this method
+    if the underlying SQLite file changes while this object is alive.
+    """
+
+    self._memo.clear()
+    self._index = None
+
+
+  def cache_stats(self):
+    """Returns a dictionary with hit and miss counters of memoised metadata
+    lookups"""
+
+    return self._memo.stats()
+
+
+  def _iter_rows(self, query, batch_size):
+    """Streams :py:class:`bob.db.verafinger.records.FileRow` objects for a
+    query of files"""
+
+    from .records import FileRow, file_path
+    from .models import File, Finger, Client
+
+    # a single query for all fingers avoids joins on every streamed row
+    fingers = dict([(k[0], k[1:]) for k in self.query(Finger.id,
+      Client.id, Client.gender, Finger.side).join(Client)])
+
+    query = query.with_entities(File.id, File.model_id, File.finger_id,
+        File.size, File.source, File.session).order_by(None).order_by(File.id)
+
+    for id_, model_id, finger_id, size, source, session in \
+        query.yield_per(batch_size):
+      client_id, gender, side = fingers[finger_id]
+      yield FileRow(id_, file_path(size, source, client_id, gender, side,
+        session), model_id, client_id, side, session, size, source)
+
+
+  def iter_images(self, *args, directory=None, extension='.png', roi=False,
+      prefetch=16, workers=4, **kwargs):
+    """Iterates over images of files filtered by criteria, loading them ahead
+
+    Images (and, optionally, region-of-interest annotations) are loaded on a
+    pool of threads, into a bounded read-ahead queue, while the caller
+    processes previous ones, so that reading and decoding files overlaps with
+    computations on the caller side. See
+    :py:func:`bob.db.verafinger.loader.prefetch` for details. Parameters are
+    validated when this method is called, before iteration starts.
+
+
+    Parameters:
+
+      args, kwargs: Filtering criteria (e.g. ``protocol`` or ``groups``),
+        passed to :py:meth:`objects`
+
+      directory (str, optional): The path to the root of the dataset
+        installation. If not set, use the ``original_directory`` this
+        database was constructed with.
+
+      extension (str, optional): The extension to use for loading the files
+
+      roi (bool, optional): If set, also load region-of-interest annotations,
+        from ``directory``
+
+      prefetch (int, optional): The maximum number of files loaded ahead
+
+      workers (int, optional): The number of threads to use for loading
+
+
+    Returns:
+
+      generator: A generator of tuples ``(file, image, roi)``, in the same
+      order as returned by :py:meth:`objects`, where ``file`` is a
+      :py:class:`bob.db.verafinger.records.FileRow`, ``image`` a
+      :py:class:`numpy.ndarray` and ``roi`` the annotations of the file (or
+      ``None``, if ``roi`` is not set)
+
+    """
+
+    from .loader import prefetch as _prefetch
+
+    files = self.objects(*args, detached=True, **kwargs)
+    directory = directory or self.original_directory
+    return _prefetch(files, directory, extension, directory if roi else None,
+        prefetch, workers)
+
+
+  async def aobjects(self, *args, **kwargs):
+    """Coroutine version of :py:meth:`objects`
+
+    The query runs on the shared pool of threads of
+    :py:mod:`bob.db.verafinger.aio`, without blocking the event loop. Queries
+    on the same database object are serialised.
+    """
+
+    from .aio import query
+    return await query(self, self.objects, *args, **kwargs)
+
+
+  async def aiter_images(self, *args, directory=None, extension='.png',
+      roi=False, prefetch=16, **kwargs):
+    """Asynchronously iterates over images of files filtered by criteria
+
+    This is the asynchronous counterpart of :py:meth:`iter_images`, for use
+    with ``async for``. Files are queried and images loaded on the shared pool
+    of threads of :py:mod:`bob.db.verafinger.aio` (see
+    :py:func:`bob.db.verafinger.aio.stream`). Parameters have the same meaning
+    as for :py:meth:`iter_images` and are validated when iteration starts.
+    """
+
+    from .aio import stream
+
+    files = await self.aobjects(*args, detached=True, **kwargs)
+    directory = directory or self.original_directory
+    async for k in stream(files, directory, extension,
+        directory if roi else None, prefetch):
+      yield k
+
+
+  def load_many(self, files, directory=None, extension='.png', workers=4,
+      processes=False):
+    """Loads images for a list of files in parallel into a single stack
+
+    See :py:func:`bob.db.verafinger.loader.load_many` for details.
+
+
+    Parameters:
+
+      files (list): A list of :py:class:`bob.db.verafinger.File` objects,
+        typically returned by :py:meth:`objects`
+
+      directory (str, optional): The path to the root of the dataset
+        installation. If not set, use the ``original_directory`` this
+        database was constructed with.
+
+      extension (str, optional): The extension to use for loading the files
+
+      workers (int, optional): The number of threads (or processes) to use for
+        decoding
+
+      processes (bool, optional): If set, decode images on a pool of
+        processes, into shared memory (see
+        :py:func:`bob.db.verafinger.loader.load_shared`)
+
+
+    Returns:
+
+      numpy.ndarray: A 3D array with shape ``(N, H, W)`` and the data type
+        of the first decoded image, containing the decoded images, in the
+        same order as ``files``
+
+      dict: A dictionary mapping positions on ``files`` to the exception
+        raised while loading them
+
+    """
+
+    from .loader import load_many
+    return load_many(files, directory or self.original_directory, extension,
+        workers, processes=processes)
+
+
+  def open_packed(self, directory, sizes=None):
+    """Opens packed image stores created with ``bob_dbmanage.py verafinger
+    pack``
+
+    Once opened, :py:meth:`bob.db.verafinger.File.load` returns images as
+    read-only, memory-mapped views from the packed stores, instead of decoding
+    PNG files, when called with the dataset directory the stores were packed
+    from. Stores are shared process-wide. See
+    :py:func:`bob.db.verafinger.packed.open_stores` for details.
+
+
+    Parameters:
+
+      directory (str): The directory containing the packed stores
+
+      sizes (:py:class:`str`, :py:class:`list`, optional): One or more of the
+        supported sizes. If not set, open all stores available in
+        ``directory``.
+
+
+    Returns:
+
+      list: A list of :py:class:`bob.db.verafinger.packed.PackedStore`
+      objects that were opened
+
+    """
+
+    from .packed import open_stores
+    if sizes:
+      sizes = self.check_parameters_for_validity(sizes, "sizes", self.sizes())
+    return open_stores(directory, sizes)
+
+
+  def close_packed(self):
+    """Closes all packed image stores opened with :py:meth:`open_packed`"""
+
+    from .packed import close_stores
+    close_stores()
+
+
+  def roi_masks(self, files, directory=None, shape=None, cache=None):
+    """Generates region-of-interest masks for a list of files
+
+    See :py:meth:`bob.db.verafinger.File.roi_mask` for details.
+
+
+    Parameters:
+
+      files (list): A list of :py:class:`bob.db.verafinger.File` objects,
+        typically returned by :py:meth:`objects`
+
+      directory (str, optional): The path to the root of the dataset
+        installation. If not set, use the ``original_directory`` this
+        database was constructed with.
+
+      shape (:py:class:`tuple`, optional): The ``(height, width)`` of the
+        output masks. If not set, use the default image shape for the size of
+        the files, which must then all have the same size.
+
+      cache (:py:class:`str`, optional): If set, the path to a directory where
+        masks are cached as packed bits
+
+
+    Returns:
+
+      numpy.ndarray: A 3D boolean array with shape ``(N, H, W)`` containing
+      the masks for each of the input files, in order
+
+    """
+
+    directory = directory or self.original_directory
+
+    if shape is None:
+      shapes = set([SIZE_SHAPES[k.size] for k in files])
+      if len(shapes) > 1:
+        raise ValueError("cannot stack masks for files of different sizes " \
+            "without an explicit shape - filter your files by size first")
+      shape = shapes.pop() if shapes else (0, 0)
+
+    retval = numpy.zeros((len(files),) + tuple(shape), dtype=bool)
+    for k, f in enumerate(files):
+      retval[k] = f.roi_mask(directory, shape, cache)
+
+    return retval
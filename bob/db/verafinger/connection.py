@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Shared, read-only connections to the SQLite backend
+
+By default, every instance of :py:class:`bob.db.verafinger.Database` and
+:py:class:`bob.db.verafinger.PADDatabase` opens its own connection to the
+SQLite file, testing file locking on the way. When hundreds of processes read
+the same file (e.g. on a shared network file system), this causes contention
+on file locks. In read-only mode (``read_only=True``), both classes instead
+use a single engine per process and per SQLite file, which opens connections
+with ``mode=ro&immutable=1`` URIs: SQLite then neither locks the file nor
+checks it for changes.
+
+Engines are not shared with child processes: after a ``fork()``, the child
+creates its own engine (and therefore new connections) when it first queries
+the database.
+"""
+
+import os
+import threading
+
+
+_LOCK = threading.Lock()
+_ENGINES = {}
+
+
+def _after_fork():
+  """Forgets engines (and the lock) inherited from the parent process"""
+
+  global _LOCK
+  _LOCK = threading.Lock()
+  _ENGINES.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork)
+
+
+def uri(path):
+  """Returns the SQLite URI to open ``path`` read-only, as immutable"""
+
+  from urllib.request import pathname2url
+  return 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(path))
+
+
+def engine(path):
+  """Returns the read-only engine for ``path``, shared within the process
+
+  Connections are not pooled: each session opens its own connection, which is
+  cheap, as it never writes to, nor locks the SQLite file, and closes it when
+  the session is closed. The number of database objects in use is therefore
+  not limited by the size of a pool. The file must not change while it is in
+  use.
+  """
+
+  with _LOCK:
+    retval = _ENGINES.get(path)
+    if retval is None:
+      import sqlite3
+      from sqlalchemy import create_engine
+      from sqlalchemy.pool import NullPool
+      location = uri(path)
+      retval = create_engine('sqlite://', poolclass=NullPool,
+          creator=lambda: sqlite3.connect(location, uri=True,
+            check_same_thread=False))
+      _ENGINES[path] = retval
+    return retval
+
+
+def session(path):
+  """Returns a new session bound to the shared, read-only engine for ``path``
+  """
+
+  from sqlalchemy.orm import sessionmaker
+  return sessionmaker(bind=engine(path))()
@@ -7,9 +7,9 @@
 import os
 import re
 import csv
-import pkg_resources
 
 from .models import *
+from .driver import MANIFEST_FILE, SNAPSHOT_FILE
 
 
 VERAFINGER_PATH = os.environ.get('VERAFINGER_PATH',
@@ -51,19 +51,32 @@ def add_fingers(session, verbose):
 
 
 def add_files(db_session, verbose):
-  """Create file entries at the database"""
+  """Create file entries at the database
 
+  Returns a dictionary mapping tuples ``(size, source, client_id, side,
+  session)`` to the created :py:class:`File` objects, which is used to resolve
+  file references on protocol lists without querying the database (see
+  :py:func:`resolve_file`).
+  """
+
+  retval = {}
   for finger in db_session.query(Finger):
     for size in File.size_choices:
       for source in File.source_choices:
         for session in File.session_choices:
           file_ = File(size, source, finger, session)
           db_session.add(file_)
+          retval[(size, source, finger.client.id, finger.side, session)] = \
+              file_
           if verbose: print("Created %s" % file_)
 
+  db_session.flush() #assigns identifiers to all files
+  return retval
+
 
-def retrieve_file(session, size, source, ref):
-  """Retrieves the given File object from a full path"""
+def resolve_file(files, size, source, ref):
+  """Resolves a file reference using the dictionary returned by
+  :py:func:`add_files`"""
 
   bits = re.split(r'[-_/]', ref)
   # here is the outcome of this split:
@@ -72,19 +85,27 @@ def retrieve_file(session, size, source, ref):
   # [2] client-id
   # [3] side (L or R)
   # [4] session (1 or 2)
-  return session.query(File).join(Finger,Client).filter(
-    File.size==size, #full or cropped
-    File.source==source, #bf or pa
-    File.session==bits[4],
-    Client.id==int(bits[0]),
-    Finger.side==bits[3],
-    ).one()
+  return files[(size, source, int(bits[0]), bits[3], bits[4])]
+
+
+def insert_associations(session, table, column, pairs):
+  """Bulk-inserts ``(subset, file)`` pairs into an association table
+
+  Inserts are issued as a single ``executemany`` within the current
+  transaction, instead of relying on per-row ORM collection updates.
+  """
+
+  session.flush() #assigns identifiers to all subsets
+  if not pairs: return
+  session.execute(table.insert(), [{column: subset.id, 'file_id': file_.id}
+    for subset, file_ in pairs])
 
 
-def add_bio_protocols(session, path, verbose):
+def add_bio_protocols(session, files, path, verbose):
   """Creates biometric/vulnerability analysis protocols entries at the database
   """
 
+  associations = []
   protocol_dir = os.path.join(path, 'protocols', 'bio')
 
   for size in File.size_choices:
@@ -109,8 +130,8 @@ def add_bio_protocols(session, path, verbose):
           # we ignore the client identifier as it can be derived from the file
           # name in the case of this dataset
           filename_ref, _ = row.strip().split()
-          file_ = retrieve_file(session, size, 'bf', filename_ref)
-          subset.files.append(file_)
+          file_ = resolve_file(files, size, 'bf', filename_ref)
+          associations.append((subset, file_))
           if verbose:
             print("Added %s to %s" % (file_, subset))
 
@@ -125,8 +146,8 @@ def add_bio_protocols(session, path, verbose):
           # we ignore the model and client identifier as they can be derived from
           # the file name in the case of this dataset
           filename_ref, _, _ = row.strip().split()
-          file_ = retrieve_file(session, size, 'bf', filename_ref)
-          subset.files.append(file_)
+          file_ = resolve_file(files, size, 'bf', filename_ref)
+          associations.append((subset, file_))
           if verbose:
             print("Added %s to %s" % (file_, subset))
 
@@ -145,20 +166,24 @@ def add_bio_protocols(session, path, verbose):
           # we ignore the client identifier as it can be derived from the file
           # name in the case of this dataset
           filename_ref, _ = row.strip().split()
-          file_ = retrieve_file(session, size, 'bf', filename_ref)
-          bf_subset.files.append(file_)
+          file_ = resolve_file(files, size, 'bf', filename_ref)
+          associations.append((bf_subset, file_))
           if verbose:
             print("Added %s to %s" % (file_, bf_subset))
-          file_ = retrieve_file(session, size, 'pa', filename_ref)
-          pa_subset.files.append(file_)
+          file_ = resolve_file(files, size, 'pa', filename_ref)
+          associations.append((pa_subset, file_))
           if verbose:
             print("Added %s to %s" % (file_, pa_subset))
 
+  insert_associations(session, subset_file_association, 'subset_id',
+      associations)
+
 
-def add_pad_protocols(session, path, verbose):
+def add_pad_protocols(session, files, path, verbose):
   """Creates presentation attack detection protocols entries at the database
   """
 
+  associations = []
   protocol_dir = os.path.join(path, 'protocols', 'pad')
 
   # there are 2 protocols "full" and "cropped"
@@ -182,16 +207,57 @@ def add_pad_protocols(session, path, verbose):
         for row in f:
           size, source, client_name, sample_name = row.strip().split('/')
           filename_ref = '/'.join((client_name, sample_name))
-          file_ = retrieve_file(session, size, source, filename_ref)
+          file_ = resolve_file(files, size, source, filename_ref)
           if source == 'bf':
-            bf_subset.files.append(file_)
+            associations.append((bf_subset, file_))
             if verbose:
               print("Added %s to %s" % (file_, bf_subset))
           else:
-            pa_subset.files.append(file_)
+            associations.append((pa_subset, file_))
             if verbose:
               print("Added %s to %s" % (file_, pa_subset))
 
+  insert_associations(session, padsubset_file_association, 'padsubset_id',
+      associations)
+
+
+def write_manifest(session, path, verbose):
+  """Writes the static protocol manifest used by the command-line interface
+  """
+
+  import json
+
+  manifest = {
+      'bio': {
+        'protocols': sorted([k.name for k in session.query(Protocol)]),
+        'groups': list(Subset.group_choices),
+        'purposes': list(Subset.purpose_choices),
+        },
+      'pad': {
+        'protocols': sorted([k.name for k in session.query(PADProtocol)]),
+        'groups': list(PADSubset.group_choices),
+        'purposes': list(PADSubset.purpose_choices),
+        },
+      }
+
+  with open(path, 'wt') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+
+  if verbose:
+    print("Wrote protocol manifest to %s" % path)
+
+
+def write_snapshot(session, path, verbose):
+  """Writes the columnar metadata snapshot used by the ``snapshot`` backend
+  """
+
+  from .index import Index
+
+  Index(session).save(path)
+
+  if verbose:
+    print("Wrote metadata snapshot to %s" % path)
+
 
 def create_tables(args):
   """Creates all necessary tables (only to be used at the first time)"""
@@ -211,9 +277,14 @@ def create(args):
   dbfile = args.files[0]
 
   if args.recreate:
-    if args.verbose and os.path.exists(dbfile):
-      print('unlinking %s...' % dbfile)
-    if os.path.exists(dbfile): os.unlink(dbfile)
+    # the manifest and snapshot describe the old file: if creation fails,
+    # they should not outlive it
+    for k in (dbfile,
+        os.path.join(os.path.dirname(dbfile), MANIFEST_FILE),
+        os.path.join(os.path.dirname(dbfile), SNAPSHOT_FILE)):
+      if not os.path.exists(k): continue
+      if args.verbose: print('unlinking %s...' % k)
+      os.unlink(k)
 
   if not os.path.exists(os.path.dirname(dbfile)):
     os.makedirs(os.path.dirname(dbfile))
@@ -222,12 +293,22 @@ def create(args):
   create_tables(args)
   echo = args.verbose > 2 if args.verbose else False
   s = session_try_nolock(args.type, args.files[0], echo=echo)
+  # the database is created from scratch, in a single transaction: if
+  # anything goes wrong, it needs to be re-created anyway
+  s.execute('PRAGMA synchronous = OFF')
+  s.execute('PRAGMA journal_mode = MEMORY')
   add_clients(s, args.directory, args.verbose)
   add_fingers(s, args.verbose)
-  add_files(s, args.verbose)
-  add_pad_protocols(s, args.directory, args.verbose)
-  add_bio_protocols(s, args.directory, args.verbose)
+  files = add_files(s, args.verbose)
+  add_pad_protocols(s, files, args.directory, args.verbose)
+  add_bio_protocols(s, files, args.directory, args.verbose)
+  # gathers statistics for the query planner to choose the best indexes
+  s.execute('ANALYZE')
   s.commit()
+  write_manifest(s, os.path.join(os.path.dirname(dbfile), MANIFEST_FILE),
+      args.verbose)
+  write_snapshot(s, os.path.join(os.path.dirname(dbfile), SNAPSHOT_FILE),
+      args.verbose)
   s.close()
 
 
@@ -6,7 +6,6 @@
 
 import os
 import sys
-import pkg_resources
 from bob.db.base.driver import Interface as BaseInterface
 
 
@@ -60,21 +59,19 @@ def checkfiles(args):
   """Checks existence of files based on your criteria"""
 
   from .query import Database
+  from .check import check, load_manifest, save_manifest
   db = Database()
 
   r = db.objects()
 
+  manifest = load_manifest(args.manifest) if args.manifest else None
+
   # go through all files, check if they are available on the filesystem
-  bad = []
-  for f in r:
-    path = f.make_path(args.directory, args.extension)
-    if not os.path.exists(path): bad.append(path)
+  bad, manifest = check(r, args.directory, args.extension, args.annotations,
+      args.hash, manifest, args.workers)
 
-    #check annotations
-    if args.annotations and f.source == 'full':
-      dirname = os.path.join(args.directory, 'annotations', 'roi')
-      path = f.make_path(dirname, '.txt')
-      if not os.path.exists(path): bad.append(path)
+  if args.manifest:
+    save_manifest(manifest, args.manifest)
 
   # report
   output = sys.stdout
@@ -83,12 +80,158 @@ def checkfiles(args):
     output = null()
 
   if bad:
-    for p in bad: output.write('Cannot find file `%s\'\n' % p)
-    output.write('%d files (out of %d) were not found\n' % (len(bad), len(r)))
+    for p, status in bad:
+      if status == 'missing':
+        output.write('Cannot find file `%s\'\n' % p)
+      else:
+        output.write('File `%s\' does not match the manifest\n' % p)
+    output.write('%d files (out of %d) were not found or do not match\n' % \
+        (len(bad), len(r)))
+
+  return 0
+
+
+def pack(args):
+  """Packs decoded images into memory-mapped stores"""
+
+  from .query import Database
+  from .packed import pack as pack_files
+  db = Database()
+
+  sizes = db.check_parameters_for_validity(args.size, "sizes", db.sizes())
+  for size in sizes:
+    n = pack_files(db.objects(sizes=size), args.directory, args.output, size,
+        args.verbose)
+    if args.verbose:
+      print("Packed %d %s images into %s" % (n, size, args.output))
+
+  return 0
+
+
+def roicache(args):
+  """Converts region-of-interest annotations into a binary store"""
+
+  from .query import Database
+  from .roi import write_store
+  db = Database()
+
+  n = write_store(db.objects(sizes='full'), args.directory, args.output,
+      args.verbose)
+  if args.verbose:
+    print("Converted %d annotations" % n)
+
+  return 0
+
+
+def synthesize(args):
+  """Writes a synthetic dataset with the structure of the original one"""
+
+  from .synthetic import CLIENTS, write_dataset
+
+  clients = args.clients or int(round(args.scale * CLIENTS))
+  write_dataset(args.output, clients, args.seed, args.images, args.workers)
+  if args.verbose:
+    print("Wrote a synthetic dataset with %d clients to %s" % (clients,
+      args.output))
+
+  return 0
+
+
+def benchmark(args):
+  """Times cold imports, queries and, optionally, creation of this package's
+  database"""
+
+  from .benchmark import time_imports, time_create, time_queries, report
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  timings = time_imports(args.repeat)
+  if args.create:
+    timings['create'] = time_create(args.create, args.repeat)
+
+  metadata = {}
+  if args.queries or args.synthetic:
+    import shutil
+    import tempfile
+    tmpdir = None
+    sqlite_file = None
+    try:
+      if args.synthetic:
+        from .synthetic import write_dataset, create_database
+        tmpdir = tempfile.mkdtemp()
+        write_dataset(os.path.join(tmpdir, 'dataset'), args.synthetic)
+        sqlite_file = create_database(os.path.join(tmpdir, 'dataset'),
+            os.path.join(tmpdir, 'db', 'db.sql3'))
+        metadata['synthetic_clients'] = args.synthetic
+      for backend in (args.backend or ('sql', 'index', 'snapshot')):
+        timings.update(time_queries(sqlite_file, args.repeat, backend))
+    finally:
+      if tmpdir is not None: shutil.rmtree(tmpdir)
+
+  for name, values in sorted(timings.items()):
+    output.write('%s: %.3f ms (best of %d)\n' % (name, 1000*min(values),
+      len(values)))
+
+  if args.json:
+    import json
+    with open(args.json, 'wt') as f:
+      json.dump(report(timings, repeat=args.repeat, **metadata), f, indent=2,
+          sort_keys=True)
 
   return 0
 
 
+_FILES = None
+
+
+def _files():
+  """Returns the (memoised) list of metadata files of this package"""
+
+  global _FILES
+  if _FILES is None:
+    import importlib.resources
+    basedir = str(importlib.resources.files(__package__))
+    filelist = os.path.join(basedir, 'files.txt')
+    with open(filelist, 'rt') as f:
+      _FILES = tuple([os.path.join(basedir, k.strip()) for k in \
+          f.readlines() if k.strip()])
+  return _FILES
+
+
+MANIFEST_FILE = 'protocols.json'
+"""Name of the protocol manifest file, stored next to the SQLite file"""
+
+
+SNAPSHOT_FILE = 'db.npz'
+"""Name of the columnar metadata snapshot, stored next to the SQLite file"""
+
+
+_MANIFEST = None
+
+
+def _manifest():
+  """Returns the (memoised) protocol manifest of this package
+
+  The manifest is a dictionary with keys ``bio`` and ``pad``, each mapping to
+  a dictionary with lists of valid ``protocols``, ``groups`` and ``purposes``.
+  It is empty if the manifest file is not available.
+  """
+
+  global _MANIFEST
+  if _MANIFEST is None:
+    path = os.path.join(os.path.dirname(_files()[0]), MANIFEST_FILE)
+    if os.path.exists(path):
+      import json
+      with open(path, 'rt') as f:
+        _MANIFEST = json.load(f)
+    else:
+      _MANIFEST = {}
+  return _MANIFEST
+
+
 class Interface(BaseInterface):
 
 
@@ -97,15 +240,12 @@ class Interface(BaseInterface):
 
 
   def version(self):
-    return pkg_resources.require('bob.db.%s' % self.name())[0].version
+    import importlib.metadata
+    return importlib.metadata.version('bob.db.%s' % self.name())
 
 
   def files(self):
-    basedir = pkg_resources.resource_filename(__name__, '')
-    filelist = os.path.join(basedir, 'files.txt')
-    with open(filelist, 'rt') as f:
-      return [os.path.join(basedir, k.strip()) for k in \
-          f.readlines() if k.strip()]
+    return list(_files())
 
 
   def type(self):
@@ -122,30 +262,32 @@ class Interface(BaseInterface):
     from .create import add_command as create_command
     create_command(subparsers)
 
-    # example: get the "dumplist" action from a submodule
-    from .query import Database
-    from .pad import PADDatabase
+    # choices come from the static protocol manifest written by "create", so
+    # we don't have to open the database for building the parsers - if the
+    # manifest is not available, values are only validated when the
+    # subcommand runs
     import argparse
-    db = Database()
-    paddb = PADDatabase()
+    manifest = _manifest()
+    bio = manifest.get('bio', {})
+    pad = manifest.get('pad', {})
 
     from .create import VERAFINGER_PATH
 
     parser = subparsers.add_parser('dumplist', help=dumplist.__doc__)
     parser.add_argument('-d', '--directory', default=VERAFINGER_PATH, help="if given, this path will be prepended to every entry returned [default: %(default)s)]")
     parser.add_argument('-e', '--extension', default='', help="if given, this extension will be appended to every entry returned")
-    parser.add_argument('-p', '--protocol', help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol", choices=db.protocol_names() if db.is_valid() else ())
-    parser.add_argument('-u', '--purpose', help="if given, this value will limit the output files to those designed for the given purposes", choices=db.purposes() if db.is_valid() else ())
+    parser.add_argument('-p', '--protocol', help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol", choices=bio.get('protocols'))
+    parser.add_argument('-u', '--purpose', help="if given, this value will limit the output files to those designed for the given purposes", choices=bio.get('purposes'))
     parser.add_argument('-m', '--models', type=str, help="if given, limits the dump to a particular model")
-    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group", choices=db.groups() if db.is_valid() else ())
+    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group", choices=bio.get('groups'))
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=dumplist) #action
 
     parser = subparsers.add_parser('dumppadlist', help=dumplist.__doc__)
     parser.add_argument('-d', '--directory', default=VERAFINGER_PATH, help="if given, this path will be prepended to every entry returned [default: %(default)s)]")
     parser.add_argument('-e', '--extension', default='', help="if given, this extension will be appended to every entry returned")
-    parser.add_argument('-p', '--protocol', help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol", choices=paddb.protocol_names() if paddb.is_valid() else ())
-    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group", choices=paddb.groups() if paddb.is_valid() else ())
+    parser.add_argument('-p', '--protocol', help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol", choices=pad.get('protocols'))
+    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group", choices=pad.get('groups'))
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=dumppadlist) #action
 
@@ -154,5 +296,45 @@ class Interface(BaseInterface):
     parser.add_argument('-d', '--directory', default=VERAFINGER_PATH, help="if given, this path will be prepended to every entry checked [default: %(default)s]")
     parser.add_argument('-e', '--extension', default='.png', help="if given, this extension will be appended to every entry returned")
     parser.add_argument('-a', '--annotations', dest="annotations", action='store_true', help="if set, also check for the availability of annotations (extension is '.txt')")
+    parser.add_argument('-H', '--hash', choices=('sha256', 'xxhash'), help="if given, also hash the contents of every file using this algorithm")
+    parser.add_argument('-m', '--manifest', help="if given, read file sizes, modification times and hashes from this manifest (if it exists), only re-check files that changed and write the updated manifest back")
+    parser.add_argument('-j', '--workers', type=int, default=8, help="number of threads to use for checking files [default: %(default)s]")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=checkfiles) #action
+
+    # the "pack" action
+    parser = subparsers.add_parser('pack', help=pack.__doc__)
+    parser.add_argument('-d', '--directory', default=VERAFINGER_PATH, help="if given, this path will be used to search for the original images [default: %(default)s]")
+    parser.add_argument('-o', '--output', required=True, help="the directory where to write the packed stores")
+    parser.add_argument('-s', '--size', help="if given, only pack images of this size (otherwise pack all sizes)", choices=('full', 'cropped'))
+    parser.add_argument('-v', '--verbose', action='count', help="print progress information")
+    parser.set_defaults(func=pack) #action
+
+    # the "roicache" action
+    parser = subparsers.add_parser('roicache', help=roicache.__doc__)
+    parser.add_argument('-d', '--directory', default=VERAFINGER_PATH, help="if given, this path will be used to search for the annotations [default: %(default)s]")
+    parser.add_argument('-o', '--output', help="if given, write the binary store to this file instead of `annotations/roi.bin', inside the dataset directory (notice File.roi() only uses stores at the default location)")
+    parser.add_argument('-v', '--verbose', action='count', help="print progress information")
+    parser.set_defaults(func=roicache) #action
+
+    # the "synthesize" action
+    parser = subparsers.add_parser('synthesize', help=synthesize.__doc__)
+    parser.add_argument('-o', '--output', required=True, help="the directory where to write the dataset (use it with `create --directory')")
+    parser.add_argument('-s', '--scale', type=float, default=1., help="number of clients, relative to the original dataset [default: %(default)s]")
+    parser.add_argument('-n', '--clients', type=int, help="if given, the number of clients to write (overrides --scale)")
+    parser.add_argument('-i', '--images', action='store_true', help="if set, also write random images and region-of-interest annotations")
+    parser.add_argument('-S', '--seed', type=int, default=0, help="seed for the random number generator [default: %(default)s]")
+    parser.add_argument('-j', '--workers', type=int, default=8, help="number of threads to use for writing images [default: %(default)s]")
+    parser.add_argument('-v', '--verbose', action='count', help="print progress information")
+    parser.set_defaults(func=synthesize) #action
+
+    # the "benchmark" action
+    parser = subparsers.add_parser('benchmark', help=benchmark.__doc__)
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="number of times to repeat each measurement [default: %(default)s]")
+    parser.add_argument('-c', '--create', metavar='DIRECTORY', help="if given, also time the creation of the database from the dataset at this path")
+    parser.add_argument('-q', '--queries', action='store_true', help="if set, also time queries on the installed database")
+    parser.add_argument('-s', '--synthetic', type=int, metavar='CLIENTS', help="if given, time queries on a synthetic database with this number of clients (110 matches the original dataset), created on a temporary directory, instead of the installed one")
+    parser.add_argument('-b', '--backend', action='append', choices=('sql', 'index', 'snapshot'), help="if given, only time queries on this backend (may be repeated) [default: all]")
+    parser.add_argument('-j', '--json', metavar='FILE', help="if given, also write all results to this file, as JSON")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=benchmark) #action
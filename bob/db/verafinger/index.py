@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""In-memory index of the VERA database file graph
+
+The metadata in this database is tiny and static (a few thousand files, a few
+hundred fingers and clients and a handful of protocols). Instead of issuing a
+number of SQL queries for every call to
+:py:meth:`bob.db.verafinger.Database.objects`, one may load the whole graph
+once into compact NumPy structures and answer queries by intersecting boolean
+masks. Results are guaranteed to be the same as those of the SQL path.
+"""
+
+import collections
+
+import numpy
+
+
+class ComparisonPlan(collections.namedtuple('ComparisonPlan', ['model_ids',
+  'model_fingers', 'enroll_ids', 'enroll_offsets', 'probe_ids',
+  'probe_fingers', 'genuine', 'attack_ids', 'attack_fingers', 'attacks'])):
+  """All comparisons of a biometric recognition protocol, as dense arrays
+
+  Enrollment files for the ``i``-th model are ``enroll_ids[enroll_offsets[i]:
+  enroll_offsets[i+1]]``. Every model is compared to every probe, genuine
+  comparisons are those between a model and a probe of the same finger.
+  Presentation attacks are only compared to the model of the finger they
+  target.
+
+
+  Attributes:
+
+    model_ids (numpy.ndarray): Sorted model identifiers (strings), with
+      shape ``(M,)``
+
+    model_fingers (numpy.ndarray): Finger identifiers of every model, with
+      shape ``(M,)``
+
+    enroll_ids (numpy.ndarray): File identifiers of enrollment files, grouped
+      by model and sorted by identifier within each model
+
+    enroll_offsets (numpy.ndarray): Offsets of every model on
+      ``enroll_ids``, with shape ``(M+1,)``
+
+    probe_ids (numpy.ndarray): Sorted file identifiers of bona fide probes,
+      with shape ``(P,)``
+
+    probe_fingers (numpy.ndarray): Finger identifiers of every probe, with
+      shape ``(P,)``
+
+    genuine (numpy.ndarray): Boolean matrix with shape ``(M, P)``, set for
+      genuine comparisons and unset for zero-effort impostors
+
+    attack_ids (numpy.ndarray): File identifiers of presentation attacks,
+      with shape ``(A,)``, grouped by finger and sorted by identifier within
+      each finger. Empty if attacks were not requested.
+
+    attack_fingers (numpy.ndarray): Finger identifiers of every attack, with
+      shape ``(A,)``
+
+    attacks (numpy.ndarray): Boolean matrix with shape ``(M, A)``, set for
+      attacks to be compared with each model
+
+  """
+
+  __slots__ = ()
+
+
+class Index(object):
+  """Compact, column-oriented representation of the file/subset graph
+
+  Each attribute named after a file property (e.g. :py:attr:`model_id`,
+  :py:attr:`size` or :py:attr:`gender`) is a 1D NumPy array, aligned with all
+  others, with one entry per file in the database, sorted by file identifier.
+  Protocol subsets are represented as boolean masks over the same axis.
+
+
+  Parameters:
+
+    db (bob.db.base.SQLiteDatabase): An open database from which to load the
+      whole file graph
+
+
+  Attributes:
+
+    files (list): A list of :py:class:`bob.db.verafinger.File` objects, aligned
+      with all columns of this index, or ``None`` if this index was loaded
+      from a snapshot (see :py:meth:`load`)
+
+    subsets (dict): A dictionary mapping tuples ``(protocol, group, purpose)``
+      to boolean masks indicating which files belong to each biometric
+      recognition subset
+
+    padsubsets (dict): A dictionary mapping tuples ``(protocol, group,
+      purpose)`` to boolean masks indicating which files belong to each
+      presentation attack detection subset
+
+  """
+
+
+  def __init__(self, db):
+
+    from sqlalchemy.orm import joinedload
+    from .models import File, Finger, Protocol, Subset, \
+        PADProtocol, PADSubset, subset_file_association, \
+        padsubset_file_association
+
+    self.files = db.query(File).options(
+        joinedload(File.finger).joinedload(Finger.client)).order_by(
+            File.id).all()
+
+    self.id = numpy.array([k.id for k in self.files], dtype='int64')
+    self.model_id = numpy.array([k.model_id for k in self.files])
+    self.finger_id = numpy.array([k.finger_id for k in self.files],
+        dtype='int64')
+    self.client_id = numpy.array([k.finger.client.id for k in self.files],
+        dtype='int64')
+    self.gender = numpy.array([k.finger.client.gender for k in self.files])
+    self.side = numpy.array([k.finger.side for k in self.files])
+    self.size = numpy.array([k.size for k in self.files])
+    self.source = numpy.array([k.source for k in self.files])
+    self.session = numpy.array([k.session for k in self.files])
+
+    self._load_model_fingers()
+
+    self.protocols = tuple([k.name for k in
+      db.query(Protocol).order_by(Protocol.name)])
+    self.subsets = self._load_subsets(db,
+        db.query(Subset.id, Protocol.name, Subset.group,
+          Subset.purpose).join(Protocol),
+        db.query(subset_file_association.c.subset_id,
+          subset_file_association.c.file_id))
+
+    self.padprotocols = tuple([k.name for k in
+      db.query(PADProtocol).order_by(PADProtocol.name)])
+    self.padsubsets = self._load_subsets(db,
+        db.query(PADSubset.id, PADProtocol.name, PADSubset.group,
+          PADSubset.purpose).join(PADProtocol),
+        db.query(padsubset_file_association.c.padsubset_id,
+          padsubset_file_association.c.file_id))
+
+
+  def _load_model_fingers(self):
+    """Builds the mapping from model identifiers to finger identifiers"""
+
+    # model_id -> finger_id, keeps the first file (by id) for every model
+    self.model_fingers = {}
+    for model_id, finger_id in zip(self.model_id.tolist(),
+        self.finger_id.tolist()):
+      self.model_fingers.setdefault(model_id, finger_id)
+
+
+  def _load_subsets(self, db, subsets, associations):
+    """Builds one boolean mask per subset from the association table"""
+
+    keys = dict([(k[0], tuple(k[1:])) for k in subsets])
+    retval = dict([(k, numpy.zeros(len(self.id), dtype=bool)) for k in
+      keys.values()])
+
+    pairs = numpy.array(list(associations), dtype='int64').reshape(-1, 2)
+    positions = numpy.searchsorted(self.id, pairs[:,1])
+    for subset_id, key in keys.items():
+      retval[key][positions[pairs[:,0] == subset_id]] = True
+
+    return retval
+
+
+  def __len__(self):
+    return len(self.id)
+
+
+  COLUMNS = ('id', 'model_id', 'finger_id', 'client_id', 'gender', 'side',
+      'size', 'source', 'session')
+  """Names of the file columns saved on snapshots"""
+
+
+  def save(self, path):
+    """Saves this index as a compressed NumPy archive (a snapshot)
+
+    The archive only contains arrays of numbers, strings and booleans. It can
+    be loaded back with :py:meth:`load`, without SQLAlchemy.
+    """
+
+    arrays = dict([(k, getattr(self, k)) for k in self.COLUMNS])
+    arrays['protocols'] = numpy.array(self.protocols, dtype=str)
+    arrays['padprotocols'] = numpy.array(self.padprotocols, dtype=str)
+    for name in ('subsets', 'padsubsets'):
+      subsets = getattr(self, name)
+      keys = sorted(subsets)
+      arrays[name + '_keys'] = numpy.array(keys, dtype=str).reshape(-1, 3)
+      arrays[name + '_masks'] = numpy.array([subsets[k] for k in keys],
+          dtype=bool).reshape(-1, len(self.id))
+
+    with open(path, 'wb') as f:
+      numpy.savez_compressed(f, **arrays)
+
+
+  @classmethod
+  def load(cls, path):
+    """Loads an index from a snapshot written by :py:meth:`save`
+
+    Indexes loaded from snapshots do not hold any
+    :py:class:`bob.db.verafinger.File` objects: use :py:meth:`rows` to
+    retrieve files.
+    """
+
+    retval = cls.__new__(cls)
+    retval.files = None
+
+    with numpy.load(path, allow_pickle=False) as data:
+      for k in cls.COLUMNS:
+        setattr(retval, k, data[k])
+      retval.protocols = tuple(data['protocols'].tolist())
+      retval.padprotocols = tuple(data['padprotocols'].tolist())
+      for name in ('subsets', 'padsubsets'):
+        setattr(retval, name, dict([(tuple(k), m) for k, m in
+          zip(data[name + '_keys'].tolist(), data[name + '_masks'])]))
+
+    retval._load_model_fingers()
+    return retval
+
+
+  def _subset_mask(self, subsets, protocols, groups, purposes):
+    """Returns the union of all subset masks matching the given criteria"""
+
+    retval = numpy.zeros(len(self.id), dtype=bool)
+    for (protocol, group, purpose), mask in subsets.items():
+      if protocols and protocol not in protocols: continue
+      if groups and group not in groups: continue
+      if purposes and purpose not in purposes: continue
+      retval |= mask
+    return retval
+
+
+  def model_ids(self, protocols=None, groups=None):
+    """Returns a sorted list of model identifiers for protocols and groups
+
+    Parameters are supposed to be validated by the caller and have the same
+    meaning as for :py:meth:`bob.db.verafinger.Database.model_ids`.
+    """
+
+    mask = self._subset_mask(self.subsets, protocols, groups, ('enroll',))
+    return sorted(set(self.model_id[mask].tolist()))
+
+
+  def select(self, subsets, protocols=None, groups=None, purposes=None,
+      model_ids=None, finger_ids=None, genders=None, sides=None, sizes=None,
+      sources=None, sessions=None):
+    """Returns the positions of files matching all the given criteria
+
+    Parameters are supposed to be validated by the caller and have the same
+    meaning as for :py:meth:`bob.db.verafinger.Database.objects`.
+
+
+    Parameters:
+
+      subsets (dict): One of :py:attr:`subsets` or :py:attr:`padsubsets`
+
+      finger_ids (list, optional): If set, limit output to files of these
+        fingers
+
+
+    Returns:
+
+      numpy.ndarray: A 1D array of integers with the positions of the selected
+      files on this index, sorted by file identifier
+
+    """
+
+    if protocols or groups or purposes:
+      mask = self._subset_mask(subsets, protocols, groups, purposes)
+    else:
+      mask = numpy.ones(len(self.id), dtype=bool)
+
+    for column, values in (
+        (self.gender, genders),
+        (self.side, sides),
+        (self.size, sizes),
+        (self.source, sources),
+        (self.session, sessions),
+        (self.model_id, model_ids),
+        (self.finger_id, finger_ids),
+        ):
+      if values: mask &= numpy.isin(column, list(values))
+
+    return numpy.flatnonzero(mask)
+
+
+  def objects(self, positions):
+    """Returns the :py:class:`bob.db.verafinger.File` objects at positions
+
+    If this index was loaded from a snapshot, returns
+    :py:class:`bob.db.verafinger.records.FileRow` objects instead.
+    """
+
+    if self.files is None:
+      return list(self.rows(positions))
+
+    return [self.files[k] for k in positions]
+
+
+  def finger_name(self, model_id):
+    """Returns the unique name of the finger of a model (e.g. ``001_L``)"""
+
+    position = numpy.flatnonzero(self.finger_id ==
+        self.model_fingers[model_id])[0]
+    return '%03d_%s' % (self.client_id[position], self.side[position])
+
+
+  def rows(self, positions):
+    """Iterates over :py:class:`bob.db.verafinger.records.FileRow` objects
+    for the files at positions"""
+
+    from .records import FileRow, file_path
+
+    columns = [k[positions].tolist() for k in (self.id, self.model_id,
+      self.client_id, self.gender, self.side, self.session, self.size,
+      self.source)]
+
+    for id_, model_id, client_id, gender, side, session, size, source in \
+        zip(*columns):
+      yield FileRow(id_, file_path(size, source, client_id, gender, side,
+        session), model_id, client_id, side, session, size, source)
+
+
+  def comparison_plan(self, protocol, group, include_attacks=True):
+    """Returns the :py:class:`ComparisonPlan` for a protocol and group
+
+    Parameters are supposed to be validated by the caller and have the same
+    meaning as for :py:meth:`bob.db.verafinger.Database.comparison_plan`.
+    """
+
+    def _positions(purpose):
+      return numpy.flatnonzero(self._subset_mask(self.subsets, (protocol,),
+        (group,), (purpose,)))
+
+    # enrollment files, grouped by model
+    enroll = _positions('enroll')
+    enroll = enroll[numpy.lexsort((self.id[enroll], self.model_id[enroll]))]
+    model_ids, offsets = numpy.unique(self.model_id[enroll],
+        return_index=True)
+    offsets = numpy.append(offsets, len(enroll)).astype('int64')
+    model_fingers = numpy.array([self.model_fingers[k] for k in
+      model_ids.tolist()], dtype='int64')
+
+    probes = _positions('probe')
+
+    if include_attacks:
+      attacks = _positions('attack')
+      attacks = attacks[numpy.lexsort((self.id[attacks],
+        self.finger_id[attacks]))]
+    else:
+      attacks = numpy.zeros((0,), dtype='int64')
+
+    return ComparisonPlan(
+        model_ids=model_ids,
+        model_fingers=model_fingers,
+        enroll_ids=self.id[enroll],
+        enroll_offsets=offsets,
+        probe_ids=self.id[probes],
+        probe_fingers=self.finger_id[probes],
+        genuine=model_fingers[:,None] == self.finger_id[probes][None,:],
+        attack_ids=self.id[attacks],
+        attack_fingers=self.finger_id[attacks],
+        attacks=model_fingers[:,None] == self.finger_id[attacks][None,:],
+        )
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Decoding and batched loading of images from the VERA database
+"""
+
+import os
+import threading
+import functools
+import itertools
+import collections
+
+import numpy
+
+
+def _load_bob(path):
+  """Loads data using :py:func:`bob.io.base.load`"""
+
+  import bob.io.base
+  import bob.io.image #registers image codecs
+  return bob.io.base.load(path)
+
+
+def _load_npy(path):
+  """Loads a NumPy array file, memory-mapping it read-only"""
+
+  return numpy.load(path, mmap_mode='r')
+
+
+def _load_npz(path):
+  """Loads a NumPy archive
+
+  Returns the sole array in the archive or, if there is more than one, a
+  dictionary mapping each array name to its contents.
+  """
+
+  with numpy.load(path) as data:
+    if len(data.files) == 1:
+      return data[data.files[0]]
+    return dict([(k, data[k]) for k in data.files])
+
+
+DECODERS = {
+    '.png': _load_bob,
+    '.hdf5': _load_bob,
+    '.h5': _load_bob,
+    '.npy': _load_npy,
+    '.npz': _load_npz,
+    }
+"""Decoders used by :py:meth:`bob.db.verafinger.File.load`, by extension"""
+
+
+def register_decoder(extension, decoder):
+  """Registers a decoder for files with a given extension
+
+  Registered decoders take precedence over the built-in ones, so this can
+  also be used to replace the decoder for an existing extension.
+
+
+  Parameters:
+
+    extension (str): The file extension, including the leading dot (e.g.
+      ``.npy``). Matching is case-insensitive.
+
+    decoder (callable): A function taking the path of a file and returning
+      its decoded contents
+
+  """
+
+  DECODERS[extension.lower()] = decoder
+
+
+def decode(path):
+  """Decodes the file at ``path`` using the decoder for its extension
+
+  Files with extensions that have no registered decoder are loaded with
+  :py:func:`bob.io.base.load`.
+
+
+  Parameters:
+
+    path (str): The path of the file to decode
+
+
+  Returns:
+
+    object: The decoded contents of the file, typically a
+    :py:class:`numpy.ndarray`
+
+  """
+
+  extension = os.path.splitext(path)[1].lower()
+  return DECODERS.get(extension, _load_bob)(path)
+
+
+def load_file(f, directory=None, extension='.png'):
+  """Loads the image for a file entry
+
+  Implements :py:meth:`bob.db.verafinger.File.load`, for any object with
+  attributes ``id``, ``size`` and ``make_path`` (see also
+  :py:class:`bob.db.verafinger.records.FileRow`). Images are looked-up on
+  open packed stores for ``directory`` first, then on the process-wide cache
+  (if enabled) and only decoded from disk if not found.
+  """
+
+  from .cache import CACHE
+  from . import packed
+
+  if extension is None: extension = '.png'
+
+  if extension == '.png' and packed.STORES:
+    image = packed.lookup(f, directory)
+    if image is not None: return image
+
+  if not CACHE.enabled:
+    return decode(f.make_path(directory, extension))
+
+  key = ('load', f.id, directory, extension)
+  retval = CACHE.get(key)
+  if retval is None:
+    retval = decode(f.make_path(directory, extension))
+    if isinstance(retval, numpy.ndarray): retval = CACHE.put(key, retval)
+  return retval
+
+
+def _mismatch(image, shape, dtype, path):
+  """Returns an error if ``image`` cannot be stored on the output stack
+
+  Images must have the shape of the other images on the stack, and a data type
+  which can be safely cast to that of the stack. Returns ``None`` if ``image``
+  can be stored.
+  """
+
+  if image.shape != tuple(shape):
+    return ValueError('image at %s has shape %s, while the output stack has ' \
+        'shape %s' % (path, image.shape, tuple(shape)))
+  if not numpy.can_cast(image.dtype, dtype, 'safe'):
+    return TypeError('image at %s has data type %s, which cannot be safely ' \
+        'cast to the data type of the output stack (%s)' % (path, image.dtype,
+          numpy.dtype(dtype)))
+  return None
+
+
+def load_many(files, directory=None, extension='.png', workers=4,
+    dtype=None, processes=False):
+  """Loads a list of files in parallel into a single, preallocated stack
+
+  Images are decoded using a pool of threads (decoders release the GIL while
+  inflating data) and copied into a 3D array as they become available. The
+  output array is allocated once, from the shape (and, unless ``dtype`` is
+  set, the data type) of the first decoded image. Images which cannot be
+  loaded, which do not have the same shape as the others, or whose data type
+  cannot be safely cast to that of the output array (e.g. ``float64`` images
+  on a ``uint8`` stack), are reported on the returned error dictionary and
+  their slot on the output stack is left zeroed. Data is never truncated and
+  decoding errors never abort the whole batch.
+
+  If ``processes`` is set, images are decoded on a pool of processes instead,
+  which write them directly into a shared memory block holding the output
+  stack (see :py:func:`load_shared`).
+
+
+  Parameters:
+
+    files (list): A list of :py:class:`bob.db.verafinger.File` objects to load
+
+    directory (str, optional): The path to the root of the dataset
+      installation. See :py:meth:`bob.db.verafinger.File.load`.
+
+    extension (str, optional): The extension to use for loading the files in
+      question. See :py:meth:`bob.db.verafinger.File.load`.
+
+    workers (int, optional): The number of threads (or processes) to use for
+      decoding
+
+    dtype (str, optional): The data type of the output stack. If not set, use
+      the data type of the first decoded image.
+
+    processes (bool, optional): If set, decode images on a pool of processes
+
+
+  Returns:
+
+    numpy.ndarray: A 3D array with shape ``(N, H, W)``, where ``N`` is the
+      number of input files, containing the decoded images in the same order
+      as ``files``. If no image can be loaded, the shape is ``(N, 0, 0)``.
+
+    dict: A dictionary mapping positions on the input list of files to the
+      exception raised while loading them. It is empty if all images were
+      loaded successfully.
+
+  """
+
+  from concurrent.futures import ThreadPoolExecutor
+
+  if processes:
+    return load_shared(files, directory, extension, workers, dtype)
+
+  files = list(files)
+  state = {'data': None}
+  errors = {}
+  lock = threading.Lock()
+
+  def _load(position):
+    try:
+      image = files[position].load(directory, extension)
+    except Exception as e:
+      with lock: errors[position] = e
+      return
+
+    with lock:
+      if state['data'] is None:
+        state['data'] = numpy.zeros((len(files),) + image.shape,
+            dtype=dtype or image.dtype)
+      data = state['data']
+
+    error = _mismatch(image, data.shape[1:], data.dtype,
+        files[position].make_path(directory, extension))
+    if error is not None:
+      with lock: errors[position] = error
+      return
+
+    data[position] = image
+
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+    # consumes the iterator to make sure all tasks are done
+    list(pool.map(_load, range(len(files))))
+
+  data = state['data']
+  if data is None:
+    data = numpy.zeros((len(files), 0, 0), dtype=dtype or 'uint8')
+
+  return data, errors
+
+
+def load_with_roi(f, directory=None, extension='.png', roi=None):
+  """Loads the image and, optionally, region-of-interest annotations of a file
+
+  Returns a tuple ``(f, image, roi)``, as yielded by :py:func:`prefetch`.
+  """
+
+  image = f.load(directory, extension)
+  return f, image, (f.roi(roi) if roi is not None else None)
+
+
+def prefetch(files, directory=None, extension='.png', roi=None, depth=16,
+    workers=4):
+  """Iterates over images of a list of files, loading them ahead of time
+
+  Images are loaded on a pool of threads, while the caller processes previous
+  ones. At most ``depth`` files are loaded (or being loaded) ahead of the
+  one last returned: a new file is only scheduled when the caller takes one
+  from the queue, so memory usage is bounded no matter how slow the caller is.
+  Images are returned in the same order as ``files``. If loading a file fails,
+  its exception is raised when the caller reaches it. Pending loads are
+  cancelled if the iterator is closed (e.g. by breaking out of a loop).
+
+
+  Parameters:
+
+    files (list): An iterable over :py:class:`bob.db.verafinger.File` (or
+      :py:class:`bob.db.verafinger.records.FileRow`) objects
+
+    directory (str, optional): The path to the root of the dataset
+      installation. See :py:meth:`bob.db.verafinger.File.load`.
+
+    extension (str, optional): The extension to use for loading the files in
+      question. See :py:meth:`bob.db.verafinger.File.load`.
+
+    roi (str, optional): If set, the path to the root of the dataset
+      installation, from which region-of-interest annotations are also loaded
+      (see :py:meth:`bob.db.verafinger.File.roi`)
+
+    depth (int, optional): The maximum number of files loaded ahead
+
+    workers (int, optional): The number of threads to use for loading
+
+
+  Returns:
+
+    generator: A generator of tuples ``(file, image, roi)``, where ``roi``
+    is ``None`` if not loading annotations
+
+  """
+
+  from concurrent.futures import ThreadPoolExecutor
+
+  _load = functools.partial(load_with_roi, directory=directory,
+      extension=extension, roi=roi)
+
+  files = iter(files)
+  pending = collections.deque()
+  pool = ThreadPoolExecutor(max_workers=max(1, workers))
+  try:
+    for f in itertools.islice(files, max(1, depth)):
+      pending.append(pool.submit(_load, f))
+    while pending:
+      retval = pending.popleft().result()
+      # refills the queue before the caller starts working on this image
+      for f in itertools.islice(files, 1):
+        pending.append(pool.submit(_load, f))
+      yield retval
+  finally:
+    for k in pending: k.cancel()
+    pool.shutdown(wait=True)
+
+
+def _decode_into(name, shape, dtype, decoder, tasks):
+  """Decodes images into the output stack, on a worker process
+
+  The stack, with the given shape and data type, is held on the shared memory
+  block called ``name``. ``tasks`` is a list of tuples ``(position, path)``,
+  decoded with ``decoder``, which is resolved by the calling process, so that
+  workers do not depend on decoders registered there. Returns a dictionary
+  mapping positions to the exception raised while loading the file at
+  ``path``.
+  """
+
+  from multiprocessing import shared_memory
+
+  errors = {}
+  block = shared_memory.SharedMemory(name=name)
+  try:
+    data = numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
+    for position, path in tasks:
+      try:
+        image = decoder(path)
+      except Exception as e:
+        errors[position] = e
+        continue
+      error = _mismatch(image, shape[1:], dtype, path)
+      if error is not None:
+        errors[position] = error
+        continue
+      data[position] = image
+  finally:
+    block.close()
+
+  return errors
+
+
+def load_shared(files, directory=None, extension='.png', workers=None,
+    dtype=None):
+  """Loads a list of files on a pool of processes, into shared memory
+
+  Decoding PNG files is CPU-bound, so threads only partially scale with the
+  number of cores. This function allocates the output stack on a
+  :py:class:`multiprocessing.shared_memory.SharedMemory` block, sized from the
+  shape of the first image and the number of files, and has worker processes
+  decode the remaining images straight into it. Only file paths and error
+  reports are exchanged with the workers: pixel data is never pickled. The
+  returned array is a view on the shared block, which is released once the
+  array (and all views on it) are garbage collected.
+
+  Apart from the first one, images are decoded directly from disk, bypassing
+  the process-wide cache. Workers use the decoder registered for
+  ``extension`` on the calling process (see :py:func:`register_decoder`),
+  whatever the start method of the pool, so decoders must be picklable
+  (i.e., functions defined at module level). Images available on open packed
+  stores for ``directory`` (see :py:mod:`bob.db.verafinger.packed`) are not decoded, but
+  copied by the calling process. Errors are handled like on
+  :py:func:`load_many`.
+
+
+  Parameters:
+
+    files (list): A list of :py:class:`bob.db.verafinger.File` objects to load
+
+    directory (str, optional): The path to the root of the dataset
+      installation. See :py:meth:`bob.db.verafinger.File.load`.
+
+    extension (str, optional): The extension to use for loading the files in
+      question. See :py:meth:`bob.db.verafinger.File.load`.
+
+    workers (int, optional): The number of processes to use for decoding. If
+      not set, use one process per CPU.
+
+    dtype (str, optional): The data type of the output stack. If not set, use
+      the data type of the first decoded image.
+
+
+  Returns:
+
+    numpy.ndarray: A 3D array with shape ``(N, H, W)``, where ``N`` is the
+      number of input files, containing the decoded images in the same order
+      as ``files``. If no image can be loaded, the shape is ``(N, 0, 0)``.
+
+    dict: A dictionary mapping positions on the input list of files to the
+      exception raised while loading them. It is empty if all images were
+      loaded successfully.
+
+  """
+
+  import pickle
+  import weakref
+  from concurrent.futures import ProcessPoolExecutor
+  from multiprocessing import shared_memory
+  from . import packed
+
+  if extension is None: extension = '.png'
+  workers = workers or os.cpu_count() or 1
+
+  use_packed = extension == '.png' and bool(packed.STORES)
+
+  # workers may not share our registry of decoders (e.g. when spawned)
+  decoder = DECODERS.get(extension.lower(), _load_bob)
+  try:
+    pickle.dumps(decoder)
+  except Exception as e:
+    raise ValueError("the decoder for `%s' files (%r) cannot be sent to " \
+        "worker processes (%s) - register a function defined at module " \
+        "level, or load files with threads" % (extension, decoder, e))
+
+  files = list(files)
+  errors = {}
+
+  # the first image which loads determines the shape (and, if not set, the
+  # data type) of the output stack
+  first = None
+  for start, f in enumerate(files):
+    try:
+      image = f.load(directory, extension)
+    except Exception as e:
+      errors[start] = e
+      continue
+    error = _mismatch(image, image.shape, dtype or image.dtype,
+        f.make_path(directory, extension))
+    if error is not None:
+      errors[start] = error
+      continue
+    first = image
+    break
+
+  if first is None:
+    return numpy.zeros((len(files), 0, 0), dtype=dtype or 'uint8'), errors
+
+  dtype = numpy.dtype(dtype or first.dtype)
+  shape = (len(files),) + first.shape
+  block = shared_memory.SharedMemory(create=True,
+      size=max(1, int(numpy.prod(shape)) * dtype.itemsize))
+  try:
+    data = numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
+    data[start] = first
+
+    # images on packed stores are copied here, others decoded on workers
+    tasks = []
+    for k in range(start + 1, len(files)):
+      image = packed.lookup(files[k], directory) if use_packed else None
+      path = files[k].make_path(directory, extension)
+      if image is None:
+        tasks.append((k, path))
+        continue
+      error = _mismatch(image, shape[1:], dtype, path)
+      if error is not None: errors[k] = error
+      else: data[k] = image
+
+    # contiguous chunks of files, a few per worker, to balance the load
+    workers = max(1, min(workers, len(tasks)))
+    chunk = max(1, -(-len(tasks) // (4 * workers)))
+    chunks = [tasks[k:k+chunk] for k in range(0, len(tasks), chunk)]
+
+    if chunks:
+      with ProcessPoolExecutor(max_workers=workers) as pool:
+        for k in pool.map(_decode_into, [block.name] * len(chunks),
+            [shape] * len(chunks), [dtype] * len(chunks),
+            [decoder] * len(chunks), chunks):
+          errors.update(k)
+
+  except Exception:
+    data = None
+    block.close()
+    raise
+
+  finally:
+    # the block stays mapped until closed, so its name is not needed anymore
+    block.unlink()
+
+  # unmaps the block only once the stack (and views on it) are gone
+  weakref.finalize(data, block.close)
+
+  return data, errors
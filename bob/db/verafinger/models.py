@@ -4,16 +4,9 @@
 """Table models and functionality for the VERA database.
 """
 
-import os
-import pkg_resources
-
-import bob.io.base
-import bob.io.image
 import bob.db.base
 
-import numpy
-
-from sqlalchemy import Table, Column, Integer, String, ForeignKey
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, Index
 from sqlalchemy import or_, and_, not_
 from sqlalchemy import UniqueConstraint
 
@@ -21,6 +14,9 @@ from bob.db.base.sqlalchemy_migration import Enum, relationship
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declarative_base
 
+from .records import GENDERS, SIDES, SIZES, SIZE_SHAPES, SOURCES, SESSIONS, \
+    GROUPS, PURPOSES, PAD_GROUPS, PAD_PURPOSES
+
 
 Base = declarative_base()
 
@@ -32,7 +28,7 @@ class Client(Base):
 
   id = Column(Integer, primary_key=True)
 
-  gender_choices = ('M', 'F')
+  gender_choices = GENDERS
   gender = Column(Enum(*gender_choices))
 
   age = Column(Integer)
@@ -69,10 +65,10 @@ class Finger(Base):
   client_id = Column(Integer, ForeignKey('client.id'))
   client = relationship("Client", backref=backref("fingers", order_by=id))
 
-  side_choices = ('L', 'R')
+  side_choices = SIDES
   side = Column(Enum(*side_choices))
 
-  UniqueConstraint('client_id', 'side')
+  __table_args__ = (UniqueConstraint('client_id', 'side'),)
 
 
   def __init__(self, client, side):
@@ -108,24 +104,29 @@ class File(Base, bob.db.base.File):
 
   id = Column(Integer, primary_key=True)
 
-  size_choices = ('full', 'cropped')
+  size_choices = SIZES
   size = Column(Enum(*size_choices))
 
-  source_choices = ('bf', 'pa') #bona fide or presentation attacks
+  # image shapes (height, width) for each size
+  size_shapes = SIZE_SHAPES
+
+  source_choices = SOURCES #bona fide or presentation attacks
   source = Column(Enum(*source_choices))
 
   finger_id = Column(Integer, ForeignKey('finger.id'))
   finger = relationship("Finger", backref=backref("files", order_by=id))
 
-  session_choices = ('1', '2')
+  session_choices = SESSIONS
   session = Column(Enum(*session_choices))
 
-  UniqueConstraint('size', 'source', 'finger_id', 'session')
-
   # this column is not really required as it can be computed from other
   # information already in the database, it is only an optimisation to allow us
   # to quickly filter files by ``model_id``
-  model_id = Column(String(7))
+  model_id = Column(String(7), index=True)
+
+  # the unique constraint doubles as an index for lookups by finger
+  __table_args__ = (UniqueConstraint('finger_id', 'size', 'source',
+    'session'),)
 
 
   def __init__(self, size, source, finger, session):
@@ -159,7 +160,17 @@ class File(Base, bob.db.base.File):
         be reloaded using the same API.
 
       extension (str): The extension to use for loading the file in question.
-        If not passed, the default ``.png`` is used.
+        If not passed, the default ``.png`` is used. The file is decoded using
+        the decoder registered for this extension (see
+        :py:func:`bob.db.verafinger.loader.register_decoder`): ``.npy`` files
+        are memory-mapped, ``.npz`` files are read with :py:func:`numpy.load`
+        and everything else is loaded with :py:func:`bob.io.base.load`. If
+        packed stores for ``directory`` are open (see
+        :py:meth:`bob.db.verafinger.Database.open_packed`), ``.png`` images are
+        returned from them as read-only memory-mapped views instead.
+        Otherwise, if the process-wide cache is enabled (see
+        :py:mod:`bob.db.verafinger.cache`), decoded arrays are shared between
+        callers and read-only.
 
 
     Returns:
@@ -169,15 +180,28 @@ class File(Base, bob.db.base.File):
 
     """
 
-    return bob.io.base.load(self.make_path(directory, '.png'))
+    from .loader import load_file
+    return load_file(self, directory, extension)
+
+
+  async def aload(self, directory=None, extension='.png'):
+    """Coroutine version of :py:meth:`load`
+
+    The image is loaded on the shared pool of threads of
+    :py:mod:`bob.db.verafinger.aio`, without blocking the event loop.
+    """
+
+    from .aio import run
+    from .loader import load_file
+    return await run(load_file, self, directory, extension)
 
 
   def roi(self, directory):
     """Loads region-of-interest annotations for a particular image
 
     The returned points (see return value below) correspond to a polygon in the
-    2D space delimiting the finger image. It is up to you to generate a mask
-    out of these annotations.
+    2D space delimiting the finger image. Use :py:meth:`roi_mask` to generate
+    a mask out of these annotations.
 
 
     Parameters:
@@ -193,14 +217,60 @@ class File(Base, bob.db.base.File):
         annotations for the given fingervein image. Points are loaded in (y,x)
         format so, the first column of the returned array correspond to the
         y-values while the second column to the x-values of each coordinate.
+        If a binary RoI store is available in the dataset (see
+        :py:func:`bob.db.verafinger.roi.write_store`), or if the process-wide
+        cache is enabled (see :py:mod:`bob.db.verafinger.cache`), the returned
+        array is shared and read-only.
+
+    """
+
+    from .roi import load_roi
+    return load_roi(self, directory)
+
+
+  async def aroi(self, directory):
+    """Coroutine version of :py:meth:`roi`
+
+    Annotations are loaded on the shared pool of threads of
+    :py:mod:`bob.db.verafinger.aio`, without blocking the event loop.
+    """
+
+    from .aio import run
+    from .roi import load_roi
+    return await run(load_roi, self, directory)
+
+
+  def roi_mask(self, directory, shape=None, cache=None):
+    """Generates a boolean region-of-interest mask for a particular image
+
+    The polygon returned by :py:meth:`roi` is rasterised with
+    :py:func:`bob.db.verafinger.roi.polygon_mask`. Pixels inside or on the
+    boundary of the polygon are set to ``True``.
+
+
+    Parameters:
+
+      directory (str): The path to the root of the dataset installation. See
+        :py:meth:`roi`.
+
+      shape (:py:class:`tuple`, optional): The ``(height, width)`` of the
+        output mask. If not set, use the default image shape for the size of
+        this file (see :py:attr:`size_shapes`).
+
+      cache (:py:class:`str`, optional): If set, the path to a directory where
+        masks are cached as packed bits. Masks are read from this directory if
+        available with the requested shape, otherwise they are generated and
+        saved there.
+
+
+    Returns:
+
+      numpy.ndarray: A 2D boolean array with the region-of-interest mask
 
     """
 
-    directory = os.path.join(directory, 'annotations', 'roi')
-    if self.size == 'full':
-      return numpy.loadtxt(self.make_path(directory, '.txt'), dtype='uint16')
-    else: #cropped, return the full image as RoI (150x565 pixels in yx)
-      return numpy.array([[149,0], [0,0], [0,564], [149,564]], dtype='uint16')
+    from .roi import roi_mask
+    return roi_mask(self, directory, shape, cache)
 
 
 class Protocol(Base):
@@ -221,9 +291,12 @@ class Protocol(Base):
     return "Protocol('%s')" % self.name
 
 
+# the index on (subset, file) covers joins from subsets to files: selecting
+# files of a subset never requires reading the association table itself
 subset_file_association = Table('subset_file_association', Base.metadata,
   Column('file_id', Integer, ForeignKey('file.id')),
-  Column('subset_id', Integer, ForeignKey('subset.id')))
+  Column('subset_id', Integer, ForeignKey('subset.id')),
+  Index('subset_file_association_subset_id_file_id', 'subset_id', 'file_id'))
 
 
 class Subset(Base):
@@ -236,12 +309,15 @@ class Subset(Base):
   protocol_id = Column(Integer, ForeignKey('protocol.id'))
   protocol = relationship("Protocol", backref=backref("subsets"))
 
-  group_choices = ('train', 'dev')
+  group_choices = GROUPS
   group = Column(Enum(*group_choices))
 
-  purpose_choices = ('train', 'enroll', 'probe', 'attack')
+  purpose_choices = PURPOSES
   purpose = Column(Enum(*purpose_choices))
 
+  __table_args__ = (Index('subset_protocol_id_group_purpose', 'protocol_id',
+    'group', 'purpose'),)
+
   files = relationship("File",
       secondary=subset_file_association,
       backref=backref("subsets"))
@@ -277,7 +353,9 @@ class PADProtocol(Base):
 
 padsubset_file_association = Table('padsubset_file_association', Base.metadata,
   Column('file_id', Integer, ForeignKey('file.id')),
-  Column('padsubset_id', Integer, ForeignKey('padsubset.id')))
+  Column('padsubset_id', Integer, ForeignKey('padsubset.id')),
+  Index('padsubset_file_association_padsubset_id_file_id', 'padsubset_id',
+    'file_id'))
 
 
 class PADSubset(Base):
@@ -290,12 +368,15 @@ class PADSubset(Base):
   protocol_id = Column(Integer, ForeignKey('padprotocol.id'))
   protocol = relationship("PADProtocol", backref=backref("padsubsets"))
 
-  group_choices = ('train', 'dev', 'eval')
+  group_choices = PAD_GROUPS
   group = Column(Enum(*group_choices))
 
-  purpose_choices = ('real', 'attack')
+  purpose_choices = PAD_PURPOSES
   purpose = Column(Enum(*purpose_choices))
 
+  __table_args__ = (Index('padsubset_protocol_id_group_purpose', 'protocol_id',
+    'group', 'purpose'),)
+
   files = relationship("File",
       secondary=padsubset_file_association,
       backref=backref("padsubsets"))
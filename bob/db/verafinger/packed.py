@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Memory-mapped packed image store for the VERA database
+
+Instead of decoding thousands of small PNG files on every pass over the
+dataset, all decoded images for a given size (``full`` or ``cropped``) may be
+packed once into a single raw file, accompanied by an offset table keyed by
+:py:attr:`bob.db.verafinger.File.id`. Once a store is opened, images are
+returned by :py:meth:`bob.db.verafinger.File.load` as read-only, zero-copy
+views of a memory-mapped file, so that repeated passes cost page-cache reads
+instead of PNG decoding. Stores only serve images loaded from the dataset
+directory they were packed from.
+
+Packed stores are composed of 3 files per size, on the same directory:
+
+* ``<size>.bin``: the raw ``uint8`` pixel data of all images, concatenated
+* ``<size>.index.npy``: a structured array with fields ``id``, ``offset``,
+  ``height`` and ``width``, one entry per image
+* ``<size>.json``: the size and the (absolute) path of the dataset directory
+  images were packed from
+"""
+
+import os
+import json
+import collections
+
+import numpy
+
+
+INDEX_DTYPE = numpy.dtype([
+  ('id', 'int64'),
+  ('offset', 'int64'),
+  ('height', 'int32'),
+  ('width', 'int32'),
+  ])
+"""Data type of the offset table in packed stores"""
+
+
+STORES = collections.OrderedDict()
+"""Packed stores currently used by :py:meth:`bob.db.verafinger.File.load`,
+keyed by the tuple ``(directory, size)`` they were opened with"""
+
+
+def _paths(directory, size):
+  """Returns the data, index and metadata paths for a given size in a store"""
+
+  return os.path.join(directory, size + '.bin'), \
+      os.path.join(directory, size + '.index.npy'), \
+      os.path.join(directory, size + '.json')
+
+
+def _normpath(directory):
+  """Normalises dataset directories, so they can be compared"""
+
+  return os.path.realpath(directory)
+
+
+def pack(files, directory, output, size, verbose=0):
+  """Decodes and packs all images for a given size into a single file
+
+  Images must be 2D, with a data type which can be safely cast to ``uint8``
+  (e.g. ``bool`` or ``uint8``): others are rejected, instead of being
+  truncated.
+
+
+  Parameters:
+
+    files (list): A list of :py:class:`bob.db.verafinger.File` objects to
+      pack. Only files matching ``size`` are considered.
+
+    directory (str): The path to the root of the dataset installation
+
+    output (str): The directory where to write the packed store. It is created
+      if it does not exist.
+
+    size (str): One of :py:attr:`bob.db.verafinger.File.size_choices`
+
+    verbose (int, optional): If set, print progress information
+
+
+  Returns:
+
+    int: The number of images packed
+
+  """
+
+  files = sorted([k for k in files if k.size == size], key=lambda k: k.id)
+
+  if not os.path.exists(output): os.makedirs(output)
+  datafile, indexfile, metafile = _paths(output, size)
+
+  index = numpy.zeros((len(files),), dtype=INDEX_DTYPE)
+  offset = 0
+  with open(datafile, 'wb') as f:
+    for k, file_ in enumerate(files):
+      image = file_.load(directory)
+      if image.ndim != 2:
+        raise ValueError('cannot pack image at %s with shape %s - only 2D ' \
+            'images are supported' % (file_.make_path(directory, '.png'),
+              image.shape))
+      if not numpy.can_cast(image.dtype, 'uint8', 'safe'):
+        raise TypeError('cannot pack image at %s with data type %s - only ' \
+            'images which can be safely cast to uint8 are supported' % \
+            (file_.make_path(directory, '.png'), image.dtype))
+      image = numpy.ascontiguousarray(image, dtype='uint8')
+      f.write(image.tobytes())
+      index[k] = (file_.id, offset, image.shape[0], image.shape[1])
+      offset += image.size
+      if verbose:
+        print("Packed %s" % file_.make_path(directory, '.png'))
+
+  numpy.save(indexfile, index)
+  with open(metafile, 'wt') as f:
+    json.dump(dict(size=size, directory=_normpath(directory)), f)
+
+  return len(files)
+
+
+class PackedStore(object):
+  """A read-only, memory-mapped packed image store for a given size
+
+
+  Parameters:
+
+    directory (str): The directory containing the packed store
+
+    size (str): One of :py:attr:`bob.db.verafinger.File.size_choices`
+
+  """
+
+
+  def __init__(self, directory, size):
+
+    datafile, indexfile, metafile = _paths(directory, size)
+    self.directory = directory
+    self.size = size
+    self.index = numpy.load(indexfile)
+
+    if not os.path.exists(metafile):
+      raise IOError("packed store at `%s' does not record the dataset it " \
+          "was packed from - re-create it with `bob_dbmanage.py verafinger " \
+          "pack'" % directory)
+    with open(metafile, 'rt') as f:
+      meta = json.load(f)
+    if meta['size'] != size:
+      raise IOError("packed store at `%s' contains `%s' images, not `%s'" % \
+          (directory, meta['size'], size))
+    self.source = meta['directory']
+
+    if os.path.getsize(datafile):
+      self.data = numpy.memmap(datafile, dtype='uint8', mode='r')
+    else: #numpy cannot memory-map empty files
+      self.data = numpy.zeros((0,), dtype='uint8')
+
+    # direct lookup table: file id -> position on index (or -1)
+    length = int(self.index['id'].max()) + 1 if len(self.index) else 0
+    self.positions = numpy.full((length,), -1, dtype='int64')
+    self.positions[self.index['id']] = numpy.arange(len(self.index))
+
+
+  def __len__(self):
+    return len(self.index)
+
+
+  def __contains__(self, file_id):
+    return 0 <= file_id < len(self.positions) and \
+        self.positions[file_id] >= 0
+
+
+  def __getitem__(self, file_id):
+    """Returns a read-only view of the image for the given file id"""
+
+    if file_id not in self:
+      raise KeyError(file_id)
+    _, offset, height, width = self.index[self.positions[file_id]]
+    return self.data[offset:offset+height*width].reshape(height, width)
+
+
+  def lookup(self, f, directory):
+    """Returns the image for a file entry, loaded from ``directory``
+
+    Returns ``None`` if ``f`` is not packed in this store, or if
+    ``directory`` is not the dataset directory images were packed from.
+    """
+
+    if f.size != self.size or f.id not in self or directory is None or \
+        _normpath(directory) != self.source:
+      return None
+    return self[f.id]
+
+
+  def __repr__(self):
+    return "PackedStore('%s', '%s') <%d images>" % (self.directory, self.size,
+        len(self))
+
+
+def open_stores(directory, sizes=None):
+  """Opens packed stores and makes them available to file loading
+
+  After this call, :py:meth:`bob.db.verafinger.File.load` returns images
+  from the opened stores, instead of decoding them, whenever it is called
+  with the default ``.png`` extension and the dataset directory the stores
+  were packed from. Opening a store again replaces the previous one.
+
+
+  Parameters:
+
+    directory (str): The directory containing the packed stores
+
+    sizes (:py:class:`str`, :py:class:`list`, optional): One or more of
+      :py:attr:`bob.db.verafinger.File.size_choices`. If not set, open all
+      stores available in ``directory``.
+
+
+  Returns:
+
+    list: A list of :py:class:`PackedStore` objects that were opened
+
+  """
+
+  if sizes is None:
+    sizes = ('full', 'cropped')
+    sizes = [k for k in sizes if os.path.exists(_paths(directory, k)[1])]
+  elif isinstance(sizes, str):
+    sizes = [sizes]
+
+  retval = [PackedStore(directory, k) for k in sizes]
+  for store in retval:
+    STORES[(_normpath(directory), store.size)] = store
+  return retval
+
+
+def close_stores():
+  """Closes all opened packed stores"""
+
+  STORES.clear()
+
+
+def lookup(f, directory):
+  """Returns the packed image for a file entry loaded from ``directory``, or
+  ``None`` if not packed for that directory"""
+
+  for store in list(STORES.values()):
+    retval = store.lookup(f, directory)
+    if retval is not None: return retval
+  return None
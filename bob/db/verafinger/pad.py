@@ -3,113 +3,124 @@
 
 """Dataset interface allowing the user to query the VERA database"""
 
-from .models import *
-from .driver import Interface
+# the SQL backend (and therefore SQLAlchemy) is only imported when used, so
+# that the snapshot backend does not depend on it - bob.db.base, from which
+# the database classes derive, is always required (see common.py)
+from .driver import _files
+from .common import BaseDatabase
+from .records import GENDERS, SIDES, SIZES, SOURCES, SESSIONS, \
+    PAD_GROUPS, PAD_PURPOSES
 
-import bob.db.base
 
-SQLITE_FILE = Interface().files()[0]
+def __getattr__(name):
+  # resolves the path to the SQLite file on first access only
+  if name == 'SQLITE_FILE':
+    return _files()[0]
+  raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
 
 
-class PADDatabase(bob.db.base.SQLiteDatabase):
+class PADDatabase(BaseDatabase):
   """The dataset class opens and maintains a connection opened to the Database.
 
   It provides many different ways to probe for the characteristics of the data
   and for the data itself inside the database.
-  """
 
 
-  def __init__(self, original_directory=None, original_extension=None):
-    super(PADDatabase, self).__init__(SQLITE_FILE, File, original_directory,
-        original_extension)
+  Parameters:
+
+    original_directory (str, optional): The path to the root of the dataset
+      installation
+
+    original_extension (str, optional): The extension of the original data
+      files
+
+    index (bool, optional): If set, loads the whole file graph once into an
+      in-memory :py:class:`bob.db.verafinger.index.Index` and answers queries
+      from it, without touching the SQL backend on repeated calls. Results are
+      the same as those of the SQL path.
+
+    read_only (bool, optional): If set, does not open a private connection
+      to the SQLite file. Instead, shares one read-only engine per process
+      between all database objects, opening the file as immutable (see
+      :py:mod:`bob.db.verafinger.connection`). Connections are re-opened
+      lazily in child processes after a ``fork()``.
+
+    backend (str, optional): Either ``sql`` (the default), to query the
+      SQLite file, or ``snapshot``, to answer all queries from the columnar
+      metadata snapshot written by ``create`` next to it (see
+      :py:meth:`bob.db.verafinger.index.Index.save`), without SQLAlchemy. With
+      the snapshot backend, files are returned as
+      :py:class:`bob.db.verafinger.records.FileRow` objects.
+
+    sqlite_file (str, optional): The path to an alternative SQLite file to
+      use (e.g. a synthetic database, see
+      :py:mod:`bob.db.verafinger.synthetic`). The snapshot is searched for
+      next to it. If not set, use the one installed with this package.
+
+  """
 
 
   def protocol_names(self):
     """Returns a list of all supported protocols"""
 
+    return self._memo(('protocol_names',), self._protocol_names)
+
+
+  def _protocol_names(self):
+    """Queries the names of all supported protocols"""
+
+    if self.use_index:
+      return self.index.padprotocols
+
+    from .models import PADProtocol
     return tuple([k.name for k in self.query(PADProtocol).order_by(PADProtocol.name)])
 
 
   def purposes(self):
     """Returns a list of all supported purposes"""
 
-    return PADSubset.purpose_choices
+    return PAD_PURPOSES
 
 
   def groups(self):
     """Returns a list of all supported groups"""
 
-    return PADSubset.group_choices
+    return PAD_GROUPS
 
 
   def genders(self):
     """Returns a list of all supported gender values"""
 
-    return Client.gender_choices
+    return GENDERS
 
 
   def sides(self):
     """Returns a list of all supported side values"""
 
-    return Finger.side_choices
+    return SIDES
 
 
   def sizes(self):
     """Returns a list of all supported size values"""
 
-    return File.size_choices
+    return SIZES
 
 
   def sources(self):
     """Returns a list of all supported source values"""
 
-    return File.source_choices
+    return SOURCES
 
 
   def sessions(self):
     """Returns a list of all supported session values"""
 
-    return File.session_choices
-
-
-  def objects(self, protocol=None, groups=None, purposes=None, genders=None,
-      sides=None, sizes=None, sources=None, sessions=None):
-    """Returns objects filtered by criteria
-
-
-    Parameters:
-
-      protocol (:py:class:`str`, :py:class:`list`, optional): One or more of
-        the supported protocols. If not set, returns data from all protocols
-
-      groups (:py:class:`str`, :py:class:`list`, optional): One or more of the
-        supported groups. If not set, returns data from all groups
-
-      purposes (:py:class:`str`, :py:class:`list`, optional): One or more of
-        the supported purposes. If not set, returns data for all purposes
-
-      genders (:py:class:`str`, :py:class:`list`, optional): If set, limit
-        output using the provided gender identifiers
-
-      sides (:py:class:`str`, :py:class:`list`, optional): If set, limit output
-        using the provided side identifier
-
-      sizes (:py:class:`str`, :py:class:`list`, optional): If set, limit output
-        using the provided size identifier
-
-      sources (:py:class:`str`, :py:class:`list`, optional): If set, limit
-        output using the provided source identifier
-
-      sessions (:py:class:`str`, :py:class:`list`, optional): If set, limit
-        output using the provided session identifiers
+    return SESSIONS
 
 
-    Returns:
-
-      list: A list of :py:class:`File` objects corresponding to the filtering
-      criteria.
-
-    """
+  def _check_objects_parameters(self, protocol, groups, purposes, genders,
+      sides, sizes, sources, sessions):
+    """Validates parameters to :py:meth:`objects`, returning them as lists"""
 
     protocols = None
     if protocol:
@@ -149,36 +160,69 @@ class PADDatabase(bob.db.base.SQLiteDatabase):
       sessions = self.check_parameters_for_validity(sessions, "sessions",
           valid_sessions)
 
-    retval = self.query(File)
+    return (protocols, groups, purposes, genders, sides, sizes, sources,
+        sessions)
+
+
+  def _select_positions(self, protocols, groups, purposes, genders, sides,
+      sizes, sources, sessions):
+    """Selects files on the in-memory index, given validated parameters"""
+
+    return self.index.select(self.index.padsubsets, protocols, groups,
+        purposes, genders=genders, sides=sides, sizes=sizes, sources=sources,
+        sessions=sessions)
+
+
+  def _padsubset_files(self, protocols, groups, purposes):
+    """Returns a query for identifiers of files in the matching subsets
+
+    The query joins subsets with their association table. It is meant to be
+    used as a sub-select (semi-join) in the ``WHERE`` clause of other queries,
+    so files on more than one matching subset are not duplicated and the
+    association table is only accessed through its covering index.
+    """
+
+    from .models import PADProtocol, PADSubset, padsubset_file_association
+
+    retval = self.query(padsubset_file_association.c.file_id).join(PADSubset)
 
-    joins = []
     filters = []
 
-    if protocols or groups or purposes:
+    if protocols:
+      retval = retval.join(PADProtocol)
+      filters.append(PADProtocol.name.in_(protocols))
+
+    if groups:
+      filters.append(PADSubset.group.in_(groups))
+    if purposes:
+      filters.append(PADSubset.purpose.in_(purposes))
 
-      subquery = self.query(PADSubset)
-      subfilters = []
+    return retval.filter(*filters)
 
-      if protocols:
-        subquery = subquery.join(PADProtocol)
-        subfilters.append(PADProtocol.name.in_(protocols))
 
-      if groups:
-        subfilters.append(PADSubset.group.in_(groups))
-      if purposes:
-        subfilters.append(PADSubset.purpose.in_(purposes))
+  def _objects_query(self, protocols, groups, purposes, genders, sides, sizes,
+      sources, sessions):
+    """Returns a query for files, given validated parameters
 
-      padsubsets = subquery.filter(*subfilters)
+    All filters are applied in a single SQL statement.
+    """
+
+    from .models import File, Finger, Client
 
-      filters.append(File.padsubsets.any(PADSubset.id.in_([k.id for k in padsubsets])))
+    retval = self.query(File)
+
+    filters = []
+
+    if protocols or groups or purposes:
+      filters.append(File.id.in_(self._padsubset_files(protocols, groups,
+        purposes)))
 
     if genders or sides:
-      joins.append(Finger)
+      retval = retval.join(Finger)
 
       if genders:
-        fingers = self.query(Finger).join(
-            Client).filter(Client.gender.in_(genders))
-        filters.append(Finger.id.in_([k.id for k in fingers]))
+        retval = retval.join(Client)
+        filters.append(Client.gender.in_(genders))
 
       if sides:
         filters.append(Finger.side.in_(sides))
@@ -193,6 +237,127 @@ class PADDatabase(bob.db.base.SQLiteDatabase):
       if sources:
         filters.append(File.source.in_(sources))
 
-    retval = retval.join(*joins).filter(*filters).distinct().order_by('id')
+    return retval.filter(*filters).order_by(File.id)
+
+
+  def objects(self, protocol=None, groups=None, purposes=None, genders=None,
+      sides=None, sizes=None, sources=None, sessions=None, detached=False):
+    """Returns objects filtered by criteria
+
+
+    Parameters:
+
+      protocol (:py:class:`str`, :py:class:`list`, optional): One or more of
+        the supported protocols. If not set, returns data from all protocols
+
+      groups (:py:class:`str`, :py:class:`list`, optional): One or more of the
+        supported groups. If not set, returns data from all groups
+
+      purposes (:py:class:`str`, :py:class:`list`, optional): One or more of
+        the supported purposes. If not set, returns data for all purposes
+
+      genders (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided gender identifiers
+
+      sides (:py:class:`str`, :py:class:`list`, optional): If set, limit output
+        using the provided side identifier
+
+      sizes (:py:class:`str`, :py:class:`list`, optional): If set, limit output
+        using the provided size identifier
+
+      sources (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided source identifier
+
+      sessions (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided session identifiers
+
+      detached (:py:class:`bool`, optional): If set, return
+        :py:class:`bob.db.verafinger.records.FileRow` objects instead, which
+        do not depend on the database session (see :py:meth:`iter_objects`)
+
+
+    Returns:
+
+      list: A list of :py:class:`File` objects corresponding to the filtering
+      criteria.
+
+    """
+
+    args = self._check_objects_parameters(protocol, groups, purposes,
+        genders, sides, sizes, sources, sessions)
+
+    if self.use_index:
+      if detached: return list(self.index.rows(self._select_positions(*args)))
+      return self.index.objects(self._select_positions(*args))
+
+    if detached:
+      return list(self._iter_rows(self._objects_query(*args), 1000))
+
+    from sqlalchemy.orm import joinedload
+    from .models import File, Finger
+
+    # paths require fingers and clients: load them with the files, so that
+    # building paths does not issue one query per file
+    return list(self._objects_query(*args).options(
+      joinedload(File.finger).joinedload(Finger.client)))
+
+
+  def iter_objects(self, protocol=None, groups=None, purposes=None,
+      genders=None, sides=None, sizes=None, sources=None, sessions=None,
+      batch_size=1000):
+    """Iterates over lightweight rows of files filtered by criteria
+
+    Instead of materializing a list of :py:class:`File` objects, this method
+    streams immutable :py:class:`bob.db.verafinger.records.FileRow` objects,
+    which carry all information required to build paths without any further
+    access to the database. Results are fetched from the database in batches.
+    Parameters are validated when this method is called, before iteration
+    starts.
+
+
+    Parameters:
+
+      protocol (:py:class:`str`, :py:class:`list`, optional): One or more of
+        the supported protocols. If not set, returns data from all protocols
+
+      groups (:py:class:`str`, :py:class:`list`, optional): One or more of the
+        supported groups. If not set, returns data from all groups
+
+      purposes (:py:class:`str`, :py:class:`list`, optional): One or more of
+        the supported purposes. If not set, returns data for all purposes
+
+      genders (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided gender identifiers
+
+      sides (:py:class:`str`, :py:class:`list`, optional): If set, limit output
+        using the provided side identifier
+
+      sizes (:py:class:`str`, :py:class:`list`, optional): If set, limit output
+        using the provided size identifier
+
+      sources (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided source identifier
+
+      sessions (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided session identifiers
+
+
+      batch_size (int, optional): The number of rows to fetch from the
+        database at once
+
+
+    Returns:
+
+      generator: A generator of :py:class:`bob.db.verafinger.records.FileRow`
+      objects corresponding to the filtering criteria, in the same order as
+      returned by :py:meth:`objects`.
+
+    """
+
+    args = self._check_objects_parameters(protocol, groups, purposes,
+        genders, sides, sizes, sources, sessions)
+
+    if self.use_index:
+      return self.index.rows(self._select_positions(*args))
 
-    return list(retval)
+    return self._iter_rows(self._objects_query(*args), batch_size)
@@ -4,85 +4,166 @@
 '''Implementation of a simple database interface for querying PAD data'''
 
 
-from .models import *
-from .driver import Interface
-from sqlalchemy import and_, not_
+# the SQL backend (and therefore SQLAlchemy) is only imported when used, so
+# that the snapshot backend does not depend on it - bob.db.base, from which
+# the database classes derive, is always required (see common.py)
+from .driver import _files
+from .common import BaseDatabase
+from .records import GENDERS, SIDES, SIZES, SOURCES, SESSIONS, \
+    GROUPS, PURPOSES
 
-import bob.db.base
 
-SQLITE_FILE = Interface().files()[0]
+def __getattr__(name):
+  # resolves the path to the SQLite file on first access only
+  if name == 'SQLITE_FILE':
+    return _files()[0]
+  raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
 
 
-class Database(bob.db.base.SQLiteDatabase):
+class Database(BaseDatabase):
   """The dataset class opens and maintains a connection opened to the Database.
 
   It provides many different ways to probe for the characteristics of the data
   and for the data itself inside the database.
-  """
 
 
-  def __init__(self, original_directory=None, original_extension=None):
-    super(Database, self).__init__(SQLITE_FILE, File, original_directory,
-        original_extension)
+  Parameters:
+
+    original_directory (str, optional): The path to the root of the dataset
+      installation
+
+    original_extension (str, optional): The extension of the original data
+      files
+
+    index (bool, optional): If set, loads the whole file graph once into an
+      in-memory :py:class:`bob.db.verafinger.index.Index` and answers queries
+      from it, without touching the SQL backend on repeated calls. Results are
+      the same as those of the SQL path.
+
+    read_only (bool, optional): If set, does not open a private connection
+      to the SQLite file. Instead, shares one read-only engine per process
+      between all database objects, opening the file as immutable (see
+      :py:mod:`bob.db.verafinger.connection`). Connections are re-opened
+      lazily in child processes after a ``fork()``.
+
+    backend (str, optional): Either ``sql`` (the default), to query the
+      SQLite file, or ``snapshot``, to answer all queries from the columnar
+      metadata snapshot written by ``create`` next to it (see
+      :py:meth:`bob.db.verafinger.index.Index.save`), without SQLAlchemy. With
+      the snapshot backend, files are returned as
+      :py:class:`bob.db.verafinger.records.FileRow` objects.
+
+    sqlite_file (str, optional): The path to an alternative SQLite file to
+      use (e.g. a synthetic database, see
+      :py:mod:`bob.db.verafinger.synthetic`). The snapshot is searched for
+      next to it. If not set, use the one installed with this package.
+
+  """
 
 
   def protocol_names(self):
     """Returns a list of all supported protocols"""
 
+    return self._memo(('protocol_names',), self._protocol_names)
+
+
+  def _protocol_names(self):
+    """Queries the names of all supported protocols"""
+
+    if self.use_index:
+      return self.index.protocols
+
+    from .models import Protocol
     return tuple([k.name for k in self.query(Protocol).order_by(Protocol.name)])
 
 
   def purposes(self):
     """Returns a list of all supported purposes"""
 
-    return Subset.purpose_choices
+    return PURPOSES
 
 
   def groups(self):
     """Returns a list of all supported groups"""
 
-    return Subset.group_choices
+    return GROUPS
 
 
   def genders(self):
     """Returns a list of all supported gender values"""
 
-    return Client.gender_choices
+    return GENDERS
 
 
   def sides(self):
     """Returns a list of all supported side values"""
 
-    return Finger.side_choices
+    return SIDES
 
 
   def sizes(self):
     """Returns a list of all supported size values"""
 
-    return File.size_choices
+    return SIZES
 
 
   def sources(self):
     """Returns a list of all supported source values"""
 
-    return File.source_choices
+    return SOURCES
 
 
   def sessions(self):
     """Returns a list of all supported session values"""
 
-    return File.session_choices
+    return SESSIONS
+
+
+  def _model_fingers(self):
+    """Returns a dictionary mapping all model identifiers to the identifiers
+    of their fingers, loaded once"""
+
+    return self._memo(('model_fingers',), self._load_model_fingers)
+
+
+  def _load_model_fingers(self):
+    """Queries the finger identifier of every model identifier"""
+
+    if self.use_index:
+      return self.index.model_fingers
+
+    from .models import File
+
+    # keeps the first file (by id) for every model
+    retval = {}
+    for model_id, finger_id in self.query(File.model_id,
+        File.finger_id).order_by(File.id):
+      retval.setdefault(model_id, finger_id)
+    return retval
 
 
   def _finger_from_model_id(self, model_id):
     """Returns the first unique finger in the database given a ``model_id``"""
 
-    return self.query(File).filter(File.model_id == model_id).first().finger
+    return self._memo(('finger', model_id), self._load_finger,
+        self._model_fingers()[model_id])
+
+
+  def _load_finger(self, finger_id):
+    """Queries a finger, together with its client"""
+
+    from sqlalchemy.orm import joinedload
+    from .models import Finger
+    return self.query(Finger).options(joinedload(Finger.client)).get(
+        finger_id)
 
 
   def finger_name_from_model_id(self, model_id):
     """Returns the first unique finger name in the database given a ``model_id``"""
 
+    if self.backend == 'snapshot':
+      return self.index.finger_name(model_id)
+
     return self._finger_from_model_id(model_id).unique_name
 
 
@@ -119,73 +200,66 @@ class Database(bob.db.base.SQLiteDatabase):
       groups = self.check_parameters_for_validity(groups, "group",
                                                   valid_groups)
 
-    retval = self.query(File)
+    key = ('model_ids', tuple(sorted(protocols or ())),
+        tuple(sorted(groups or ())))
+    return list(self._memo(key, self._model_ids, protocols, groups))
 
-    joins = []
-    filters = []
 
-    subquery = self.query(Subset)
-    subfilters = []
+  def _model_ids(self, protocols, groups):
+    """Queries model identifiers, given validated parameters"""
 
-    if protocols:
-      subquery = subquery.join(Protocol)
-      subfilters.append(Protocol.name.in_(protocols))
+    if self.use_index:
+      return tuple(self.index.model_ids(protocols, groups))
 
-    if groups:
-      subfilters.append(Subset.group.in_(groups))
+    from .models import File
+    retval = self.query(File.model_id).filter(File.id.in_(
+      self._subset_files(protocols, groups, ('enroll',))))
 
-    subfilters.append(Subset.purpose == 'enroll')
+    return tuple(sorted([k[0] for k in retval.distinct()]))
 
-    subsets = subquery.filter(*subfilters)
-    filters.append(File.subsets.any(Subset.id.in_([k.id for k in subsets])))
 
-    retval = retval.join(*joins).filter(*filters).distinct().order_by('id')
+  def comparison_plan(self, protocol, group='dev', include_attacks=True):
+    """Returns all comparisons of a protocol as dense index arrays
 
-    return sorted(set([k.model_id for k in retval.distinct()]))
-
-
-  def objects(self, protocol=None, groups=None, purposes=None,
-              model_ids=None, genders=None, sides=None, sizes=None,
-              sources=None, sessions=None):
-    """Returns objects filtered by criteria
+    All protocols in this database do a full probe-model scan: every model is
+    compared to every probe. Instead of querying enrollment files and probes
+    model by model, use this method to retrieve the complete score matrix
+    layout at once and compute scores in vectorised blocks. Results are
+    computed from the in-memory :py:attr:`index`, which is loaded on first
+    use.
 
 
     Parameters:
 
-      protocol (:py:class:`str`, :py:class:`list`, optional): One or more of
-        the supported protocols. If not set, returns data from all protocols
+      protocol (str): One of the supported protocols
 
-      groups (:py:class:`str`, :py:class:`list`, optional): One or more of the
-        supported groups. If not set, returns data from all groups
+      group (:py:class:`str`, optional): One of the supported groups. Only
+        ``dev`` contains models and probes.
 
-      purposes (:py:class:`str`, :py:class:`list`, optional): One or more of
-        the supported purposes. If not set, returns data for all purposes
-
-      model_ids (:py:class:`str`, :py:class:`list`, optional): If set, limit
-        output using the provided model identifiers
-
-      genders (:py:class:`str`, :py:class:`list`, optional): If set, limit
-        output using the provided gender identifiers
+      include_attacks (:py:class:`bool`, optional): If set, also plan the
+        comparison of presentation attacks against the models of the fingers
+        they target
 
-      sides (:py:class:`str`, :py:class:`list`, optional): If set, limit output
-        using the provided side identifier
 
-      sizes (:py:class:`str`, :py:class:`list`, optional): If set, limit output
-        using the provided size identifier
+    Returns:
 
-      sources (:py:class:`str`, :py:class:`list`, optional): If set, limit
-        output using the provided source identifier
+      bob.db.verafinger.index.ComparisonPlan: A named tuple of NumPy arrays
+      describing models, their enrollment files, probes, attacks and which
+      comparisons are genuine. File identifiers correspond to
+      :py:attr:`File.id`.
 
-      sessions (:py:class:`str`, :py:class:`list`, optional): If set, limit
-        output using the provided session identifiers
+    """
 
+    protocol = self.check_parameter_for_validity(protocol, "protocol",
+        self.protocol_names())
+    group = self.check_parameter_for_validity(group, "group", self.groups())
 
-    Returns:
+    return self.index.comparison_plan(protocol, group, include_attacks)
 
-      list: A list of :py:class:`File` objects corresponding to the filtering
-      criteria.
 
-    """
+  def _check_objects_parameters(self, protocol, groups, purposes, model_ids,
+      genders, sides, sizes, sources, sessions):
+    """Validates parameters to :py:meth:`objects`, returning them as lists"""
 
     protocols = None
     if protocol:
@@ -236,36 +310,72 @@ class Database(bob.db.base.SQLiteDatabase):
       sessions = self.check_parameters_for_validity(sessions, "sessions",
           valid_sessions)
 
-    retval = self.query(File)
+    return (protocols, groups, purposes, model_ids, genders, sides, sizes,
+        sources, sessions)
+
+
+  def _select_positions(self, protocols, groups, purposes, model_ids, genders,
+      sides, sizes, sources, sessions):
+    """Selects files on the in-memory index, given validated parameters"""
+
+    finger_ids = None
+    if model_ids and purposes and len(purposes) == 1 and 'attack' in purposes:
+      finger_ids = [self.index.model_fingers[k] for k in model_ids]
+      model_ids = None
+    return self.index.select(self.index.subsets, protocols, groups, purposes,
+        model_ids, finger_ids, genders, sides, sizes, sources, sessions)
+
+
+  def _subset_files(self, protocols, groups, purposes):
+    """Returns a query for identifiers of files in the matching subsets
+
+    The query joins subsets with their association table. It is meant to be
+    used as a sub-select (semi-join) in the ``WHERE`` clause of other queries,
+    so files on more than one matching subset are not duplicated and the
+    association table is only accessed through its covering index.
+    """
+
+    from .models import Protocol, Subset, subset_file_association
+
+    retval = self.query(subset_file_association.c.file_id).join(Subset)
 
-    joins = []
     filters = []
 
-    if protocols or groups or purposes:
+    if protocols:
+      retval = retval.join(Protocol)
+      filters.append(Protocol.name.in_(protocols))
+
+    if groups:
+      filters.append(Subset.group.in_(groups))
+    if purposes:
+      filters.append(Subset.purpose.in_(purposes))
+
+    return retval.filter(*filters)
+
+
+  def _objects_query(self, protocols, groups, purposes, model_ids, genders,
+      sides, sizes, sources, sessions):
+    """Returns a query for files, given validated parameters
 
-      subquery = self.query(Subset)
-      subfilters = []
+    All filters are applied in a single SQL statement.
+    """
 
-      if protocols:
-        subquery = subquery.join(Protocol)
-        subfilters.append(Protocol.name.in_(protocols))
+    from .models import File, Finger, Client
 
-      if groups:
-        subfilters.append(Subset.group.in_(groups))
-      if purposes:
-        subfilters.append(Subset.purpose.in_(purposes))
+    retval = self.query(File)
 
-      subsets = subquery.filter(*subfilters)
+    filters = []
 
-      filters.append(File.subsets.any(Subset.id.in_([k.id for k in subsets])))
+    if protocols or groups or purposes:
+      filters.append(File.id.in_(self._subset_files(protocols, groups,
+        purposes)))
 
     if genders or sides:
-      joins.append(Finger)
+      retval = retval.join(Finger)
 
       if genders:
-        fingers = self.query(Finger).join(
-            Client).filter(Client.gender.in_(genders))
-        filters.append(Finger.id.in_([k.id for k in fingers]))
+        retval = retval.join(Client)
+        filters.append(Client.gender.in_(genders))
 
       if sides:
         filters.append(Finger.side.in_(sides))
@@ -282,10 +392,152 @@ class Database(bob.db.base.SQLiteDatabase):
 
     if model_ids:
       if purposes and len(purposes) == 1 and 'attack' in purposes:
-        filters.append(File.finger_id.in_([self._finger_from_model_id(k).id for k in model_ids]))
+        # attacks are matched to the fingers of the given models
+        fingers = self.query(File.finger_id).filter(
+            File.model_id.in_(model_ids))
+        filters.append(File.finger_id.in_(fingers))
       else:
         filters.append(File.model_id.in_(model_ids))
 
-    retval = retval.join(*joins).filter(*filters).distinct().order_by('id')
+    return retval.filter(*filters).order_by(File.id)
+
+
+  def objects(self, protocol=None, groups=None, purposes=None,
+              model_ids=None, genders=None, sides=None, sizes=None,
+              sources=None, sessions=None, detached=False):
+    """Returns objects filtered by criteria
+
+
+    Parameters:
+
+      protocol (:py:class:`str`, :py:class:`list`, optional): One or more of
+        the supported protocols. If not set, returns data from all protocols
+
+      groups (:py:class:`str`, :py:class:`list`, optional): One or more of the
+        supported groups. If not set, returns data from all groups
+
+      purposes (:py:class:`str`, :py:class:`list`, optional): One or more of
+        the supported purposes. If not set, returns data for all purposes
+
+      model_ids (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided model identifiers
+
+      genders (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided gender identifiers
+
+      sides (:py:class:`str`, :py:class:`list`, optional): If set, limit output
+        using the provided side identifier
+
+      sizes (:py:class:`str`, :py:class:`list`, optional): If set, limit output
+        using the provided size identifier
+
+      sources (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided source identifier
+
+      sessions (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided session identifiers
+
+      detached (:py:class:`bool`, optional): If set, return
+        :py:class:`bob.db.verafinger.records.FileRow` objects instead, which
+        do not depend on the database session (see :py:meth:`iter_objects`)
+
+
+    Returns:
+
+      list: A list of :py:class:`File` objects corresponding to the filtering
+      criteria.
+
+    """
+
+    args = self._check_objects_parameters(protocol, groups, purposes,
+        model_ids, genders, sides, sizes, sources, sessions)
+
+    if self.use_index:
+      if detached: return list(self.index.rows(self._select_positions(*args)))
+      return self.index.objects(self._select_positions(*args))
+
+    if detached:
+      return list(self._iter_rows(self._objects_query(*args), 1000))
+
+    from sqlalchemy.orm import joinedload
+    from .models import File, Finger
+
+    # paths require fingers and clients: load them with the files, so that
+    # building paths does not issue one query per file
+    return list(self._objects_query(*args).options(
+      joinedload(File.finger).joinedload(Finger.client)))
+
+
+  def iter_objects(self, protocol=None, groups=None, purposes=None,
+                   model_ids=None, genders=None, sides=None, sizes=None,
+                   sources=None, sessions=None, batch_size=1000):
+    """Iterates over lightweight rows of files filtered by criteria
+
+    Instead of materializing a list of :py:class:`File` objects, this method
+    streams immutable :py:class:`bob.db.verafinger.records.FileRow` objects,
+    which carry all information required to build paths without any further
+    access to the database. Results are fetched from the database in batches.
+    Parameters are validated when this method is called, before iteration
+    starts.
+
+
+    Parameters:
+
+      protocol (:py:class:`str`, :py:class:`list`, optional): One or more of
+        the supported protocols. If not set, returns data from all protocols
+
+      groups (:py:class:`str`, :py:class:`list`, optional): One or more of the
+        supported groups. If not set, returns data from all groups
+
+      purposes (:py:class:`str`, :py:class:`list`, optional): One or more of
+        the supported purposes. If not set, returns data for all purposes
+
+      model_ids (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided model identifiers
+
+      genders (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided gender identifiers
+
+      sides (:py:class:`str`, :py:class:`list`, optional): If set, limit output
+        using the provided side identifier
+
+      sizes (:py:class:`str`, :py:class:`list`, optional): If set, limit output
+        using the provided size identifier
+
+      sources (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided source identifier
+
+      sessions (:py:class:`str`, :py:class:`list`, optional): If set, limit
+        output using the provided session identifiers
+
+
+      batch_size (int, optional): The number of rows to fetch from the
+        database at once
+
+
+    Returns:
+
+      generator: A generator of :py:class:`bob.db.verafinger.records.FileRow`
+      objects corresponding to the filtering criteria, in the same order as
+      returned by :py:meth:`objects`.
+
+    """
+
+    args = self._check_objects_parameters(protocol, groups, purposes,
+        model_ids, genders, sides, sizes, sources, sessions)
+
+    if self.use_index:
+      return self.index.rows(self._select_positions(*args))
+
+    return self._iter_rows(self._objects_query(*args), batch_size)
+
+
+  async def amodel_ids(self, *args, **kwargs):
+    """Coroutine version of :py:meth:`model_ids`
+
+    The query runs on the shared pool of threads of
+    :py:mod:`bob.db.verafinger.aio`, without blocking the event loop.
+    """
 
-    return list(retval)
+    from .aio import query
+    return await query(self, self.model_ids, *args, **kwargs)
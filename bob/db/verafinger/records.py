@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Lightweight file records and metadata constants, decoupled from the SQL
+backend
+"""
+
+import os
+import collections
+
+
+GENDERS = ('M', 'F')
+"""Valid client genders"""
+
+SIDES = ('L', 'R')
+"""Valid finger sides"""
+
+SIZES = ('full', 'cropped')
+"""Valid image sizes"""
+
+SIZE_SHAPES = {'full': (250, 665), 'cropped': (150, 565)}
+"""Image shapes (height, width) for each size"""
+
+SOURCES = ('bf', 'pa')
+"""Valid image sources (bona fide or presentation attacks)"""
+
+SESSIONS = ('1', '2')
+"""Valid sessions"""
+
+GROUPS = ('train', 'dev')
+"""Valid groups of biometric recognition protocols"""
+
+PURPOSES = ('train', 'enroll', 'probe', 'attack')
+"""Valid purposes of biometric recognition protocols"""
+
+PAD_GROUPS = ('train', 'dev', 'eval')
+"""Valid groups of presentation attack detection protocols"""
+
+PAD_PURPOSES = ('real', 'attack')
+"""Valid purposes of presentation attack detection protocols"""
+
+
+def file_path(size, source, client_id, gender, side, session):
+  """Returns the relative path (without extension) of a file in the dataset
+
+  The format is ``<size>/<source>/<client>-<gender>/<client>_<side>_<session>``
+  (e.g. ``full/bf/001-M/001_L_1``), like :py:attr:`bob.db.verafinger.File.path`.
+  """
+
+  return '%s/%s/%03d-%s/%03d_%s_%s' % (size, source, client_id, gender,
+      client_id, side, session)
+
+
+class FileRow(collections.namedtuple('FileRow', ['id', 'path', 'model_id',
+  'client_id', 'side', 'session', 'size', 'source'])):
+  """A lightweight, immutable row describing a file in the database
+
+  Rows are produced by :py:meth:`bob.db.verafinger.Database.iter_objects` and
+  :py:meth:`bob.db.verafinger.PADDatabase.iter_objects` (or their
+  ``objects()`` methods, with ``detached=True``). They do not hold any
+  reference to the database session and pickle as plain tuples, so they are
+  cheap to keep around or to send to worker processes. Rows provide the
+  attributes and methods of :py:class:`bob.db.verafinger.File` used for
+  loading data.
+  """
+
+  __slots__ = ()
+
+
+  def make_path(self, directory=None, extension=None):
+    """Wraps the current path so that a complete path is formed
+
+    See :py:meth:`bob.db.verafinger.File.make_path`.
+    """
+
+    return os.path.join(directory or '', self.path + (extension or ''))
+
+
+  def load(self, directory=None, extension='.png'):
+    """Loads the image for this file entry
+
+    See :py:meth:`bob.db.verafinger.File.load`.
+    """
+
+    from .loader import load_file
+    return load_file(self, directory, extension)
+
+
+  async def aload(self, directory=None, extension='.png'):
+    """Coroutine version of :py:meth:`load`
+
+    See :py:meth:`bob.db.verafinger.File.aload`.
+    """
+
+    from .aio import run
+    from .loader import load_file
+    return await run(load_file, self, directory, extension)
+
+
+  def roi(self, directory):
+    """Loads region-of-interest annotations for this file entry
+
+    See :py:meth:`bob.db.verafinger.File.roi`.
+    """
+
+    from .roi import load_roi
+    return load_roi(self, directory)
+
+
+  async def aroi(self, directory):
+    """Coroutine version of :py:meth:`roi`
+
+    See :py:meth:`bob.db.verafinger.File.aroi`.
+    """
+
+    from .aio import run
+    from .roi import load_roi
+    return await run(load_roi, self, directory)
+
+
+  def roi_mask(self, directory, shape=None, cache=None):
+    """Generates a boolean region-of-interest mask for this file entry
+
+    See :py:meth:`bob.db.verafinger.File.roi_mask`.
+    """
+
+    from .roi import roi_mask
+    return roi_mask(self, directory, shape, cache)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Region-of-interest utilities for the VERA database
+"""
+
+import os
+import zlib
+
+import numpy
+
+
+def polygon_mask(points, shape):
+  """Rasterises a polygon into a boolean mask
+
+  This function fills the polygon using the even-odd rule on all scan-lines
+  simultaneously. Intersections between every image row and every polygon edge
+  are computed at once, turned into toggles on a difference array and
+  integrated with a cumulative sum along the columns. Polygon edges are then
+  drawn on top, so that the annotated boundary is part of the mask. No Python
+  loops over rows, columns or edges are involved.
+
+
+  Parameters:
+
+    points (numpy.ndarray): A 2D array with shape ``(N, 2)`` containing the
+      polygon vertices in (y,x) format, as returned by
+      :py:meth:`bob.db.verafinger.File.roi`
+
+    shape (tuple): The ``(height, width)`` of the output mask
+
+
+  Returns:
+
+    numpy.ndarray: A 2D boolean array with the given shape, where pixels inside
+    or on the boundary of the polygon are set to ``True``
+
+  """
+
+  height, width = shape
+  mask = numpy.zeros((height, width), dtype=bool)
+
+  points = numpy.asarray(points, dtype='float64').reshape(-1, 2)
+  if not len(points): return mask
+
+  y0, x0 = points[:,0], points[:,1]
+  y1, x1 = numpy.roll(y0, -1), numpy.roll(x0, -1)
+
+  # scan-line fill: edges crossing each row (half-open on y, so vertices
+  # shared by two edges are only counted once)
+  rows = numpy.arange(height, dtype='float64')[:,numpy.newaxis]
+  crosses = ((y0 <= rows) & (y1 > rows)) | ((y1 <= rows) & (y0 > rows))
+  r, e = numpy.nonzero(crosses)
+  x = x0[e] + (r - y0[e]) * (x1[e] - x0[e]) / (y1[e] - y0[e])
+  c = numpy.clip(numpy.ceil(x).astype('int64'), 0, width)
+  toggles = numpy.zeros((height, width + 1), dtype='int32')
+  numpy.add.at(toggles, (r, c), 1)
+  mask[:] = (numpy.cumsum(toggles, axis=1)[:,:width] % 2).astype(bool)
+
+  # boundary: samples every edge at (at least) one point per pixel
+  lengths = (numpy.maximum(abs(y1 - y0), abs(x1 - x0)) + 1).astype('int64')
+  edge = numpy.repeat(numpy.arange(len(lengths)), lengths)
+  step = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - \
+      lengths, lengths)
+  t = step / numpy.maximum(lengths - 1, 1)[edge]
+  y = numpy.rint(y0[edge] + t * (y1 - y0)[edge]).astype('int64')
+  x = numpy.rint(x0[edge] + t * (x1 - x0)[edge]).astype('int64')
+  valid = (y >= 0) & (y < height) & (x >= 0) & (x < width)
+  mask[y[valid], x[valid]] = True
+
+  return mask
+
+
+def save_mask(path, mask):
+  """Saves a boolean mask as packed bits on a NumPy archive"""
+
+  dirname = os.path.dirname(path)
+  if dirname and not os.path.exists(dirname): os.makedirs(dirname)
+  numpy.savez(path, bits=numpy.packbits(mask, axis=None),
+      shape=numpy.array(mask.shape, dtype='int64'))
+
+
+def load_mask(path):
+  """Loads a boolean mask saved with :py:func:`save_mask`"""
+
+  with numpy.load(path) as data:
+    shape = tuple(data['shape'].tolist())
+    return numpy.unpackbits(data['bits'],
+        count=int(numpy.prod(shape))).reshape(shape).astype(bool)
+
+
+STORE_MAGIC = b'VFROI\x00\x02\x00'
+"""Magic bytes at the start of binary region-of-interest stores"""
+
+
+def store_path(directory):
+  """Returns the path of the binary region-of-interest store in a dataset"""
+
+  return os.path.join(directory, 'annotations', 'roi.bin')
+
+
+def path_checksum(path):
+  """Returns the CRC-32 checksum of a file path, as stored on RoI stores"""
+
+  return zlib.crc32(path.encode('utf-8')) & 0xffffffff
+
+
+def write_store(files, directory, output=None, verbose=0):
+  """Converts text region-of-interest annotations into a binary store
+
+  The store is a single binary file containing all polygons of the given
+  files, concatenated as a ragged array of 16-bit unsigned integers, preceded
+  by an offset table indexed by :py:attr:`bob.db.verafinger.File.id`. File
+  identifiers change when the database is re-created, so the store also keeps
+  a checksum of the path of each file: polygons are only returned for files
+  whose path matches (see :py:meth:`ROIStore.lookup`). Its layout is:
+
+  * 8 bytes of magic (:py:data:`STORE_MAGIC`)
+  * the number of offsets ``N``, as a little-endian 64-bit integer
+  * ``N`` offsets, as little-endian 64-bit integers. Points for the file with
+    identifier ``i`` are stored in rows ``offsets[i]`` (inclusive) until
+    ``offsets[i+1]`` (exclusive) of the points array.
+  * ``N-1`` CRC-32 checksums of :py:attr:`bob.db.verafinger.File.path`, as
+    little-endian 32-bit unsigned integers, indexed by file identifier
+  * the points array, with shape ``(offsets[-1], 2)``, as little-endian
+    16-bit unsigned integers in (y,x) format
+
+
+  Parameters:
+
+    files (list): A list of :py:class:`bob.db.verafinger.File` objects.
+      Only files of size ``full`` are considered, as RoIs for ``cropped``
+      files are fixed.
+
+    directory (str): The path to the root of the dataset installation
+
+    output (str, optional): The path of the binary store to write. If not set,
+      use :py:func:`store_path`, on which :py:meth:`bob.db.verafinger.File.roi`
+      looks for it.
+
+    verbose (int, optional): If set, print progress information
+
+
+  Returns:
+
+    int: The number of annotations converted
+
+  """
+
+  files = sorted([k for k in files if k.size == 'full'], key=lambda k: k.id)
+  if output is None: output = store_path(directory)
+
+  roidir = os.path.join(directory, 'annotations', 'roi')
+  length = files[-1].id + 2 if files else 1
+  counts = numpy.zeros((length,), dtype='int64')
+  checksums = numpy.zeros((length - 1,), dtype='<u4')
+  points = []
+  for f in files:
+    p = numpy.loadtxt(f.make_path(roidir, '.txt'), dtype='uint16')
+    p = p.reshape(-1, 2)
+    counts[f.id + 1] = len(p)
+    checksums[f.id] = path_checksum(f.path)
+    points.append(p)
+    if verbose:
+      print("Converted %s" % f.make_path(roidir, '.txt'))
+
+  offsets = numpy.cumsum(counts).astype('<i8')
+  if points:
+    points = numpy.concatenate(points).astype('<u2')
+  else:
+    points = numpy.zeros((0, 2), dtype='<u2')
+
+  dirname = os.path.dirname(output)
+  if dirname and not os.path.exists(dirname): os.makedirs(dirname)
+  with open(output, 'wb') as f:
+    f.write(STORE_MAGIC)
+    f.write(numpy.array([len(offsets)], dtype='<i8').tobytes())
+    f.write(offsets.tobytes())
+    f.write(checksums.tobytes())
+    f.write(points.tobytes())
+
+  return len(files)
+
+
+class ROIStore(object):
+  """A read-only, memory-mapped binary region-of-interest store
+
+  See :py:func:`write_store` for details on the file format.
+
+
+  Parameters:
+
+    path (str): The path of the binary store
+
+  """
+
+
+  def __init__(self, path):
+
+    self.path = path
+    data = numpy.memmap(path, dtype='uint8', mode='r')
+    if bytes(data[:8]) != STORE_MAGIC:
+      raise IOError("file `%s' is not a binary RoI store, or was written " \
+          "by an older version of this package - re-create it with " \
+          "`bob_dbmanage.py verafinger roicache'" % path)
+    length = int(data[8:16].view('<i8')[0])
+    start = 16 + 8 * length
+    end = start + 4 * (length - 1)
+    self.offsets = data[16:start].view('<i8')
+    self.checksums = data[start:end].view('<u4')
+    self.points = data[end:].view('<u2').reshape(-1, 2)
+
+
+  def __len__(self):
+    return int(numpy.count_nonzero(numpy.diff(self.offsets)))
+
+
+  def __contains__(self, file_id):
+    return 0 <= file_id < len(self.offsets) - 1 and \
+        self.offsets[file_id + 1] > self.offsets[file_id]
+
+
+  def __getitem__(self, file_id):
+    """Returns a read-only view of the polygon for the given file id"""
+
+    if file_id not in self:
+      raise KeyError(file_id)
+    return self.points[self.offsets[file_id]:self.offsets[file_id + 1]]
+
+
+  def lookup(self, f):
+    """Returns a read-only view of the polygon for a file entry
+
+    Returns ``None`` if the store has no polygon for the identifier of ``f``,
+    or if it was stored for a file with another path (i.e., the database was
+    re-created after the store was written).
+    """
+
+    if f.id not in self or \
+        self.checksums[f.id] != path_checksum(f.path):
+      return None
+    return self[f.id]
+
+
+_STORES = {}
+
+
+def open_store(directory):
+  """Returns the binary region-of-interest store of a dataset, if any
+
+  Stores are opened once and shared. They are re-opened if modified on disk.
+
+
+  Parameters:
+
+    directory (str): The path to the root of the dataset installation
+
+
+  Returns:
+
+    ROIStore: The binary store, or ``None``, if the dataset does not have one
+
+  """
+
+  path = store_path(directory)
+  try:
+    mtime = os.stat(path).st_mtime
+  except OSError:
+    return None
+
+  store = _STORES.get(path)
+  if store is None or store[0] != mtime:
+    store = _STORES[path] = (mtime, ROIStore(path))
+  return store[1]
+
+
+CROPPED_ROI = numpy.array([[149,0], [0,0], [0,564], [149,564]],
+    dtype='uint16')
+"""Region-of-interest of ``cropped`` images, which covers the whole image"""
+
+
+def _read_roi(f, directory):
+  """Reads region-of-interest annotations for a full image from disk"""
+
+  store = open_store(directory)
+  if store is not None:
+    retval = store.lookup(f)
+    if retval is not None: return retval
+
+  directory = os.path.join(directory, 'annotations', 'roi')
+  return numpy.loadtxt(f.make_path(directory, '.txt'), dtype='uint16')
+
+
+def load_roi(f, directory):
+  """Loads region-of-interest annotations for a file entry
+
+  Implements :py:meth:`bob.db.verafinger.File.roi`, for any object with
+  attributes ``id``, ``size`` and ``make_path`` (see also
+  :py:class:`bob.db.verafinger.records.FileRow`).
+  """
+
+  from .cache import CACHE
+
+  if f.size != 'full':
+    # cropped, return the full image as RoI (150x565 pixels in yx)
+    return CROPPED_ROI.copy()
+
+  if not CACHE.enabled:
+    return _read_roi(f, directory)
+
+  key = ('roi', f.id, directory, '.txt')
+  retval = CACHE.get(key)
+  if retval is None:
+    retval = _read_roi(f, directory)
+    retval = CACHE.put(key, retval)
+  return retval
+
+
+def roi_mask(f, directory, shape=None, cache=None):
+  """Generates a boolean region-of-interest mask for a file entry
+
+  Implements :py:meth:`bob.db.verafinger.File.roi_mask`, for any object
+  supported by :py:func:`load_roi`.
+  """
+
+  from .records import SIZE_SHAPES
+
+  if shape is None: shape = SIZE_SHAPES[f.size]
+  shape = tuple(shape)
+
+  if cache is not None:
+    path = f.make_path(cache, '.npz')
+    if os.path.exists(path):
+      mask = load_mask(path)
+      if mask.shape == shape: return mask
+
+  mask = polygon_mask(load_roi(f, directory), shape)
+
+  if cache is not None: save_mask(path, mask)
+
+  return mask
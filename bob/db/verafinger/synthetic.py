@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Synthetic datasets with the same structure as the VERA database
+
+The functions in this module write client metadata, protocol lists and,
+optionally, random images and region-of-interest annotations laid out like
+those of the original dataset, so that the database can be created,
+loaded and benchmarked without access to the real data. With the default
+number of clients (:py:data:`CLIENTS`), protocols have the same number of files
+as the original ones. For other numbers of clients (e.g. 10 or 100 times as
+many), protocol splits are scaled proportionally.
+"""
+
+import os
+import argparse
+
+import numpy
+
+from .records import SIDES, SESSIONS, SOURCES, SIZES, SIZE_SHAPES, file_path
+
+
+CLIENTS = 110
+"""Number of clients on the original dataset"""
+
+# number of training clients on each bio protocol, out of 110
+BIO_TRAINING = {'Nom': 0, 'Fifty': 60, 'B': 56, 'Full': 0}
+
+# number of clients on each group of the PAD protocols, out of 110
+PAD_GROUPS = (('train', 30), ('dev', 30), ('eval', 50))
+
+
+def _scale(count, clients):
+  """Scales a number of clients, given for 110 clients in total"""
+
+  return int(round(count * clients / float(CLIENTS)))
+
+
+def _reference(client_id, gender, side, session):
+  """Returns the reference of a sample in protocol lists"""
+
+  return '%03d-%s/%03d_%s_%s' % (client_id, gender, client_id, side, session)
+
+
+def _write(path, lines):
+  """Writes lines to a text file, creating directories as needed"""
+
+  if not os.path.exists(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, 'wt') as f:
+    for k in lines: f.write(k + '\n')
+
+
+def roi_polygon(rng, shape=SIZE_SHAPES['full']):
+  """Returns a random region-of-interest polygon for a full finger image
+
+  The polygon follows the finger contour, as in the original annotations: it
+  runs along the top edge of the finger, from the left to the right border of
+  the image, and back along its bottom edge. Edges are randomly perturbed
+  around horizontal lines at about 15% and 85% of the image height.
+
+
+  Parameters:
+
+    rng (numpy.random.RandomState): The random number generator to use
+
+    shape (:py:class:`tuple`, optional): The ``(height, width)`` of the image
+
+
+  Returns:
+
+    numpy.ndarray: A 2D array with shape ``(N, 2)`` and data type ``uint16``
+    containing the polygon vertices in (y,x) format, like
+    :py:meth:`bob.db.verafinger.File.roi`
+
+  """
+
+  height, width = shape
+  points = rng.randint(6, 12)
+  x = numpy.linspace(0, width - 1, points).round()
+  top = height * 0.15 + rng.uniform(-0.1, 0.1, points) * height
+  bottom = height * 0.85 + rng.uniform(-0.1, 0.1, points) * height
+  y = numpy.concatenate((top, bottom[::-1]))
+  x = numpy.concatenate((x, x[::-1]))
+  return numpy.column_stack((y.round(), x)).astype('uint16')
+
+
+def random_image(rng, shape):
+  """Returns a random 8-bit grayscale image
+
+  Images are made of a coarse random pattern (blocks of 8x8 pixels) plus some
+  fine noise, so that they compress about as much as real finger vein images,
+  instead of being incompressible white noise.
+  """
+
+  height, width = shape
+  coarse = rng.randint(32, 224, ((height + 7) // 8, (width + 7) // 8))
+  image = numpy.repeat(numpy.repeat(coarse, 8, axis=0), 8, axis=1)
+  image = image[:height,:width] + rng.randint(-16, 16, shape)
+  return image.astype('uint8')
+
+
+def _write_client(directory, seed, client_id, gender):
+  """Writes images and annotations of all samples of a client
+
+  Each client has its own directories, so clients can be written in parallel.
+  """
+
+  import bob.io.base
+  import bob.io.image #registers image codecs
+
+  # seeded per client, so outputs do not depend on the order of writes
+  rng = numpy.random.RandomState([seed, client_id])
+  for side in SIDES:
+    for session in SESSIONS:
+      for source in SOURCES:
+        for size in SIZES:
+          path = os.path.join(directory, file_path(size, source, client_id,
+            gender, side, session) + '.png')
+          bob.io.base.save(random_image(rng, SIZE_SHAPES[size]), path,
+              create_directories=True)
+        path = os.path.join(directory, 'annotations', 'roi',
+            file_path('full', source, client_id, gender, side, session) + \
+                '.txt')
+        if not os.path.exists(os.path.dirname(path)):
+          os.makedirs(os.path.dirname(path))
+        numpy.savetxt(path, roi_polygon(rng), fmt='%d')
+
+
+def write_dataset(directory, clients=CLIENTS, seed=0, images=False,
+    workers=8):
+  """Writes the metadata and protocol lists of a synthetic dataset
+
+  Clients get random genders and ages. Bio protocols ``Nom``, ``Fifty``,
+  ``B`` and ``Full`` and PAD protocols ``full`` and ``cropped`` are written
+  on the same format as the original ones:
+
+  * ``Nom``: fingers of all clients are enrolled with the first session and
+    probed with the second
+  * ``Fifty``: the first 60 (out of 110) clients are used for training, the
+    others as in ``Nom``
+  * ``B``: the first 56 (out of 110) clients are used for training, all
+    samples of the others are enrolled and probed
+  * ``Full``: all samples are enrolled and probed
+  * PAD protocols: clients are split into training (30 out of 110),
+    development (30) and evaluation (50) groups
+
+  If ``images`` is set, a random image is also written for every file (see
+  :py:func:`random_image`), on directories ``full`` and ``cropped``, together
+  with random region-of-interest annotations for full images (see
+  :py:func:`roi_polygon`), on ``annotations/roi``. Images have the same
+  shapes as the original ones.
+
+
+  Parameters:
+
+    directory (str): The path where to write the dataset
+
+    clients (:py:class:`int`, optional): The number of clients. Use multiples
+      of :py:data:`CLIENTS` to scale the dataset relative to the original one.
+
+    seed (:py:class:`int`, optional): The seed for the random number
+      generator
+
+    images (:py:class:`bool`, optional): If set, also write images and
+      region-of-interest annotations
+
+    workers (:py:class:`int`, optional): The number of threads to use for
+      writing images, one client at a time (image encoders release the GIL
+      while compressing data)
+
+
+  Returns:
+
+    list: A list of tuples ``(client_id, gender, age)`` with all clients
+
+  """
+
+  rng = numpy.random.RandomState(seed)
+  retval = [(k + 1, 'MF'[rng.randint(2)], int(rng.randint(18, 80))) for k in
+      range(clients)]
+
+  _write(os.path.join(directory, 'metadata.csv'), ['id,gender,age'] +
+      ['%03d,%s,%d' % k for k in retval])
+
+  def _samples(subset, sessions=SESSIONS):
+    return [(k[0], k[1], side, session) for k in subset for side in SIDES
+        for session in sessions]
+
+  bio = os.path.join(directory, 'protocols', 'bio')
+  for name, training in BIO_TRAINING.items():
+    training = _scale(training, clients)
+    train, dev = retval[:training], retval[training:]
+    if name in ('Nom', 'Fifty'):
+      models, probes = _samples(dev, SESSIONS[:1]), _samples(dev, SESSIONS[1:])
+    else:
+      models = probes = _samples(dev)
+    _write(os.path.join(bio, name, 'train.txt'), ['%s %03d_%s' % \
+        (_reference(*k), k[0], k[2]) for k in _samples(train)])
+    _write(os.path.join(bio, name, 'models.txt'), ['%s %03d_%s_%s %03d' % \
+        (_reference(*k), k[0], k[2], k[3], k[0]) for k in models])
+    _write(os.path.join(bio, name, 'probes.txt'), ['%s %03d_%s' % \
+        (_reference(*k), k[0], k[2]) for k in probes])
+
+  pad = os.path.join(directory, 'protocols', 'pad')
+  for size in SIZES:
+    start = 0
+    for k, (group, count) in enumerate(PAD_GROUPS):
+      # the last group takes all remaining clients
+      end = clients if k == len(PAD_GROUPS) - 1 else \
+          start + _scale(count, clients)
+      _write(os.path.join(pad, size, group + '.txt'), ['%s/%s/%s' % \
+          (size, source, _reference(*s)) for s in \
+          _samples(retval[start:end]) for source in SOURCES])
+      start = end
+
+  if images:
+    from concurrent.futures import ThreadPoolExecutor
+    def _run(client):
+      _write_client(directory, seed, client[0], client[1])
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+      # consumes the iterator to make sure all tasks are done (and raise)
+      list(pool.map(_run, retval))
+
+  return retval
+
+
+def create_database(directory, output, verbose=0):
+  """Creates the SQLite database (and its snapshot) of a synthetic dataset
+
+
+  Parameters:
+
+    directory (str): The path to a dataset written by
+      :py:func:`write_dataset`
+
+    output (str): The path of the SQLite file to create. Files created by
+      ``create`` are written next to it.
+
+    verbose (:py:class:`int`, optional): The verbosity level
+
+
+  Returns:
+
+    str: The path to the created SQLite file
+
+  """
+
+  from .create import create
+
+  create(argparse.Namespace(files=[output], type='sqlite', recreate=True,
+    verbose=verbose, directory=directory))
+  return output
@@ -32,6 +32,24 @@ def sql3_available(test):
   return wrapper
 
 
+def snapshot_available(test):
+  """Decorator for detecting if the metadata snapshot is available"""
+
+  from bob.io.base.test_utils import datafile
+  from nose.plugins.skip import SkipTest
+  import functools
+
+  @functools.wraps(test)
+  def wrapper(*args, **kwargs):
+    snapshot = datafile("db.npz", __name__, None)
+    if os.path.exists(snapshot):
+      return test(*args, **kwargs)
+    else:
+      raise SkipTest("The metadata snapshot (%s) is not available; did you forget to run 'bob_dbmanage.py %s create' ?" % (snapshot, 'vera'))
+
+  return wrapper
+
+
 def db_available(path):
   """Decorator for detecting if the database files are available"""
 
@@ -52,6 +70,21 @@ def db_available(path):
   return decorator
 
 
+def synthetic_database(directory, images=True):
+  """Writes a small synthetic dataset, with images, and its database
+
+  Returns the paths to the dataset and to the SQLite file, both inside
+  ``directory``.
+  """
+
+  from .synthetic import write_dataset, create_database
+
+  dataset = os.path.join(directory, 'dataset')
+  write_dataset(dataset, clients=2, images=images)
+  return dataset, create_database(dataset, os.path.join(directory, 'db',
+    'db.sql3'))
+
+
 @sql3_available
 def test_counts_bio():
 
@@ -363,3 +396,1170 @@ def test_counts_pad():
 
   _check_proto('full')
   _check_proto('cropped')
+
+
+@sql3_available
+def test_index_matches_sql():
+
+  db = Database()
+  idx = Database(index=True)
+
+  nose.tools.eq_(db.protocol_names(), idx.protocol_names())
+
+  for protocol in db.protocol_names():
+    nose.tools.eq_(db.model_ids(protocol=protocol),
+        idx.model_ids(protocol=protocol))
+    for group in db.groups():
+      for purpose in db.purposes():
+        nose.tools.eq_(
+            [k.id for k in db.objects(protocol, group, purpose)],
+            [k.id for k in idx.objects(protocol, group, purpose)])
+
+    model_ids = db.model_ids(protocol=protocol)[:3]
+    for purpose in db.purposes():
+      nose.tools.eq_(
+          [k.id for k in db.objects(protocol, 'dev', purpose, model_ids)],
+          [k.id for k in idx.objects(protocol, 'dev', purpose, model_ids)])
+
+  nose.tools.eq_([k.id for k in db.objects(genders='F', sides='L')],
+      [k.id for k in idx.objects(genders='F', sides='L')])
+
+  paddb = PADDatabase()
+  padidx = PADDatabase(index=True)
+
+  nose.tools.eq_(paddb.protocol_names(), padidx.protocol_names())
+
+  for protocol in paddb.protocol_names():
+    for group in paddb.groups():
+      for purpose in paddb.purposes():
+        nose.tools.eq_(
+            [k.id for k in paddb.objects(protocol, group, purpose)],
+            [k.id for k in padidx.objects(protocol, group, purpose)])
+
+
+def test_load_many():
+
+  import shutil
+  import tempfile
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    dataset, sqlite_file = synthetic_database(tmpdir)
+    db = Database(sqlite_file=sqlite_file)
+
+    files = db.objects(protocol='Full', groups='dev', purposes='enroll')
+    data, errors = db.load_many(files, dataset, workers=4)
+    nose.tools.eq_(errors, {})
+    nose.tools.eq_(data.dtype, numpy.uint8)
+    nose.tools.eq_(data.shape, (len(files), 250, 665))
+    for k, f in enumerate(files):
+      assert numpy.array_equal(data[k], f.load(dataset))
+
+    # errors are reported per item
+    data, errors = db.load_many(files[:2], '/does/not/exist')
+    nose.tools.eq_(sorted(errors.keys()), [0, 1])
+    nose.tools.eq_(data.shape, (2, 0, 0))
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def _load_text(path):
+  """Decoder for text arrays, used to test decoders on worker processes"""
+
+  return numpy.loadtxt(path, dtype='int16', ndmin=2)
+
+
+@sql3_available
+def test_load_shared_decoders():
+
+  import shutil
+  import tempfile
+  import multiprocessing
+  from concurrent.futures import ProcessPoolExecutor
+  from .loader import register_decoder, load_shared, DECODERS, _decode_into
+
+  db = Database()
+  files = db.objects(sizes='cropped')[:4]
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    for k, f in enumerate(files):
+      if not os.path.exists(os.path.dirname(f.make_path(tmpdir))):
+        os.makedirs(os.path.dirname(f.make_path(tmpdir)))
+      numpy.savetxt(f.make_path(tmpdir, '.arr'), numpy.full((2, 3), -k),
+          fmt='%d')
+
+    register_decoder('.arr', _load_text)
+    data, errors = load_shared(files, tmpdir, '.arr', workers=2)
+    nose.tools.eq_(errors, {})
+    nose.tools.eq_(data.dtype, numpy.int16)
+    nose.tools.eq_([int(k[0,0]) for k in data], [0, -1, -2, -3])
+
+    # workers started with "spawn" do not inherit our registry of decoders
+    from multiprocessing import shared_memory
+    block = shared_memory.SharedMemory(create=True, size=2 * 2 * 3 * 2)
+    try:
+      tasks = [(k, f.make_path(tmpdir, '.arr')) for k, f in \
+          enumerate(files[2:])]
+      context = multiprocessing.get_context('spawn')
+      with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        nose.tools.eq_(pool.submit(_decode_into, block.name, (2, 2, 3),
+          numpy.dtype('int16'), _load_text, tasks).result(), {})
+      data = numpy.ndarray((2, 2, 3), dtype='int16', buffer=block.buf)
+      nose.tools.eq_(data[:,0,0].tolist(), [-2, -3])
+      del data
+    finally:
+      block.close()
+      block.unlink()
+
+    # decoders which cannot be sent to workers are reported upfront
+    register_decoder('.arr', lambda path: _load_text(path))
+    nose.tools.assert_raises(ValueError, load_shared, files, tmpdir, '.arr')
+  finally:
+    DECODERS.pop('.arr', None)
+    shutil.rmtree(tmpdir)
+
+
+@sql3_available
+def test_load_many_dtype():
+
+  import shutil
+  import tempfile
+
+  db = Database()
+  files = db.objects(sizes='cropped')[:3]
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    for f, dtype in zip(files, ('float32', 'uint16', 'float64')):
+      if not os.path.exists(os.path.dirname(f.make_path(tmpdir))):
+        os.makedirs(os.path.dirname(f.make_path(tmpdir)))
+      numpy.save(f.make_path(tmpdir, '.npy'),
+          numpy.full((3, 4), 0.5, dtype=dtype))
+
+    # the data type comes from the first image, and is never truncated
+    for processes in (False, True):
+      data, errors = db.load_many(files, tmpdir, '.npy', workers=1,
+          processes=processes)
+      nose.tools.eq_(data.dtype, numpy.float32)
+      nose.tools.eq_(data[0].tolist(), [[0.5] * 4] * 3)
+      nose.tools.eq_(data[1].tolist(), [[0] * 4] * 3)
+      nose.tools.eq_(sorted(errors), [2])
+      assert isinstance(errors[2], TypeError)
+
+    # explicit data types are respected as well
+    from .loader import load_many
+    data, errors = load_many(files, tmpdir, '.npy', dtype='uint8')
+    nose.tools.eq_(data.dtype, numpy.uint8)
+    nose.tools.eq_(sorted(errors), [0, 1, 2])
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+@sql3_available
+def test_load_extension():
+
+  import shutil
+  import tempfile
+  from .loader import register_decoder, DECODERS
+
+  db = Database()
+  f = db.objects()[0]
+  data = numpy.arange(12, dtype='uint8').reshape(3, 4)
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    os.makedirs(os.path.dirname(f.make_path(tmpdir)))
+
+    numpy.save(f.make_path(tmpdir, '.npy'), data)
+    loaded = f.load(tmpdir, '.npy')
+    assert isinstance(loaded, numpy.memmap)
+    assert numpy.array_equal(loaded, data)
+
+    numpy.savez(f.make_path(tmpdir, '.npz'), data)
+    assert numpy.array_equal(f.load(tmpdir, '.npz'), data)
+
+    register_decoder('.raw', lambda path: numpy.fromfile(path, dtype='uint8'))
+    try:
+      data.tofile(f.make_path(tmpdir, '.raw'))
+      assert numpy.array_equal(f.load(tmpdir, '.raw'), data.flatten())
+    finally:
+      del DECODERS['.raw']
+
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def test_packed():
+
+  import shutil
+  import tempfile
+  from .packed import pack
+  from .loader import decode
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    dataset, sqlite_file = synthetic_database(tmpdir)
+    db = Database(sqlite_file=sqlite_file)
+    files = db.objects(protocol='Cropped-Nom', groups='dev',
+        purposes='enroll')
+    nose.tools.eq_(len(files), 4)
+
+    packdir = os.path.join(tmpdir, 'packed')
+    nose.tools.eq_(pack(files, dataset, packdir, 'cropped'), 4)
+    stores = db.open_packed(packdir)
+    try:
+      nose.tools.eq_(len(stores), 1)
+      nose.tools.eq_(len(stores[0]), 4)
+      for f in files:
+        image = f.load(dataset)
+        assert isinstance(image, numpy.memmap)
+        assert not image.flags.writeable
+        assert numpy.array_equal(image, decode(f.make_path(dataset, '.png')))
+
+      # re-opening replaces stores, which only serve their own dataset
+      db.open_packed(packdir)
+      from . import packed
+      nose.tools.eq_(len(packed.STORES), 1)
+      nose.tools.assert_raises(Exception, files[0].load, packdir)
+      assert isinstance(files[0].load(os.path.join(dataset, '.')),
+          numpy.memmap) #same directory, spelled differently
+
+      # a copy of the dataset elsewhere is decoded, not served from the store
+      copy = os.path.join(tmpdir, 'copy')
+      shutil.copytree(dataset, copy)
+      image = files[0].load(copy)
+      assert not isinstance(image, numpy.memmap)
+      assert numpy.array_equal(image, files[0].load(dataset))
+
+      # processes copy packed images, instead of decoding them
+      data, errors = db.load_many(files, dataset, workers=2, processes=True)
+      nose.tools.eq_(errors, {})
+      for f, image in zip(files, data):
+        assert numpy.array_equal(image, f.load(dataset))
+    finally:
+      db.close_packed()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def test_pack_dtype():
+
+  import shutil
+  import tempfile
+  from .packed import pack
+  from .loader import DECODERS
+
+  tmpdir = tempfile.mkdtemp()
+  decoder = DECODERS['.png']
+  try:
+    _, sqlite_file = synthetic_database(tmpdir, images=False)
+    files = Database(sqlite_file=sqlite_file).objects(sizes='cropped',
+        detached=True)[:3]
+
+    # images are never truncated to fit the packed store
+    DECODERS['.png'] = lambda path: numpy.full((2, 3), 300, dtype='uint16')
+    nose.tools.assert_raises(TypeError, pack, files, tmpdir,
+        os.path.join(tmpdir, 'packed'), 'cropped')
+    DECODERS['.png'] = lambda path: numpy.ones((2, 3), dtype=bool)
+    nose.tools.eq_(pack(files, tmpdir, os.path.join(tmpdir, 'packed'),
+      'cropped'), 3)
+  finally:
+    DECODERS['.png'] = decoder
+    shutil.rmtree(tmpdir)
+
+
+def test_lru_cache():
+
+  from .cache import LRUCache
+
+  cache = LRUCache()
+  assert not cache.enabled
+  cache.put('a', numpy.zeros((10,), dtype='uint8'))
+  nose.tools.eq_(len(cache), 0) #disabled
+
+  cache.max_bytes = 25
+  a = numpy.zeros((10,), dtype='uint8')
+  stored = cache.put('a', a)
+  assert a.flags.writeable #the caller's array is not modified
+  assert not stored.flags.writeable
+  assert stored.base is a
+  cache.put('b', numpy.zeros((10,), dtype='uint8'))
+  assert cache.get('a') is stored #'a' is now the most recently used
+  cache.put('c', numpy.zeros((10,), dtype='uint8'))
+  assert cache.get('b') is None #evicted
+  assert cache.get('c') is not None
+  cache.put('d', numpy.zeros((30,), dtype='uint8')) #too large, ignored
+  import tempfile
+  with tempfile.TemporaryFile() as f:
+    m = numpy.memmap(f, dtype='uint8', mode='w+', shape=(4,))
+    assert cache.put('e', m) is m #memory-mapped, ignored
+    del m
+
+  stats = cache.stats()
+  nose.tools.eq_(stats['entries'], 2)
+  nose.tools.eq_(stats['bytes'], 20)
+  nose.tools.eq_(stats['hits'], 2)
+  nose.tools.eq_(stats['misses'], 1)
+  nose.tools.eq_(stats['evictions'], 1)
+
+  cache.max_bytes = 10
+  nose.tools.eq_(len(cache), 1)
+  cache.clear()
+  nose.tools.eq_(cache.stats()['bytes'], 0)
+
+
+def test_load_cached():
+
+  import shutil
+  import tempfile
+  from . import cache
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    dataset, sqlite_file = synthetic_database(tmpdir)
+    db = Database(sqlite_file=sqlite_file)
+    paddb = PADDatabase(sqlite_file=sqlite_file)
+    f = [k for k in paddb.objects(protocol='full', groups='dev') if \
+        k.size == 'full'][0]
+    g = [k for k in db.objects() if k.id == f.id][0]
+
+    cache.configure(2**24)
+    try:
+      image = f.load(dataset)
+      roi = f.roi(dataset)
+      assert not image.flags.writeable
+      assert g.load(dataset) is image
+      assert g.roi(dataset) is roi
+      nose.tools.eq_(cache.stats()['hits'], 2)
+      nose.tools.eq_(cache.stats()['misses'], 2)
+    finally:
+      cache.configure(0)
+      cache.clear()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def test_polygon_mask():
+
+  from .roi import polygon_mask
+
+  # the cropped image RoI covers the whole image
+  mask = polygon_mask([[149,0], [0,0], [0,564], [149,564]], (150, 565))
+  assert mask.all()
+
+  mask = polygon_mask([[2,2], [2,7], [7,7], [7,2]], (10, 10))
+  nose.tools.eq_(mask.sum(), 36)
+  assert mask[2:8,2:8].all()
+
+  # triangle, compared to a point-by-point, even-odd test of pixel centers
+  points = numpy.array([[0,5], [9,0], [9,9]])
+  mask = polygon_mask(points, (10, 10))
+  for y in range(10):
+    for x in range(10):
+      if abs(x - 5) * 9 < y * 5:
+        assert mask[y,x], (y, x)
+  assert not mask[0,0] and not mask[0,9]
+
+  nose.tools.eq_(polygon_mask(numpy.zeros((0,2)), (3, 3)).sum(), 0)
+
+
+def test_roi_masks():
+
+  import shutil
+  import tempfile
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    dataset, sqlite_file = synthetic_database(tmpdir)
+    db = Database(sqlite_file=sqlite_file)
+    files = db.objects(protocol='Nom', groups='dev', purposes='enroll')
+    nose.tools.eq_(len(files), 4)
+
+    cachedir = os.path.join(tmpdir, 'masks')
+    masks = db.roi_masks(files, dataset, cache=cachedir)
+    nose.tools.eq_(masks.shape, (4, 250, 665))
+    nose.tools.eq_(masks.dtype, bool)
+    for k, f in enumerate(files):
+      assert masks[k].any()
+      assert os.path.exists(f.make_path(cachedir, '.npz'))
+      assert numpy.array_equal(f.roi_mask(dataset, cache=cachedir),
+          masks[k])
+
+    # cached masks are read back, without the annotations
+    shutil.rmtree(os.path.join(dataset, 'annotations'))
+    assert numpy.array_equal(db.roi_masks(files, dataset, cache=cachedir),
+        masks)
+    nose.tools.assert_raises(Exception, files[0].roi_mask, dataset)
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+@sql3_available
+def test_roi_store():
+
+  import shutil
+  import tempfile
+  from .roi import write_store, store_path, ROIStore
+
+  db = Database()
+  files = db.objects(sizes='full')[:4]
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    roidir = os.path.join(tmpdir, 'annotations', 'roi')
+    expected = []
+    for k, f in enumerate(files):
+      points = numpy.arange(2*(k+11), dtype='uint16').reshape(-1, 2)
+      if not os.path.exists(os.path.dirname(f.make_path(roidir))):
+        os.makedirs(os.path.dirname(f.make_path(roidir)))
+      numpy.savetxt(f.make_path(roidir, '.txt'), points, fmt='%d')
+      expected.append(points)
+
+    nose.tools.eq_(write_store(files, tmpdir), 4)
+    store = ROIStore(store_path(tmpdir))
+    nose.tools.eq_(len(store), 4)
+
+    for f, points in zip(files, expected):
+      # makes sure we read the binary store and not the text files
+      os.unlink(f.make_path(roidir, '.txt'))
+      roi = f.roi(tmpdir)
+      nose.tools.eq_(roi.dtype, numpy.uint16)
+      assert numpy.array_equal(roi, points)
+
+    # after the database is re-created, identifiers may refer to other files
+    row = db.objects(sizes='full', detached=True)[0]
+    assert store.lookup(row) is not None
+    moved = row._replace(path=files[1].path)
+    assert store.lookup(moved) is None
+    nose.tools.assert_raises(IOError, moved.roi, tmpdir) #text file is gone
+
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def test_lazy_import():
+
+  import sys
+  import subprocess
+
+  # importing the package should not import the ORM or open the database
+  code = 'import sys; import bob.db.verafinger; ' \
+      'print(sorted(k for k in ("sqlalchemy", "bob.db.verafinger.models", ' \
+      '"bob.db.verafinger.query", "pkg_resources") if k in sys.modules))'
+  output = subprocess.check_output([sys.executable, '-c', code])
+  nose.tools.eq_(output.decode().strip(), '[]')
+
+  # names are still resolvable
+  import bob.db.verafinger
+  assert bob.db.verafinger.Database is Database
+  assert bob.db.verafinger.File.__name__ == 'File'
+  assert 'PADDatabase' in dir(bob.db.verafinger)
+  nose.tools.assert_raises(AttributeError, getattr, bob.db.verafinger, 'Foo')
+
+
+def test_benchmark_imports():
+
+  from .benchmark import time_imports
+
+  timings = time_imports(repeat=1)
+  for name in ('import', 'import+Database'):
+    nose.tools.eq_(len(timings[name]), 1)
+    assert timings[name][0] > 0
+
+
+def test_driver_parser_does_not_open_database():
+
+  import sys
+  import subprocess
+
+  code = 'import sys, argparse; ' \
+      'from bob.db.verafinger.driver import Interface; ' \
+      'Interface().add_commands(argparse.ArgumentParser()); ' \
+      'print(sorted(k for k in ("bob.db.verafinger.query", ' \
+      '"bob.db.verafinger.pad") if k in sys.modules))'
+  output = subprocess.check_output([sys.executable, '-c', code])
+  nose.tools.eq_(output.decode().strip(), '[]')
+
+
+def test_driver_parser_without_manifest():
+
+  import argparse
+  from . import driver
+
+  # without the manifest written by "create", any protocol name is parsed
+  saved = driver._MANIFEST
+  driver._MANIFEST = {}
+  try:
+    parser = argparse.ArgumentParser()
+    driver.Interface().add_commands(parser)
+    nose.tools.eq_(parser.parse_args(['dumplist', '-p', 'B']).protocol, 'B')
+    nose.tools.eq_(parser.parse_args(['dumppadlist', '-p', 'full']).protocol,
+        'full')
+  finally:
+    driver._MANIFEST = saved
+
+
+def test_create():
+
+  import shutil
+  import sqlite3
+  import argparse
+  import tempfile
+  from .create import create
+  from .synthetic import write_dataset
+
+  tables = ('file', 'subset', 'padsubset', 'subset_file_association',
+      'padsubset_file_association')
+
+  def _counts(path):
+    connection = sqlite3.connect(path)
+    try:
+      return [connection.execute('SELECT COUNT(*) FROM %s' % k).fetchone()[0]
+          for k in tables]
+    finally:
+      connection.close()
+
+  def _lines(*path):
+    with open(os.path.join(*path), 'rt') as f:
+      return len([k for k in f if k.strip()])
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    dataset = os.path.join(tmpdir, 'dataset')
+    write_dataset(dataset, clients=2)
+    dbfile = os.path.join(tmpdir, 'db', 'db.sql3')
+    create(argparse.Namespace(files=[dbfile], type='sqlite', recreate=True,
+      verbose=0, directory=dataset))
+
+    # 2 clients, 2 sides, 2 sessions, 2 sizes and 2 sources - bio protocols
+    # exist for both sizes, each with 4 subsets, and list probes once for
+    # bona fide samples and once for attacks; PAD protocols have 3 groups,
+    # each with 2 subsets
+    bio = os.path.join(dataset, 'protocols', 'bio')
+    pad = os.path.join(dataset, 'protocols', 'pad')
+    nose.tools.eq_(_counts(dbfile), [
+      2*2*2*2*2,
+      2 * 4 * len(os.listdir(bio)),
+      3 * 2 * len(os.listdir(pad)),
+      2 * sum([_lines(bio, k, 'train.txt') + _lines(bio, k, 'models.txt') +
+        2 * _lines(bio, k, 'probes.txt') for k in os.listdir(bio)]),
+      sum([_lines(pad, k, '%s.txt' % g) for k in os.listdir(pad) for g in
+        ('train', 'dev', 'eval')]),
+      ])
+
+    # indexes and statistics for the query planner
+    connection = sqlite3.connect(dbfile)
+    try:
+      indexes = dict(connection.execute("SELECT name, tbl_name FROM " \
+          "sqlite_master WHERE type = 'index'").fetchall())
+      plan = connection.execute("EXPLAIN QUERY PLAN SELECT id FROM file " \
+          "WHERE finger_id = 1 AND size = 'full' AND source = 'bf' AND " \
+          "session = '1'").fetchall()
+      stats = connection.execute('SELECT COUNT(*) FROM sqlite_stat1'
+          ).fetchone()[0]
+    finally:
+      connection.close()
+    nose.tools.eq_(indexes['ix_file_model_id'], 'file')
+    nose.tools.eq_(indexes['subset_protocol_id_group_purpose'], 'subset')
+    nose.tools.eq_(indexes['padsubset_protocol_id_group_purpose'],
+        'padsubset')
+    assert 'USING' in plan[0][-1], plan #unique constraint on file
+    assert stats > 0
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+@sql3_available
+def test_check():
+
+  import shutil
+  import tempfile
+  from .check import check
+
+  db = Database()
+  files = db.objects(sizes='full')[:3]
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    roidir = os.path.join(tmpdir, 'annotations', 'roi')
+    for f in files:
+      for path in (f.make_path(tmpdir, '.png'), f.make_path(roidir, '.txt')):
+        if not os.path.exists(os.path.dirname(path)):
+          os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as g: g.write(b'0123456789')
+
+    bad, manifest = check(files, tmpdir, annotations=True, algorithm='sha256')
+    nose.tools.eq_(bad, [])
+    nose.tools.eq_(len(manifest['files']), 3)
+    assert 'hash' in manifest['files'][str(files[0].id)]['roi']
+
+    # same size, different contents
+    with open(files[0].make_path(tmpdir, '.png'), 'wb') as g:
+      g.write(b'9876543210')
+    os.unlink(files[1].make_path(roidir, '.txt'))
+    bad, _ = check(files, tmpdir, annotations=True, algorithm='sha256',
+        manifest=manifest)
+    nose.tools.eq_(sorted(bad), sorted([
+      (files[0].make_path(tmpdir, '.png'), 'modified'),
+      (files[1].make_path(roidir, '.txt'), 'missing'),
+      ]))
+
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+@sql3_available
+def test_iter_objects():
+
+  from .records import FileRow
+
+  def _expected(f):
+    return (f.id, f.path, f.model_id, f.finger.client.id, f.finger.side,
+        f.session, f.size, f.source)
+
+  for index in (False, True):
+    db = Database(index=index)
+    for kwargs in (dict(), dict(protocol='Nom', groups='dev'),
+        dict(protocol='Full', purposes='attack', genders='F')):
+      rows = db.iter_objects(batch_size=7, **kwargs)
+      nose.tools.eq_([tuple(k) for k in rows],
+          [_expected(k) for k in db.objects(**kwargs)])
+
+    row = next(db.iter_objects(sizes='full'))
+    assert isinstance(row, FileRow)
+    nose.tools.eq_(row.make_path('dir', '.png'),
+        os.path.join('dir', row.path + '.png'))
+
+    pad = PADDatabase(index=index)
+    nose.tools.eq_([tuple(k) for k in pad.iter_objects(protocol='full',
+      groups='dev')], [_expected(k) for k in pad.objects(protocol='full',
+        groups='dev')])
+
+  # parameters are validated before iterating
+  nose.tools.assert_raises(ValueError, Database().iter_objects,
+      protocol='Unknown')
+
+
+@sql3_available
+def test_detached():
+
+  import pickle
+  from .records import FileRow
+
+  for index in (False, True):
+    db = Database(index=index)
+    kwargs = dict(protocol='Nom', groups='dev', purposes='enroll')
+    rows = db.objects(detached=True, **kwargs)
+    files = db.objects(**kwargs)
+    nose.tools.eq_(rows, list(db.iter_objects(**kwargs)))
+    nose.tools.eq_([(k.id, k.path, k.model_id, k.size, k.source, k.session)
+      for k in rows], [(k.id, k.path, k.model_id, k.size, k.source, k.session)
+        for k in files])
+    assert all(isinstance(k, FileRow) for k in rows)
+    assert not hasattr(rows[0], '__dict__')
+
+    # rows pickle as plain tuples, without any database state
+    data = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+    assert len(data) < 100 * len(rows), len(data) / float(len(rows))
+    nose.tools.eq_(pickle.loads(data), rows)
+
+    pad = PADDatabase(index=index)
+    nose.tools.eq_(pad.objects(protocol='full', groups='dev', detached=True),
+        list(pad.iter_objects(protocol='full', groups='dev')))
+
+  # parameters are validated as usual
+  nose.tools.assert_raises(ValueError, Database().objects, protocol='Unknown',
+      detached=True)
+
+  row = Database().objects(sizes='cropped', detached=True)[0]
+  nose.tools.eq_(row.roi(None).tolist(), [[149,0], [0,0], [0,564],
+    [149,564]])
+  nose.tools.eq_(row.roi_mask(None).shape, (150, 565))
+
+
+@sql3_available
+def test_async():
+
+  import asyncio
+  import threading
+  import time
+  from . import aio
+
+  db = Database()
+  paddb = PADDatabase()
+  queries = [dict(), dict(protocol='Nom', groups='dev'),
+      dict(protocol='Full', purposes='enroll', sizes='full'),
+      dict(protocol='Fifty', groups='train', detached=True)]
+
+  async def _queries():
+    # concurrent queries on the same database objects
+    objects = await asyncio.gather(*[db.aobjects(**k) for k in queries * 5])
+    models = await asyncio.gather(db.amodel_ids(), db.amodel_ids('Nom'))
+    pad = await paddb.aobjects(protocol='full', groups='dev')
+    return objects, models, pad
+
+  objects, models, pad = asyncio.run(_queries())
+  nose.tools.eq_([[k.id for k in v] for v in objects],
+      [[k.id for k in db.objects(**q)] for q in queries * 5])
+  nose.tools.eq_(models, [db.model_ids(), db.model_ids('Nom')])
+  nose.tools.eq_([k.id for k in pad], [k.id for k in
+    paddb.objects(protocol='full', groups='dev')])
+
+  # errors are raised on the caller
+  nose.tools.assert_raises(ValueError, asyncio.run,
+      db.aobjects(protocol='Unknown'))
+
+  # the number of blocking calls running at once is bounded
+  state = {'running': 0, 'maximum': 0}
+  lock = threading.Lock()
+  def _blocking():
+    with lock:
+      state['running'] += 1
+      state['maximum'] = max(state['maximum'], state['running'])
+    time.sleep(0.01)
+    with lock: state['running'] -= 1
+
+  async def _calls():
+    await asyncio.gather(*[aio.run(_blocking) for k in range(20)])
+
+  try:
+    aio.set_workers(3)
+    asyncio.run(_calls())
+    nose.tools.eq_(state['maximum'], 3)
+  finally:
+    aio.set_workers(aio.WORKERS)
+
+
+def _statements(db, function, *args, **kwargs):
+  """Calls ``function``, returning its output and all SQL statements issued"""
+
+  from sqlalchemy import event
+
+  statements = []
+  def _record(conn, cursor, statement, *args):
+    statements.append(statement)
+
+  engine = db.m_session.bind
+  event.listen(engine, 'before_cursor_execute', _record)
+  try:
+    return function(*args, **kwargs), statements
+  finally:
+    event.remove(engine, 'before_cursor_execute', _record)
+
+
+@sql3_available
+def test_objects_query_count():
+
+  for cls, kwargs in ((Database, dict(sizes='full')),
+      (Database, dict(protocol='Full', groups='dev', genders='F')),
+      (Database, dict(protocol='Full', purposes='attack',
+        model_ids=['001_L_1', '002_R_2'])),
+      (PADDatabase, dict(protocol='full', groups='dev'))):
+    db = cls()
+    db.objects(sizes='cropped', sessions='1') #connects the session
+    db.m_session.expunge_all() #forgets fingers and clients already loaded
+
+    def _paths():
+      files = db.objects(**kwargs)
+      return files, [k.make_path('', '') for k in files]
+
+    (files, paths), statements = _statements(db, _paths)
+
+    # a single round-trip for files, independently of the number of files (or
+    # fingers) returned: no extra query is issued while building paths, other
+    # statements only validate parameters (protocol names and model ids)
+    assert len(set([k.finger_id for k in files])) > 1
+    selected = [k for k in statements if k.startswith('SELECT file.id')]
+    nose.tools.eq_(len(selected), 1, statements)
+    for k in statements:
+      if k in selected: continue
+      assert 'protocol.name' in k.split('\n')[0] or \
+          k.startswith('SELECT DISTINCT file.model_id'), k
+
+  db = Database()
+  _, statements = _statements(db, db.model_ids, 'Full', 'dev')
+  nose.tools.eq_(len([k for k in statements if 'file.model_id' in k]), 1)
+
+
+@sql3_available
+def test_objects_query_plan():
+
+  def _plan(db, args):
+    query = db._objects_query(*args)
+    sql = str(query.statement.compile(dialect=db.m_session.bind.dialect,
+      compile_kwargs={'literal_binds': True}))
+    return [k[-1] for k in db.m_session.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+  db = Database()
+  plan = _plan(db, db._check_objects_parameters('Full', 'dev', 'probe',
+    None, 'F', None, None, None, None))
+  assert [k for k in plan if 'subset_file_association_subset_id_file_id' \
+      in k and 'COVERING INDEX' in k], plan
+  assert not [k for k in plan if k.startswith('SCAN') and \
+      'association' in k], plan
+
+  db = PADDatabase()
+  plan = _plan(db, db._check_objects_parameters('full', 'dev', 'attack',
+    None, None, None, None, None))
+  assert [k for k in plan if 'padsubset_file_association_padsubset_id' \
+      in k and 'COVERING INDEX' in k], plan
+  assert not [k for k in plan if k.startswith('SCAN') and \
+      'association' in k], plan
+
+
+@sql3_available
+def test_comparison_plan():
+
+  db = Database()
+  plan = db.comparison_plan('Full')
+
+  nose.tools.eq_(plan.model_ids.tolist(), db.model_ids('Full', 'dev'))
+  nose.tools.eq_(plan.probe_ids.tolist(),
+      [k.id for k in db.objects('Full', 'dev', 'probe')])
+  nose.tools.eq_(plan.genuine.shape, (len(plan.model_ids),
+    len(plan.probe_ids)))
+
+  probes = dict([(k.id, k) for k in db.objects('Full', 'dev', 'probe')])
+  for i, model_id in enumerate(plan.model_ids.tolist()):
+    enroll = db.objects('Full', 'dev', 'enroll', model_ids=model_id)
+    nose.tools.eq_([k.id for k in enroll], plan.enroll_ids[
+      plan.enroll_offsets[i]:plan.enroll_offsets[i+1]].tolist())
+    attacks = db.objects('Full', 'dev', 'attack', model_ids=model_id)
+    nose.tools.eq_(sorted([k.id for k in attacks]),
+        sorted(plan.attack_ids[plan.attacks[i]].tolist()))
+    finger = db.finger_name_from_model_id(model_id)
+    genuine = plan.probe_ids[plan.genuine[i]].tolist()
+    assert genuine
+    for k in genuine: nose.tools.eq_(probes[k].finger.unique_name, finger)
+
+  plan = db.comparison_plan('Full', include_attacks=False)
+  nose.tools.eq_(plan.attacks.shape, (len(plan.model_ids), 0))
+
+  nose.tools.assert_raises(ValueError, db.comparison_plan, 'Unknown')
+
+
+@sql3_available
+def test_memoised_metadata():
+
+  db = Database()
+  models = db.model_ids('Full', 'dev')
+  db.protocol_names()
+  for k in models: db.finger_name_from_model_id(k)
+  misses = db.cache_stats()['misses']
+
+  def _lookups():
+    for k in models:
+      db.objects('Full', 'dev', 'enroll', model_ids=k)
+      db.finger_name_from_model_id(k)
+    return db.model_ids('Full', ['dev'])
+
+  retval, statements = _statements(db, _lookups)
+  nose.tools.eq_(retval, models)
+  # only retrieves files, metadata lookups are memoised
+  nose.tools.eq_(len(statements), len(models))
+  stats = db.cache_stats()
+  nose.tools.eq_(stats['misses'], misses)
+  assert stats['hits'] >= 4*len(models)
+
+  # the returned list is a copy
+  retval.append('000_X_0')
+  nose.tools.eq_(db.model_ids('Full', 'dev'), models)
+
+  db.clear_cache()
+  nose.tools.eq_(db.cache_stats(), dict(entries=0, hits=0, misses=0))
+  nose.tools.eq_(db.model_ids('Full', 'dev'), models)
+  nose.tools.eq_(db.cache_stats()['misses'], 2) #protocol names and models
+
+
+@sql3_available
+def test_read_only():
+
+  import multiprocessing
+  from . import connection
+
+  db = Database(read_only=True)
+  paddb = PADDatabase(read_only=True)
+  assert db.is_valid()
+  assert db.m_session.bind is paddb.m_session.bind #a single engine
+  nose.tools.eq_([k.id for k in db.objects(protocol='Full')],
+      [k.id for k in Database().objects(protocol='Full')])
+  nose.tools.eq_([k.id for k in paddb.objects(groups='dev')],
+      [k.id for k in PADDatabase().objects(groups='dev')])
+  assert 'immutable=1' in connection.uri(db.m_sqlite_file)
+
+  import sqlalchemy.exc
+  nose.tools.assert_raises(sqlalchemy.exc.OperationalError,
+      db.m_session.execute, 'DELETE FROM file')
+  db.m_session.rollback()
+
+  # child processes re-connect lazily, on their first query
+  def _child(conn):
+    conn.send((len(db.objects(protocol='Full')), db._pid == os.getpid()))
+    conn.close()
+
+  context = multiprocessing.get_context('fork')
+  parent, child = context.Pipe()
+  process = context.Process(target=_child, args=(child,))
+  process.start()
+  nose.tools.eq_(parent.recv(), (len(db.objects(protocol='Full')), True))
+  process.join()
+  nose.tools.eq_(process.exitcode, 0)
+
+
+def test_read_only_many():
+
+  import gc
+  import shutil
+  import tempfile
+  import threading
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    _, sqlite_file = synthetic_database(tmpdir, images=False)
+
+    # more objects than a default pool of connections would hold
+    dbs = [Database(read_only=True, sqlite_file=sqlite_file) for k in
+        range(10)] + [PADDatabase(read_only=True, sqlite_file=sqlite_file)
+            for k in range(10)]
+    names = [k.protocol_names() for k in dbs]
+    nose.tools.eq_(len(set(names)), 2) #bio and pad protocols
+    engine = dbs[0].m_session.bind
+
+    # deleting one object leaves the shared engine to the others
+    disposed = []
+    engine.dispose = lambda: disposed.append(True)
+    del dbs[0]
+    gc.collect()
+    del engine.dispose
+    nose.tools.eq_(disposed, [])
+    assert dbs[0].m_session.bind is engine
+    expected = len(dbs[0].objects(protocol='Full'))
+    assert expected > 0
+    for k in dbs[1:9]: nose.tools.eq_(len(k.objects(protocol='Full')),
+        expected)
+
+    # objects are also usable from other threads
+    counts = []
+    threads = [threading.Thread(target=lambda db=k: \
+        counts.append(len(db.objects(groups='dev')))) for k in dbs[9:]]
+    for k in threads: k.start()
+    for k in threads: k.join()
+    nose.tools.eq_(len(counts), len(threads))
+    assert min(counts) > 0
+
+    for k in dbs: k.m_session.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+@sql3_available
+@snapshot_available
+def test_snapshot():
+
+  import sys
+  import subprocess
+
+  def _row(f):
+    return (f.id, f.path, f.model_id, f.finger.client.id, f.finger.side,
+        f.session, f.size, f.source)
+
+  db = Database()
+  snapshot = Database(backend='snapshot')
+  assert snapshot.is_valid()
+  nose.tools.eq_(snapshot.protocol_names(), db.protocol_names())
+  for kwargs in (dict(), dict(protocol='Full', groups='dev',
+    purposes='probe'), dict(protocol='Nom', purposes='attack',
+      model_ids=db.model_ids('Nom')[:2]), dict(genders='F', sizes='cropped')):
+    nose.tools.eq_([tuple(k) for k in snapshot.objects(**kwargs)],
+        [_row(k) for k in db.objects(**kwargs)])
+  nose.tools.eq_(snapshot.model_ids('Full', 'dev'), db.model_ids('Full',
+    'dev'))
+  model_id = db.model_ids('Full')[0]
+  nose.tools.eq_(snapshot.finger_name_from_model_id(model_id),
+      db.finger_name_from_model_id(model_id))
+
+  paddb = PADDatabase()
+  padsnapshot = PADDatabase(backend='snapshot')
+  nose.tools.eq_([tuple(k) for k in padsnapshot.objects(protocol='full',
+    groups='dev')], [_row(k) for k in paddb.objects(protocol='full',
+      groups='dev')])
+
+  nose.tools.assert_raises(ValueError, Database, backend='foo')
+
+  # the snapshot backend does not depend on the ORM
+  code = 'import sys; import bob.db.verafinger; ' \
+      'db = bob.db.verafinger.Database(backend="snapshot"); ' \
+      'db.objects(protocol="Full"); db.model_ids(); ' \
+      'bob.db.verafinger.PADDatabase(backend="snapshot").objects(); ' \
+      'print(sorted(k for k in ("sqlalchemy", "bob.db.verafinger.models") ' \
+      'if k in sys.modules))'
+  output = subprocess.check_output([sys.executable, '-c', code])
+  nose.tools.eq_(output.decode().strip(), '[]')
+
+
+def test_synthetic():
+
+  import shutil
+  import tempfile
+  from .synthetic import write_dataset, create_database
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    write_dataset(os.path.join(tmpdir, 'dataset'))
+    sqlite_file = create_database(os.path.join(tmpdir, 'dataset'),
+        os.path.join(tmpdir, 'db', 'db.sql3'))
+
+    # same structure as the original dataset
+    db = Database(sqlite_file=sqlite_file)
+    nose.tools.eq_(len(db.protocol_names()), 8)
+    nose.tools.eq_(len(db.model_ids()), 440)
+    nose.tools.eq_(len(db.model_ids(protocol='B')), 216)
+    nose.tools.eq_(len(db.objects(protocol='Nom', groups='dev')), 660)
+    nose.tools.eq_(len(db.objects(protocol='Fifty', groups='train')), 240)
+    nose.tools.eq_(len(db.objects(protocol='Full', groups='dev')), 880)
+
+    paddb = PADDatabase(sqlite_file=sqlite_file)
+    nose.tools.eq_(paddb.protocol_names(), ('cropped', 'full'))
+    nose.tools.eq_([len(paddb.objects(protocol='full', groups=k)) for k in
+      paddb.groups()], [240, 240, 400])
+
+    snapshot = Database(sqlite_file=sqlite_file, backend='snapshot')
+    nose.tools.eq_(len(snapshot.objects(protocol='Full', groups='dev')), 880)
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def test_synthetic_images():
+
+  import shutil
+  import tempfile
+  from bob.db.base.script.dbmanage import main
+  from .synthetic import create_database
+  from .check import check
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    dataset = os.path.join(tmpdir, 'dataset')
+    nose.tools.eq_(main(['verafinger', 'synthesize', '--output=%s' % dataset,
+      '--clients=2', '--images']), 0)
+    sqlite_file = create_database(dataset,
+        os.path.join(tmpdir, 'db', 'db.sql3'))
+
+    db = Database(sqlite_file=sqlite_file)
+    files = db.objects()
+    nose.tools.eq_(len(files), 2*2*2*2*2) #clients, sides, sessions, ...
+    nose.tools.eq_(check(files, dataset, annotations=True)[0], [])
+
+    for f in files:
+      image = f.load(dataset)
+      nose.tools.eq_(image.dtype, numpy.uint8)
+      nose.tools.eq_(image.shape, (250, 665) if f.size == 'full' else \
+          (150, 565))
+      if f.size != 'full': continue
+      roi = f.roi(dataset)
+      nose.tools.eq_(roi.shape[1], 2)
+      assert roi[:,0].max() < 250 and roi[:,1].max() == 664
+      mask = f.roi_mask(dataset)
+      assert 0.5 < mask.mean() < 0.9, mask.mean()
+
+    # detached rows load the same data, without the database
+    rows = db.objects(detached=True)
+    db.m_session.close()
+    for f, row in zip(files, rows):
+      assert numpy.array_equal(row.load(dataset), f.load(dataset))
+      assert numpy.array_equal(row.roi(dataset), f.roi(dataset))
+      assert numpy.array_equal(row.roi_mask(dataset), f.roi_mask(dataset))
+
+    # prefetching iterator, in order, with annotations
+    db = Database(sqlite_file=sqlite_file, original_directory=dataset)
+    images = list(db.iter_images(protocol='Full', groups='dev', roi=True,
+      prefetch=3, workers=2))
+    nose.tools.eq_([k[0] for k in images], db.objects(protocol='Full',
+      groups='dev', detached=True))
+    for f, image, roi in images:
+      assert numpy.array_equal(image, f.load(dataset))
+      assert numpy.array_equal(roi, f.roi(dataset))
+    paddb = PADDatabase(sqlite_file=sqlite_file)
+    nose.tools.eq_([k[2] for k in paddb.iter_images(protocol='full',
+      groups='train', directory=dataset)], [None] * 8)
+
+    # asynchronous counterparts
+    import asyncio
+    async def _stream():
+      retval = []
+      async for k in db.aiter_images(protocol='Full', groups='dev', roi=True,
+          prefetch=3):
+        retval.append(k)
+      return retval, await retval[0][0].aload(dataset), \
+          await retval[0][0].aroi(dataset), await files[0].aload(dataset)
+    streamed, image, roi, orm = asyncio.run(_stream())
+    nose.tools.eq_([k[0] for k in streamed], [k[0] for k in images])
+    for (_, image1, roi1), (_, image2, roi2) in zip(streamed, images):
+      assert numpy.array_equal(image1, image2)
+      assert numpy.array_equal(roi1, roi2)
+    assert numpy.array_equal(image, images[0][1])
+    assert numpy.array_equal(roi, images[0][2])
+    assert numpy.array_equal(orm, files[0].load(dataset))
+
+    # read-ahead is bounded by the prefetch depth
+    from .loader import prefetch
+    consumed = []
+    def _files():
+      for k in rows:
+        consumed.append(k)
+        yield k
+    iterator = prefetch(_files(), dataset, depth=4, workers=2)
+    next(iterator)
+    nose.tools.eq_(len(consumed), 5)
+    iterator.close()
+    nose.tools.eq_(len(consumed), 5)
+
+    # bulk loading on processes, into shared memory
+    os.unlink(files[3].make_path(dataset, '.png'))
+    full = [k for k in rows if k.size == 'full']
+    threads, errors = db.load_many(full, dataset, workers=2)
+    data, shared_errors = db.load_many(full, dataset, workers=2,
+        processes=True)
+    nose.tools.eq_(data.shape, (len(full), 250, 665))
+    assert numpy.array_equal(data, threads)
+    nose.tools.eq_(sorted(shared_errors), sorted(errors))
+    nose.tools.eq_(sorted(errors), [full.index(rows[3])])
+    data[0] = 0 #the stack is writeable
+    del data
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def test_benchmark_queries():
+
+  import json
+  import shutil
+  import tempfile
+  from .synthetic import write_dataset, create_database
+  from .benchmark import time_queries, report, BACKENDS
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    write_dataset(os.path.join(tmpdir, 'dataset'), clients=6)
+    sqlite_file = create_database(os.path.join(tmpdir, 'dataset'),
+        os.path.join(tmpdir, 'db', 'db.sql3'))
+
+    timings = {}
+    for backend in BACKENDS:
+      timings.update(time_queries(sqlite_file, repeat=2, backend=backend))
+
+    for backend in BACKENDS:
+      for name in ('model_ids()', 'objects(Full/dev/enroll)',
+          'objects(Nom/dev/attack/001_L_1)', 'padobjects(full/eval/real)',
+          'make_path(Full/dev)'):
+        for state in ('cold', 'warm'):
+          nose.tools.eq_(len(timings['%s:%s:%s' % (backend, name, state)]),
+              2)
+
+    results = json.loads(json.dumps(report(timings, repeat=2)))
+    nose.tools.eq_(sorted(results['results']), sorted(timings))
+    entry = results['results']['sql:model_ids():cold']
+    nose.tools.eq_(entry['min'], min(entry['timings']))
+  finally:
+    shutil.rmtree(tmpdir)